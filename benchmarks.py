@@ -0,0 +1,212 @@
+"""Micro benchmarks for the request handling hot paths.
+
+Run with `python benchmarks.py [name ...]`.
+"""
+import asyncio
+import io
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+from celerystar_apistar import App, ASyncApp, Route, http
+from celerystar_apistar.server.aioserver import ASGIServer
+from celerystar_apistar.server.router import Router, TreeRouter
+
+
+def report(name, number, seconds):
+    print('%-48s %10.2f us/op' % (name, seconds / number * 1e6))
+
+
+def bench_routers():
+    def static_handler():
+        pass
+
+    def param_handler(id: int):
+        pass
+
+    for size in (10, 1000, 10000):
+        routes = []
+        for idx in range(size // 2):
+            routes.append(Route('/app/service%d' % idx, 'POST',
+                                static_handler, name='static%d' % idx))
+            routes.append(Route('/app/service%d/{id}' % idx, 'GET',
+                                param_handler, name='param%d' % idx))
+
+        # Pick paths near the end, the worst case for regex matching, with
+        # distinct ids so that lookup caches do not help.
+        static_path = '/app/service%d' % (size // 2 - 1)
+        param_paths = ['/app/service%d/%d' % (size // 2 - 1, idx)
+                       for idx in range(1000)]
+
+        for router_class in (Router, TreeRouter):
+            router = router_class(routes)
+            name = '%s %d routes' % (router_class.__name__, size)
+
+            number = 1000
+            seconds = timeit.timeit(
+                lambda: router.lookup(static_path, 'POST'), number=number)
+            report(name + ' static', number, seconds)
+
+            paths = iter(param_paths)
+            seconds = timeit.timeit(
+                lambda: router.lookup(next(paths), 'GET'), number=number)
+            report(name + ' param', number, seconds)
+
+
+def make_environ(method, path, query_string='', body=b'', **headers):
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+    }
+    for key, value in headers.items():
+        environ['HTTP_' + key.upper()] = value
+    return environ
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def bench_app(name, app, environ_factory, number=5000):
+    seconds = timeit.timeit(
+        lambda: b''.join(app(environ_factory(), start_response)), number=number)
+    report(name, number, seconds)
+    print('%-48s %10.0f req/s' % ('', number / seconds))
+
+
+def bench_validation():
+    def handler(user_id: int, item_id: int, name: str, limit: int=10,
+                offset: int=0, active: bool=True, score: float=None):
+        return {'user_id': user_id, 'item_id': item_id}
+
+    app = App(routes=[
+        Route('/users/{user_id}/items/{item_id}', 'GET', handler)
+    ])
+    bench_app('params route', app, lambda: make_environ(
+        'GET', '/users/1/items/2',
+        'name=abc&limit=20&offset=5&score=1.5'))
+
+
+def run_server_in_thread(server):
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    return loop
+
+
+async def fetch(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'
+                 % path.encode())
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+def bench_asgi_server(concurrency=100, delay=0.1):
+    async def sleep():
+        await asyncio.sleep(delay)
+        return 'ok'
+
+    app = ASyncApp(routes=[Route('/sleep', 'GET', sleep)])
+    server = ASGIServer(app, '127.0.0.1', 0)
+    run_server_in_thread(server)
+
+    async def main():
+        return await asyncio.gather(*[
+            fetch(server.port, '/sleep') for _ in range(concurrency)
+        ])
+
+    start = time.perf_counter()
+    responses = asyncio.new_event_loop().run_until_complete(main())
+    elapsed = time.perf_counter() - start
+    assert all(response.startswith(b'HTTP/1.1 200') for response in responses)
+    print('%-48s %10.2f s (%.1f s if serialized)' % (
+        '%d concurrent %.1fs async handlers' % (concurrency, delay),
+        elapsed, concurrency * delay
+    ))
+
+
+def allocated(func, number=1000):
+    """
+    Return the bytes still allocated per call after calling `func`
+    `number` times and keeping the results.
+    """
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    results = [func() for _ in range(number)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del results
+    return size / number
+
+
+def bench_headers():
+    pairs = [('Header-%d' % idx, 'value %d' % idx) for idx in range(12)]
+    repeated_pairs = pairs + [('Accept', 'text/html'), ('Accept', 'application/json')]
+    headers = http.Headers(repeated_pairs)
+    number = 20000
+
+    def replace():
+        response_headers = http.MutableHeaders(pairs)
+        response_headers['Header-5'] = 'other'
+        response_headers['Content-Type'] = 'text/plain'
+        return response_headers
+
+    cases = [
+        ('Headers() 12 pairs', lambda: http.Headers(pairs)),
+        ('Headers() 14 pairs, 1 repeated', lambda: http.Headers(repeated_pairs)),
+        ('QueryParams() 12 pairs', lambda: http.QueryParams(pairs)),
+        ('Headers.get', lambda: headers.get('Header-11')),
+        ('Headers.get_list', lambda: headers.get_list('Accept')),
+        ('MutableHeaders() + 2 sets', replace),
+        ('JSONResponse()', lambda: http.JSONResponse({'id': 1})),
+    ]
+    for name, func in cases:
+        report(name, number, timeit.timeit(func, number=number))
+
+    for name, func in cases[:3] + cases[-2:]:
+        print('%-48s %10.0f bytes' % (name, allocated(func)))
+
+
+def bench_conneg():
+    from celerystar_apistar import codecs
+    from celerystar_apistar.conneg import CodecTable, negotiate_content_type
+
+    codec_list = [codecs.JSONCodec(), codecs.JSONSchemaCodec(), codecs.TextCodec()]
+    table = CodecTable(codec_list)
+    content_type = 'text/plain; charset=utf-8'
+    accept = 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
+    number = 20000
+    cases = [
+        ('negotiate_content_type()', lambda: negotiate_content_type(codec_list, content_type)),
+        ('CodecTable.negotiate_content_type', lambda: table.negotiate_content_type(content_type)),
+        ('CodecTable.lookup_accept', lambda: table.lookup_accept(accept)),
+        ('CodecTable.negotiate_accept', lambda: table.negotiate_accept(accept)),
+    ]
+    for name, func in cases:
+        report(name, number, timeit.timeit(func, number=number))
+
+
+BENCHMARKS = {
+    'routers': bench_routers,
+    'validation': bench_validation,
+    'asgi_server': bench_asgi_server,
+    'headers': bench_headers,
+    'conneg': bench_conneg,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,15 +1,34 @@
+import base64
+import gzip
+import hashlib
+import inspect
+import logging
+import lzma
+import os
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 from os import path
 from types import FunctionType
-from typing import Callable, Dict, Any, List, Union as PythonUnion
-from functools import wraps
+from typing import Callable, Dict, Any, List, Optional, Tuple, Union as PythonUnion
+from functools import lru_cache, wraps
 
 from celerystar_apistar.server.injector import Injector, ConfigurationError
 from celerystar_apistar.validators import Validator
-from celerystar_apistar import Route, App
+from celerystar_apistar import Route, App, http, jsonbackend, msgpackbackend
+from celerystar_apistar.cache import LRUCache
+from celerystar_apistar.codecs import JSONCodec, MessagePackCodec
 from celerystar_apistar.types import Type
-from celerystar_apistar.http import JSONResponse, Response
+from celerystar_apistar.http import Response
+from celerystar_apistar.server.compression import CompressionHook
 
-from celery import Celery, Task as CeleryTask
+from celery import Celery, Task as CeleryTask, group
+from kombu.serialization import register as register_serializer
 
 from celerystar_apistar.server.components import Component
 from celerystar_apistar.validators import (
@@ -21,27 +40,876 @@ from celerystar_apistar.validators import (
 
 StrDict = Dict[str, Any]
 
+logger = logging.getLogger(__name__)
+
+JSON_SERIALIZER = 'celerystar-json'
+JSON_CONTENT_TYPE = 'application/x-celerystar-json'
+MSGPACK_SERIALIZER = 'celerystar-msgpack'
+MSGPACK_CONTENT_TYPE = 'application/x-celerystar-msgpack'
+SERIALIZERS = ('json', JSON_SERIALIZER, MSGPACK_SERIALIZER)
+
+COMPRESSIONS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'gzip': (gzip.compress, gzip.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+COMPRESSED_KEY = '_compressed_'
+BLOB_KEY = '_blob_'
+BLOBS_KEY = '_blobs_'
+
 
 class Task(CeleryTask):
     pass
 
 
-class BaseService:
+def _estimate_size(value: Any, limit: int) -> int:
+    """Return roughly how many bytes value takes once serialized, without
+    serializing it, stopping as soon as the estimate reaches limit."""
+    size = 0
+    stack = [value]
+    while stack and size < limit:
+        item = stack.pop()
+        if isinstance(item, (str, bytes)):
+            size += len(item) + 2
+        elif isinstance(item, dict):
+            size += 2
+            for key, item_value in item.items():
+                stack.append(key)
+                stack.append(item_value)
+        elif isinstance(item, (list, tuple)):
+            size += 2 + len(item)
+            stack.extend(item)
+        else:
+            size += 8
+    return size
+
+
+class PayloadCompressor:
+    """Compresses task payloads and results above a size threshold.
+
+    Sizes are estimated from the values themselves, so values below the
+    threshold are not serialized an extra time. Larger values are
+    serialized, compressed and wrapped in an object tagged with
+    COMPRESSED_KEY. For the msgpack serializer they are packed with
+    `msgpackbackend` and sent as bytes, otherwise they are serialized with
+    `jsonbackend` and sent as base64 text.
+
+    @arg compression one of COMPRESSIONS
+    @arg threshold smallest estimated serialized size compressed, in bytes
+    @arg binary whether the message serializer can carry bytes, unless
+        compress() is told otherwise
+
+    """
+
+    def __init__(self, compression: str, threshold: int = 16 * 1024,
+                 binary: bool = False) -> None:
+        if compression not in COMPRESSIONS:
+            raise ConfigurationError(
+                f"compression must be one of {', '.join(COMPRESSIONS)}")
+        self.compression = compression
+        self.compress_data = COMPRESSIONS[compression][0]
+        self.threshold = threshold
+        self.binary = binary
+        self.messages = 0
+        self.compressed = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self._lock = threading.Lock()
+
+    def compress(self, value: Any, binary: bool = None) -> Any:
+        """Return value, compressed if it is at least threshold bytes.
+
+        @arg binary whether the serializer of this message can carry bytes
+
+        """
+        binary = self.binary if binary is None else binary
+        size = _estimate_size(value, self.threshold)
+        if size < self.threshold:
+            self._count(size, size, False)
+            return value
+        if binary:
+            raw = msgpackbackend.dumps(value)
+        else:
+            raw = jsonbackend.dumps(value)
+        data = self.compress_data(raw)
+        self._count(len(raw), len(data), True)
+        if not binary:
+            data = base64.b64encode(data).decode('ascii')
+        return {COMPRESSED_KEY: self.compression, 'data': data}
+
+    def _count(self, raw_size, size, compressed):
+        with self._lock:
+            self.messages += 1
+            self.compressed += compressed
+            self.raw_bytes += raw_size
+            self.compressed_bytes += size
+
+    def stats(self) -> StrDict:
+        """Return counts of values seen and compressed, and their total
+        serialized sizes before and after compression, estimated for the
+        values left uncompressed."""
+        return {
+            'messages': self.messages,
+            'compressed': self.compressed,
+            'raw_bytes': self.raw_bytes,
+            'compressed_bytes': self.compressed_bytes,
+        }
+
+
+def decompress(value: Any) -> Any:
+    """Return value, unwrapped if PayloadCompressor compressed it."""
+    if not (isinstance(value, dict) and len(value) == 2 and
+            COMPRESSED_KEY in value and 'data' in value):
+        return value
+    decompress_data = COMPRESSIONS[value[COMPRESSED_KEY]][1]
+    data = value['data']
+    if isinstance(data, str):
+        return jsonbackend.loads(decompress_data(base64.b64decode(data)))
+    return msgpackbackend.loads(decompress_data(data))
+
+
+class BlobStore:
+    """Stores the large payload fields that services offload from task
+    messages, so that messages only carry a reference to them."""
+
+    def put(self, data: bytes) -> str:
+        """Store data and return its key."""
+        raise NotImplementedError()
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError()
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError()
+
+
+class FileBlobStore(BlobStore):
+    """Stores blobs as files named by the SHA-256 of their content.
+
+    Files are written atomically, and put() refreshes the modification
+    time of existing ones, which prune() goes by. The directory must
+    be shared by publishers and workers, and defaults to one in the system
+    temporary directory, which only suits a single host.
+
+    Blobs are shared by every message with the same content, so they are
+    not deleted once a task has read them. Instead put() prunes the blobs
+    not stored for max_age seconds, at most once every max_age / 24
+    seconds. Messages waiting longer than max_age in a queue can't read
+    their blobs.
+
+    @arg directory where blobs are stored
+    @arg max_age seconds blobs are kept after they were last stored, or
+        None to only delete them by calling prune()
+
+    """
+    KEY_PATTERN = re.compile('[0-9a-f]{64}')
+
+    def __init__(self, directory: str = None,
+                 max_age: float = 24 * 3600) -> None:
+        if directory is None:
+            directory = path.join(tempfile.gettempdir(), 'celerystar-blobs')
+        self.directory = directory
+        self.max_age = max_age
+        self._next_prune = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        if not self.KEY_PATTERN.fullmatch(key):
+            raise ValueError(f"invalid blob key {key!r}")
+        return path.join(self.directory, key[:2], key)
+
+    def put(self, data: bytes) -> str:
+        if self.max_age is not None and time.time() >= self._next_prune:
+            self._next_prune = time.time() + self.max_age / 24
+            self.prune(self.max_age)
+        key = hashlib.sha256(data).hexdigest()
+        blob_path = self._path(key)
+        try:
+            # Touch existing blobs, so that prune() keeps the ones that new
+            # messages still refer to.
+            os.utime(blob_path)
+            return key
+        except FileNotFoundError:
+            pass
+        os.makedirs(path.dirname(blob_path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.dirname(blob_path))
+        try:
+            with os.fdopen(fd, 'wb') as blob_file:
+                blob_file.write(data)
+            os.replace(temp_path, blob_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return key
+
+    def get(self, key: str) -> bytes:
+        with open(self._path(key), 'rb') as blob_file:
+            return blob_file.read()
+
+    def delete(self, key: str) -> None:
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def prune(self, max_age: float) -> int:
+        """Delete blobs stored more than max_age seconds ago, and return
+        how many were deleted."""
+        deadline = time.time() - max_age
+        deleted = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                blob_path = path.join(dirpath, filename)
+                try:
+                    if os.stat(blob_path).st_mtime < deadline:
+                        os.unlink(blob_path)
+                        deleted += 1
+                except FileNotFoundError:
+                    pass
+        return deleted
+
+
+def _is_blob_ref(value: Any) -> bool:
+    return (isinstance(value, dict) and isinstance(value.get(BLOB_KEY), str)
+            and value.keys() <= {BLOB_KEY, 'encoding'}
+            and value.get('encoding') in (None, 'utf-8'))
+
+
+@lru_cache(maxsize=None)
+def _offloadable_fields(data_cls: Type) -> frozenset:
+    """Return the names of the fields of data_cls that can be offloaded:
+    those taking any string, or any value, which includes bytes."""
+    return frozenset(
+        name for name, validator in data_cls.validator.properties.items()
+        if type(validator) in (String, Any))
+
+
+class _Blob:
+    """An offloaded field value, read from its store on first access."""
+    __slots__ = ('store', 'key', 'encoding')
+
+    def __init__(self, store: BlobStore, ref: StrDict) -> None:
+        self.store = store
+        self.key = ref[BLOB_KEY]
+        self.encoding = ref.get('encoding')
+
+    def load(self) -> Any:
+        data = self.store.get(self.key)
+        return data.decode(self.encoding) if self.encoding else data
+
+
+@lru_cache(maxsize=None)
+def _lazy_type(data_cls: Type) -> Type:
+    class LazyState(data_cls):
+        """A data_cls instance whose offloaded fields are only read from
+        the blob store, and validated, when accessed."""
+
+        def __init__(self, value: StrDict, store: BlobStore,
+                     offloaded: frozenset) -> None:
+            if not offloaded <= _offloadable_fields(data_cls):
+                raise ValidationError(
+                    f"cannot offload {', '.join(sorted(offloaded))}")
+            refs = {}
+            for name in offloaded:
+                if not _is_blob_ref(value.get(name)):
+                    raise ValidationError(f"{name!r} is not a blob reference")
+                refs[name] = _Blob(store, value[name])
+            validator = self._partial_validator(frozenset(refs))
+            state = validator.validate({
+                name: item for name, item in value.items() if name not in refs
+            })
+            state.update(refs)
+            object.__setattr__(self, '_dict', state)
+
+        @classmethod
+        @lru_cache(maxsize=None)
+        def _partial_validator(cls, offloaded: frozenset) -> Object:
+            properties = data_cls.validator.properties
+            return Object(
+                properties={name: validator for name, validator in properties.items()
+                            if name not in offloaded},
+                required=[name for name in data_cls.validator.required
+                          if name not in offloaded],
+                additional_properties=None,
+            )
+
+        def _load(self, key: str) -> None:
+            value = self._dict.get(key)
+            if isinstance(value, _Blob):
+                validator = self.validator.properties[key]
+                self._dict[key] = validator.validate(value.load())
+
+        def __getitem__(self, key):
+            self._load(key)
+            return super().__getitem__(key)
+
+        def __getattr__(self, key):
+            self._load(key)
+            return super().__getattr__(key)
+
+    LazyState.validator = data_cls.validator
+    LazyState.__name__ = LazyState.__qualname__ = data_cls.__name__
+    return LazyState
+
+
+def _load_state(data_cls: Type, value: Any, store: BlobStore = None,
+                offloaded: frozenset = frozenset()) -> Type:
+    """Return value as a data_cls instance, with the offloaded fields
+    loaded lazily from store."""
+    if isinstance(value, data_cls):
+        return value
+    if store is None or not offloaded:
+        return data_cls(value)
+    return _lazy_type(data_cls)(value, store, offloaded)
+
+
+class ResultCache:
+    """Memoizes service results by key.
+
+    Entries are fresh for `ttl` seconds, then stale for `stale_ttl` more
+    seconds, during which they are still returned while the service
+    recomputes them in the background.
+
+    @arg maxsize number of entries kept, evicting the least recently used
+    @arg ttl seconds entries are fresh for, or None to keep them forever
+    @arg stale_ttl seconds stale entries are still returned for
+
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None,
+                 stale_ttl: float = 0) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def lookup(self, key: str) -> Optional[Tuple[Any, bool]]:
+        """Return the (value, stale) cached for key, or None."""
+        entry = self._get(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.time() - stored_at
+            if self.ttl is None or age < self.ttl:
+                self._count('hits')
+                return value, False
+            if age < self.ttl + self.stale_ttl:
+                self._count('stale_hits')
+                return value, True
+        self._count('misses')
+        return None
+
+    def _count(self, counter: str) -> None:
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def store(self, key: str, value: Any) -> None:
+        self._set(key, value, time.time())
+
+    def stats(self) -> StrDict:
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+        }
+
+    def _get(self, key: str) -> Optional[Tuple[Any, float]]:
+        raise NotImplementedError()
+
+    def _set(self, key: str, value: Any, stored_at: float) -> None:
+        raise NotImplementedError()
+
+
+class MemoryResultCache(ResultCache):
+    """Caches results in the memory of the current process. Cached values
+    are returned as they are, so they must not be mutated."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None,
+                 stale_ttl: float = 0) -> None:
+        super().__init__(maxsize, ttl, stale_ttl)
+        self.entries = LRUCache(maxsize)
+
+    def _get(self, key):
+        return self.entries.get(key)
+
+    def _set(self, key, value, stored_at):
+        self.entries.set(key, (value, stored_at))
+
+
+class SQLiteMixin:
+    """Opens `self.filename` as a SQLite database shared between processes."""
+
+    def _connect(self) -> sqlite3.Connection:
+        # One connection per thread, opened again in forked children.
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = sqlite3.connect(
+                self.filename, timeout=30, isolation_level=None)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.connection
+
+
+class SQLiteResultCache(SQLiteMixin, ResultCache):
+    """Caches results in a SQLite database, shared by every process on the
+    host that opens the same file, such as prefork workers and gateways.
+    Values are serialized with `jsonbackend`.
+
+    @arg filename path of the database
+
+    """
+
+    def __init__(self, filename: str, maxsize: int = 1024,
+                 ttl: float = None, stale_ttl: float = 0) -> None:
+        super().__init__(maxsize, ttl, stale_ttl)
+        self.filename = filename
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY,'
+            ' value BLOB NOT NULL, stored_at REAL NOT NULL,'
+            ' used_at REAL NOT NULL)')
+        self._connect().execute(
+            'CREATE INDEX IF NOT EXISTS results_used_at ON results (used_at)')
+
+    def _get(self, key):
+        connection = self._connect()
+        row = connection.execute(
+            'SELECT value, stored_at FROM results WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        connection.execute(
+            'UPDATE results SET used_at = ? WHERE key = ?', (time.time(), key))
+        return jsonbackend.loads(row[0]), row[1]
+
+    def _set(self, key, value, stored_at):
+        connection = self._connect()
+        connection.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+            (key, jsonbackend.dumps(value), stored_at, stored_at))
+        connection.execute(
+            'DELETE FROM results WHERE key IN (SELECT key FROM results'
+            ' ORDER BY used_at DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Lets concurrent identical calls in a process share one task: the
+    first caller publishes it, and the others wait for its result."""
+
+    def __init__(self) -> None:
+        self.led = 0
+        self.joined = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: str, publish: Callable[[str], Any],
+            attach: Callable[[str], Any], wait: Callable[[Any], Any]) -> Any:
+        """Return the result of the task in flight for key.
+
+        @arg publish sends the task with the given id and returns its
+            AsyncResult
+        @arg attach returns the AsyncResult of a task id
+        @arg wait returns the result of an AsyncResult
+
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.led += 1
+            else:
+                self.joined += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._lead(key, publish, attach, wait)
+            return flight.result
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _lead(self, key, publish, attach, wait):
+        return wait(publish(str(uuid.uuid4())))
+
+    def stats(self) -> StrDict:
+        return {'led': self.led, 'joined': self.joined}
+
+
+class SQLiteSingleFlight(SQLiteMixin, SingleFlight):
+    """Also shares tasks between processes on the host, by recording the
+    id of each task in flight in a SQLite database. Processes joining a
+    task read its result from the result backend, so the backend must
+    let any client read a result, unlike the `rpc` one.
+
+    @arg filename path of the database
+    @arg ttl seconds after which a task in flight is no longer joined,
+        in case its publisher died
+
+    """
+
+    def __init__(self, filename: str, ttl: float = 300) -> None:
+        super().__init__()
+        self.filename = filename
+        self.ttl = ttl
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS flights (key TEXT PRIMARY KEY,'
+            ' task_id TEXT NOT NULL, started_at REAL NOT NULL)')
+
+    def _lead(self, key, publish, attach, wait):
+        connection = self._connect()
+        now = time.time()
+        task_id = str(uuid.uuid4())
+        # Record the task id before publishing, so that the write lock is
+        # not held during the broker round-trip.
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT task_id FROM flights WHERE key = ? AND started_at > ?',
+                (key, now - self.ttl)).fetchone()
+            if row is None:
+                connection.execute(
+                    'INSERT OR REPLACE INTO flights VALUES (?, ?, ?)',
+                    (key, task_id, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        if row is not None:
+            with self._lock:
+                self.led -= 1
+                self.joined += 1
+            return wait(attach(row[0]))
+        try:
+            return wait(publish(task_id))
+        finally:
+            connection.execute(
+                'DELETE FROM flights WHERE key = ? AND task_id = ?',
+                (key, task_id))
+
+
+class DedupeStore:
+    """Remembers the task published for each idempotency key during a
+    window, so that duplicates are not published again."""
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def claim(self, key: str, task_id: str, window: float) -> Optional[str]:
+        """Record task_id for key, unless another task was recorded for it
+        less than window seconds ago, in which case return that task id."""
+        existing = self._claim(key, task_id, time.time(), window)
+        with self._stats_lock:
+            if existing is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return existing
+
+    def release(self, key: str, task_id: str) -> None:
+        """Forget key, if task_id is still recorded for it."""
+        raise NotImplementedError()
+
+    def stats(self) -> StrDict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _claim(self, key, task_id, now, window):
+        raise NotImplementedError()
+
+
+class MemoryDedupeStore(DedupeStore):
+    """Keeps idempotency keys in the memory of the current process.
+
+    @arg maxsize number of keys kept, evicting the least recently used
+
+    """
+
+    def __init__(self, maxsize: int = 100000) -> None:
+        super().__init__()
+        self.entries = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def _claim(self, key, task_id, now, window):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+            self.entries.set(key, (task_id, now + window))
+            return None
+
+    def release(self, key, task_id):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == task_id:
+                self.entries.pop(key)
+
+
+class SQLiteDedupeStore(SQLiteMixin, DedupeStore):
+    """Keeps idempotency keys in a SQLite database shared by every
+    process on the host that opens the same file.
+
+    @arg filename path of the database
+
+    """
+
+    def __init__(self, filename: str) -> None:
+        super().__init__()
+        self.filename = filename
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS idempotency_keys (key TEXT PRIMARY KEY,'
+            ' task_id TEXT NOT NULL, expires_at REAL NOT NULL)')
+        self._connect().execute(
+            'CREATE INDEX IF NOT EXISTS idempotency_keys_expires_at'
+            ' ON idempotency_keys (expires_at)')
+
+    def _claim(self, key, task_id, now, window):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT task_id FROM idempotency_keys'
+                ' WHERE key = ? AND expires_at > ?', (key, now)).fetchone()
+            if row is None:
+                connection.execute(
+                    'DELETE FROM idempotency_keys WHERE expires_at <= ?', (now,))
+                connection.execute(
+                    'INSERT OR REPLACE INTO idempotency_keys VALUES (?, ?, ?)',
+                    (key, task_id, now + window))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return row[0] if row is not None else None
+
+    def release(self, key, task_id):
+        self._connect().execute(
+            'DELETE FROM idempotency_keys WHERE key = ? AND task_id = ?',
+            (key, task_id))
+
+
+def _sort_keys(value: Any) -> Any:
+    """Return value with the keys of every mapping in sorted order."""
+    if isinstance(value, (dict, Type)):
+        return {key: _sort_keys(value[key]) for key in sorted(value)}
+    if isinstance(value, (list, tuple)):
+        return [_sort_keys(item) for item in value]
+    return value
+
+
+class PayloadMixin:
+    compact = False
+    compressor = None
+    blob_store = None
+    offload_threshold = 256 * 1024
+    cache = None
+    single_flight = None
+
+    def _make_payload(self, initial_state: StrDict, data: Type = None,
+                      serializer: str = None, offload: bool = True) -> Any:
+        """Validate initial_state and build the task message payload.
+
+        Compact services send the schema fingerprint followed by the field
+        values in schema order, instead of an object repeating field names.
+        Services with a blob store send references to large string and
+        bytes fields instead of their values, in an envelope listing the
+        offloaded fields under BLOBS_KEY.
+
+        @arg serializer the message is sent with, defaults to the app's
+        @arg offload whether to offload large fields to the blob store
+
+        """
+        if data is None:
+            data = self.data_cls(initial_state)
+        payload = data if self.compact else initial_state
+        offloaded = {}
+        if self.blob_store is not None and offload:
+            offloaded = self._offload(payload)
+            payload = {**payload, **offloaded}
+        if self.compact:
+            payload = [self.fingerprint, *(payload[name] for name in self.fields)]
+        if self.blob_store is not None:
+            payload = {BLOBS_KEY: sorted(offloaded), 'payload': payload}
+        if self.compressor is not None:
+            if serializer is None:
+                serializer = self.app.conf.task_serializer
+            payload = self.compressor.compress(
+                payload, serializer == MSGPACK_SERIALIZER)
+        return payload
+
+    def _offload(self, values: StrDict) -> StrDict:
+        """Store the large fields of values, and return references to them
+        by field name."""
+        offloaded = {}
+        for name in _offloadable_fields(self.data_cls):
+            value = values.get(name)
+            if isinstance(value, str) and len(value) * 4 >= self.offload_threshold:
+                data = value.encode('utf-8')
+                if len(data) >= self.offload_threshold:
+                    offloaded[name] = {BLOB_KEY: self.blob_store.put(data),
+                                       'encoding': 'utf-8'}
+            elif isinstance(value, bytes) and len(value) >= self.offload_threshold:
+                offloaded[name] = {BLOB_KEY: self.blob_store.put(value)}
+        return offloaded
+
+    def _read_payload(self, payload: Any) -> StrDict:
+        """Return the initial state sent in a task message payload.
+
+        @throws ValidationError if a compact payload has another schema
+
+        """
+        return self._read_message(payload)[0]
+
+    def _read_message(self, payload: Any) -> Tuple[StrDict, frozenset]:
+        """Return the initial state sent in a task message payload, and the
+        names of its fields offloaded to the blob store."""
+        payload = decompress(payload)
+        offloaded = frozenset()
+        if self.blob_store is not None:
+            if not (isinstance(payload, dict) and
+                    payload.keys() == {BLOBS_KEY, 'payload'}):
+                raise ValidationError("payload has no blob envelope")
+            names = payload[BLOBS_KEY]
+            if not (isinstance(names, list) and
+                    all(isinstance(name, str) for name in names)):
+                raise ValidationError("invalid list of offloaded fields")
+            offloaded = frozenset(names)
+            payload = payload['payload']
+        if not isinstance(payload, list):
+            return payload, offloaded
+        if not payload or payload[0] != self.fingerprint:
+            raise ValidationError(
+                f"payload schema fingerprint does not match {self.fingerprint}")
+        if len(payload) != len(self.fields) + 1:
+            raise ValidationError(
+                f"payload has {len(payload) - 1} fields, expected {len(self.fields)}")
+        return dict(zip(self.fields, payload[1:])), offloaded
+
+    def _cache_key(self, data: Type) -> str:
+        # MessagePack keeps bytes apart from strings, unlike JSON.
+        canonical = msgpackbackend.dumps(_sort_keys(data))
+        digest = hashlib.sha256(canonical).hexdigest()
+        return f'{self.name}:{self.fingerprint}:{digest}'
+
+    def _run_cached(self, data: Type, run: Callable[[], Any]) -> Any:
+        """Return the cached result for data, or call run() to get it."""
+        if self.cache is None:
+            return run()
+        key = self._cache_key(data)
+        entry = self.cache.lookup(key)
+        if entry is None:
+            result = run()
+            self.cache.store(key, result)
+            return result
+        result, stale = entry
+        if stale:
+            self._revalidate(key, run)
+        return result
+
+    def _revalidate(self, key: str, run: Callable[[], Any]) -> None:
+        with self._revalidate_lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def refresh():
+            try:
+                self.cache.store(key, run())
+            except Exception:
+                logger.exception('failed to revalidate %s', key)
+            finally:
+                with self._revalidate_lock:
+                    self._revalidating.discard(key)
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _make_result(self, result: Any) -> Any:
+        if self.compressor is not None:
+            return self.compressor.compress(
+                result, self.app.conf.result_serializer == MSGPACK_SERIALIZER)
+        return result
+
+    def _read_result(self, result: Any) -> Any:
+        return decompress(result)
+
+
+class BaseService(PayloadMixin):
     """Service base class.
 
     @arg app Celery app instance
     @arg injector apistar injector instance
     @arg task_impl object implementing task
     @arg celery_task_opts Celery Task options
+    @arg compact send initial states as positional arrays
+    @arg compression compress payloads and results with zlib, gzip or lzma
+    @arg compression_threshold smallest serialized size compressed
+    @arg blob_store BlobStore large fields are offloaded to
+    @arg offload_threshold smallest field size offloaded, in bytes
+    @arg cache ResultCache memoizing results by initial state
+    @arg single_flight SingleFlight sharing tasks between identical calls
+    @arg dedupe DedupeStore of idempotency keys for apply_remote()
+    @arg dedupe_window seconds a published idempotency key is remembered
+    @arg idempotency_field field holding the idempotency key, instead of
+        a hash of the whole initial state
 
     """
 
     def __init__(self, app: Celery, injector: Injector, task_impl,
-                 data_cls, celery_task_opts: StrDict) -> None:
+                 data_cls, celery_task_opts: StrDict,
+                 compact: bool = False, compression: str = None,
+                 compression_threshold: int = 16 * 1024,
+                 blob_store: BlobStore = None,
+                 offload_threshold: int = 256 * 1024,
+                 cache: ResultCache = None,
+                 single_flight: SingleFlight = None,
+                 dedupe: DedupeStore = None,
+                 dedupe_window: float = 600,
+                 idempotency_field: str = None) -> None:
         self.app = app
         self.injector = injector
         self.data_cls = data_cls
         self.get_impl = lambda *_: task_impl
+        self.compact = compact
+        self.fields = list(data_cls.validator.properties)
+        self.fingerprint = _schema_fingerprint(data_cls)
+        self.blob_store = blob_store
+        self.offload_threshold = offload_threshold
+        self.cache = cache
+        self.single_flight = single_flight
+        self.dedupe = dedupe
+        self.dedupe_window = dedupe_window
+        if idempotency_field is not None and idempotency_field not in self.fields:
+            raise ConfigurationError(
+                f"unknown idempotency field {idempotency_field!r}")
+        self.idempotency_field = idempotency_field
+        self._revalidating = set()
+        self._revalidate_lock = threading.Lock()
+        if compression is not None:
+            binary = app.conf.task_serializer == MSGPACK_SERIALIZER
+            self.compressor = PayloadCompressor(
+                compression, compression_threshold, binary)
 
         self.opts = self._make_task_options(task_impl, celery_task_opts)
         self.name = self.opts['name']
@@ -70,8 +938,8 @@ class BaseService:
 
     @staticmethod
     def _validate_apply_options(opts: StrDict):
-        if 'serializer' in opts and opts['serializer'] != 'json':
-            raise ConfigurationError("only json is supported")
+        if opts.get('serializer', 'json') not in SERIALIZERS:
+            raise ConfigurationError("only json and msgpack are supported")
 
     def apply_local(self, initial_state: StrDict, apply_opts: StrDict) -> None:
         """Run service locally calling apply().
@@ -82,28 +950,65 @@ class BaseService:
         @return result of the task
 
         """
-        self.data_cls(initial_state)
+        data = self.data_cls(initial_state)
         self._validate_apply_options(apply_opts)
-        result = self.task.apply([initial_state], {}, **apply_opts)
-        return result.get()
 
-    def apply_remote(self, initial_state: StrDict,
-                     apply_opts: StrDict) -> None:
+        def run():
+            # Runs in-process, so large fields need not go to the store.
+            payload = self._make_payload(initial_state, data,
+                                         apply_opts.get('serializer'),
+                                         offload=False)
+            result = self.task.apply([payload], {}, **apply_opts)
+            return self._read_result(result.get())
+        return self._run_cached(data, run)
+
+    def apply_remote(self, initial_state: StrDict, apply_opts: StrDict,
+                     idempotency_key: str = None) -> None:
         """Run service remotely calling apply_async().
 
+        With a dedupe store, a call repeating the idempotency key of one
+        made within the dedupe window is not published, and returns the
+        task id of the first one instead.
+
         @arg initial_state initial injection data
         @arg apply_opts kwargs provided to celery's apply_async()
+        @arg idempotency_key overrides the idempotency field or payload hash
         @throws ValidationError if initial_state is invalid
 
         """
-        self.data_cls(initial_state)
+        data = self.data_cls(initial_state)
         self._validate_apply_options(apply_opts)
-        result = self.task.apply_async([initial_state], {}, **apply_opts)
+        if self.dedupe is None:
+            payload = self._make_payload(initial_state, data,
+                                         apply_opts.get('serializer'))
+            result = self.task.apply_async([payload], {}, **apply_opts)
+            return result.id
+
+        key = self._idempotency_key(data, idempotency_key)
+        task_id = apply_opts.get('task_id') or str(uuid.uuid4())
+        existing = self.dedupe.claim(key, task_id, self.dedupe_window)
+        if existing is not None:
+            return existing
+        try:
+            payload = self._make_payload(initial_state, data,
+                                         apply_opts.get('serializer'))
+            result = self.task.apply_async(
+                [payload], {}, **{**apply_opts, 'task_id': task_id})
+        except BaseException:
+            self.dedupe.release(key, task_id)
+            raise
         return result.id
+
+    def _idempotency_key(self, data: Type, idempotency_key: str = None) -> str:
+        if idempotency_key is None and self.idempotency_field is not None:
+            idempotency_key = str(data[self.idempotency_field])
+        if idempotency_key is None:
+            return self._cache_key(data)
+        return f'{self.name}:{idempotency_key}'
 Service = BaseService
 
 
-class ResulterMixin:
+class ResulterMixin(PayloadMixin):
 
     def _validate_celery_app(self):
         if not self.app.conf.result_backend:
@@ -120,41 +1025,131 @@ class ResulterMixin:
         @return restult of the task
 
         """
-        self.data_cls(initial_state)
+        data = self.data_cls(initial_state)
         self._validate_apply_options(apply_opts)
         if result_opts.get('timeout', -1) <= 0:
             raise ConfigurationError("timeout>0 is required to get results")
-        result = self.task.apply_async([initial_state], {}, **apply_opts)
-        return result.get(**result_opts)
 
+        def publish(task_id=None):
+            payload = self._make_payload(initial_state, data,
+                                         apply_opts.get('serializer'))
+            opts = apply_opts if task_id is None else {**apply_opts, 'task_id': task_id}
+            return self.task.apply_async([payload], {}, **opts)
+
+        def wait(result):
+            return self._read_result(result.get(**result_opts))
+
+        def run():
+            if self.single_flight is None:
+                return wait(publish())
+            return self.single_flight.run(self._cache_key(data), publish,
+                                          self.task.AsyncResult, wait)
+        return self._run_cached(data, run)
+
+    def scatter(self, initial_state: StrDict, field: str, chunk_size: int,
+                reduce: BaseService = None, apply_opts: StrDict = None,
+                result_opts: StrDict = None,
+                reduce_field: str = 'results') -> Any:
+        """Run service remotely over chunks of a list field, in parallel.
+
+        initial_state is validated once, then one task is published for
+        each chunk of up to chunk_size items of field, with the other
+        fields unchanged. Their results are gathered in order and, with a
+        reduce service, passed to it as the reduce_field of its initial
+        state.
+
+        @arg field name of an Array field of data_cls
+        @arg reduce resulter service combining the results of the chunks
+        @throws ValidationError if initial_state, or the state of a chunk,
+            is invalid
+        @return result of reduce, or the list of results of the chunks
+
+        """
+        apply_opts = {} if apply_opts is None else apply_opts
+        result_opts = {} if result_opts is None else result_opts
+        if not isinstance(self.data_cls.validator.properties.get(field), Array):
+            raise ConfigurationError(f"{field!r} is not a list field")
+        if chunk_size < 1:
+            raise ConfigurationError("chunk_size>0 is required")
+        if reduce is not None:
+            if not isinstance(reduce, ResulterMixin):
+                raise ConfigurationError(f"{reduce.name} does not handle results")
+            validator = reduce.data_cls.validator
+            if reduce_field not in validator.properties or \
+                    set(validator.required) - {reduce_field}:
+                raise ConfigurationError(
+                    f"{reduce.name} must take {reduce_field!r} "
+                    "as its only required field")
+        data = self.data_cls(initial_state)
+        self._validate_apply_options(apply_opts)
+        if result_opts.get('timeout', -1) <= 0:
+            raise ConfigurationError("timeout>0 is required to get results")
 
-class BaseTaskBuilderMixin:
+        state = dict(data)
+        items = state[field]
+        chunks = [items[start:start + chunk_size]
+                  for start in range(0, len(items), chunk_size)]
+        payloads = []
+        for chunk in chunks or [[]]:
+            chunk_state = {**state, field: chunk}
+            # Chunks can break min_items, max_items or unique_items where
+            # the whole list does not, so check them before publishing any.
+            payloads.append(self._make_payload(
+                chunk_state, self.data_cls(chunk_state),
+                apply_opts.get('serializer')))
+        group_result = group(
+            self.task.s(payload) for payload in payloads
+        ).apply_async(**apply_opts)
+        results = [self._read_result(result)
+                   for result in group_result.get(**result_opts)]
+        if reduce is None:
+            return results
+        return reduce.apply_remote({reduce_field: results}, apply_opts,
+                                   result_opts)
+
+
+class BaseTaskBuilderMixin(PayloadMixin):
 
     def _make_initial_state(self, data):
+        state, offloaded = self._read_message(data)
+        if self.blob_store is not None:
+            state = _load_state(self.data_cls, state, self.blob_store,
+                                offloaded)
         return {
-            '_hack_': data,
+            '_hack_': state,
             'service': self,
         }
 
 
 class FunctionTaskBuilderMixin(BaseTaskBuilderMixin):
 
+    def _run_initial_state(self, initial_state: StrDict) -> Any:
+        return self.injector.run([self.get_impl()], initial_state)
+
+    def _output_type(self) -> Any:
+        return inspect.signature(self.get_impl()).return_annotation
+
     def _build_task(self) -> CeleryTask:
         @self.task_decorator
         def task(data):
-            return self.injector.run([self.get_impl()],
-                                     self._make_initial_state(data))
+            return self._make_result(
+                self._run_initial_state(self._make_initial_state(data)))
         return task
 
 
 class ClassTaskBuilderMixin(BaseTaskBuilderMixin):
 
+    def _run_initial_state(self, initial_state: StrDict) -> Any:
+        return self.injector.run([self.get_impl()], initial_state).run()
+
+    def _output_type(self) -> Any:
+        return inspect.signature(self.get_impl().run).return_annotation
+
     def _build_task(self) -> CeleryTask:
         @self.task_decorator
         def task(data):
-            obj = self.injector.run([self.get_impl()],
-                                     self._make_initial_state(data))
-            return obj.run()
+            return self._make_result(
+                self._run_initial_state(self._make_initial_state(data)))
         return task
 
 
@@ -167,6 +1162,271 @@ class CallableTaskBuilderMixin(FunctionTaskBuilderMixin):
         return super()._make_task_options(impl, opts)
 
 
+class _Batcher:
+    """Collects the items submitted by concurrent tasks of a worker
+    process into batches of up to `size` items, waiting at most `timeout`
+    seconds after the first one for more, and runs each batch in a thread.
+
+    Items already queued join the batch even when `timeout` is 0.
+
+    """
+
+    def __init__(self, run_batch: Callable[[list], None], size: int,
+                 timeout: float) -> None:
+        self.run_batch = run_batch
+        self.size = size
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, data: Any) -> Any:
+        """Add data to the next batch and return its result."""
+        flight = _Flight()
+        self.queue.put((data, flight))
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.timeout
+            while len(batch) < self.size:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self.queue.get(timeout=remaining))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.run_batch(batch)
+            except BaseException as exc:
+                for _, flight in batch:
+                    if flight.error is None:
+                        flight.error = exc
+            for _, flight in batch:
+                flight.done.set()
+
+
+class BatchTaskBuilderMixin(BaseTaskBuilderMixin):
+    """Runs a function impl once per batch of task messages.
+
+    Parameters annotated `List[T]` receive one `T` per item, resolved
+    item by item from its initial state. The other parameters are resolved
+    once per batch, from the initial state of its first item. The impl may
+    return a list with one result per item, where an exception instance
+    fails that item only.
+
+    Tasks block until their batch has run, so batches only grow beyond one
+    item when the worker runs tasks concurrently, e.g. with `-P threads`
+    and a concurrency of at least `batch_size`.
+
+    """
+
+    def __init__(self, *args, batch_size: int = 100,
+                 batch_timeout: float = 0, **kwargs) -> None:
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self._batcher = None
+        self._batcher_pid = None
+        self._batcher_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _validate(self):
+        self._validate_celery_app()
+        self._make_resolvers(self.get_impl())
+        self.injector.resolve_functions([self._resolve_item])
+        self.injector.resolve_functions([self._resolve_batch])
+
+    def _make_resolvers(self, impl: Callable) -> None:
+        item_params, batch_params = [], []
+        self._list_names = []
+        for parameter in inspect.signature(impl).parameters.values():
+            annotation = parameter.annotation
+            if getattr(annotation, '__origin__', None) is list:
+                self._list_names.append(parameter.name)
+                item_params.append(parameter.replace(
+                    annotation=annotation.__args__[0]))
+            else:
+                batch_params.append(parameter)
+        if not self._list_names:
+            raise ConfigurationError(
+                f"{impl.__name__} must take a List[...] parameter")
+
+        def resolve_item(**kwargs):
+            return kwargs
+
+        def resolve_batch(**kwargs):
+            return kwargs
+
+        resolve_item.__signature__ = inspect.Signature(item_params)
+        resolve_batch.__signature__ = inspect.Signature(batch_params)
+        self._resolve_item = resolve_item
+        self._resolve_batch = resolve_batch
+
+    def _get_batcher(self) -> _Batcher:
+        # Batches are collected per worker process.
+        with self._batcher_lock:
+            if self._batcher_pid != os.getpid():
+                self._batcher = _Batcher(
+                    self._run_batch, self.batch_size, self.batch_timeout)
+                self._batcher_pid = os.getpid()
+            return self._batcher
+
+    def _run_batch(self, batch: list) -> None:
+        flights, items, first_state = [], [], None
+        for data, flight in batch:
+            try:
+                state = self._make_initial_state(data)
+                # Validate each message here, so that an invalid one fails
+                # alone instead of failing the impl for the whole batch.
+                if not isinstance(state['_hack_'], self.data_cls):
+                    state['_hack_'] = self.data_cls(state['_hack_'])
+                items.append(self.injector.run([self._resolve_item], state))
+            except Exception as exc:
+                flight.error = exc
+                continue
+            flights.append(flight)
+            if first_state is None:
+                first_state = state
+        if not flights:
+            return
+
+        kwargs = self.injector.run([self._resolve_batch], first_state)
+        for name in self._list_names:
+            kwargs[name] = [item[name] for item in items]
+        results = self.get_impl()(**kwargs)
+        if results is None:
+            results = [None] * len(flights)
+        elif not isinstance(results, list) or len(results) != len(flights):
+            raise ValueError(
+                f"batch impl must return a list of {len(flights)} results")
+        for flight, result in zip(flights, results):
+            if isinstance(result, Exception):
+                flight.error = result
+            else:
+                flight.result = result
+
+    def _build_task(self) -> CeleryTask:
+        @self.task_decorator
+        def task(data):
+            return self._make_result(self._get_batcher().submit(data))
+        return task
+
+
+# Validator attributes that do not change what a validator accepts.
+_DESCRIPTIVE_ATTRIBUTES = {'title', 'description', '_creation_counter'}
+
+
+def _same_validator(first: Any, second: Any) -> bool:
+    """Return whether two validators, or values of their attributes,
+    accept exactly the same values."""
+    if isinstance(first, type) and issubclass(first, Type):
+        first = first.validator
+    if isinstance(second, type) and issubclass(second, Type):
+        second = second.validator
+    if isinstance(first, Validator) or isinstance(second, Validator):
+        if type(first) is not type(second):
+            return False
+        first_attrs, second_attrs = [
+            {name: value for name, value in vars(validator).items()
+             if name not in _DESCRIPTIVE_ATTRIBUTES}
+            for validator in (first, second)
+        ]
+        return _same_validator(first_attrs, second_attrs)
+    if isinstance(first, dict) and isinstance(second, dict):
+        return first.keys() == second.keys() and all(
+            _same_validator(value, second[name])
+            for name, value in first.items())
+    if isinstance(first, (list, tuple)) and isinstance(second, (list, tuple)):
+        return len(first) == len(second) and all(
+            _same_validator(*pair) for pair in zip(first, second))
+    return type(first) is type(second) and first == second
+
+
+def _make_adapter(output_type: Any, data_cls: Type) -> Callable:
+    """Return a function turning the output of a stage into the initial
+    state of the next one, which takes data_cls.
+
+    Outputs of stages annotated to return a Type are checked against
+    data_cls once, here. When every field they share has the same
+    validator in both, outputs are then passed on without validation.
+    Other outputs are validated by data_cls on every run.
+
+    """
+    if not (isinstance(output_type, type) and issubclass(output_type, Type)):
+        return data_cls
+
+    outputs = output_type.validator.properties
+    fields, defaults, same = [], {}, True
+    for name, validator in data_cls.validator.properties.items():
+        if name in outputs:
+            if type(outputs[name]) is not type(validator):
+                raise ConfigurationError(
+                    f"{output_type.__name__}.{name} is a "
+                    f"{type(outputs[name]).__name__}, "
+                    f"{data_cls.__name__}.{name} a {type(validator).__name__}")
+            fields.append(name)
+            same = same and _same_validator(outputs[name], validator)
+        elif validator.has_default():
+            defaults[name] = validator.default
+        else:
+            raise ConfigurationError(
+                f"{output_type.__name__} has no {name!r} for {data_cls.__name__}")
+    if output_type is data_cls:
+        return lambda value: value
+    if not same:
+        return lambda value: data_cls({name: value[name] for name in fields})
+    return lambda value: {**defaults, **{name: value[name] for name in fields}}
+
+
+class PipelineTaskBuilderMixin(BaseTaskBuilderMixin):
+    """Runs the services of a pipeline one after the other in one task.
+
+    The initial state is the initial state of the first stage, and the
+    output of each stage the initial state of the next one. Stages run
+    in-process through their own injectors, so outputs are passed on as
+    Python objects instead of being serialized and published.
+
+    """
+
+    def __init__(self, *args, stages: List[BaseService], **kwargs) -> None:
+        self.stages = stages
+        super().__init__(*args, **kwargs)
+
+    def _make_task_options(self, impl, opts: StrDict):
+        if 'name' not in opts:
+            opts['name'] = '|'.join(stage.name for stage in self.stages)
+        return super()._make_task_options(impl, opts)
+
+    def _validate(self):
+        self._validate_celery_app()
+        for stage in self.stages:
+            if not isinstance(stage, (FunctionTaskBuilderMixin,
+                                      ClassTaskBuilderMixin)):
+                raise ConfigurationError(f"{stage} cannot run in a pipeline")
+        self._adapters = [lambda value: value] + [
+            _make_adapter(stage._output_type(), next_stage.data_cls)
+            for stage, next_stage in zip(self.stages, self.stages[1:])
+        ]
+
+    def _build_task(self) -> CeleryTask:
+        @self.task_decorator
+        def task(data):
+            value = self._make_initial_state(data)['_hack_']
+            for stage, adapt in zip(self.stages, self._adapters):
+                value = stage._run_initial_state({
+                    '_hack_': adapt(value),
+                    'service': stage,
+                })
+            return self._make_result(value)
+        return task
+
+
 class FunctionService(FunctionTaskBuilderMixin, BaseService):
     """Function based Service."""
 
@@ -194,14 +1454,38 @@ class CallableResulterService(CallableTaskBuilderMixin, ResulterMixin,
     """Callable object based Service that handles results."""
 
 
-def _make_injector(components: List[Component],
-                    data_cls: Type) -> Injector:
+class BatchService(BatchTaskBuilderMixin, BaseService):
+    """Function based Service that runs task messages in batches."""
+
+
+class BatchResulterService(BatchTaskBuilderMixin, ResulterMixin, BaseService):
+    """Function based Service that runs task messages in batches and
+    handles results."""
+
+
+class PipelineService(PipelineTaskBuilderMixin, BaseService):
+    """Service running a pipeline of services in one task."""
+
+
+class PipelineResulterService(PipelineTaskBuilderMixin, ResulterMixin,
+                              BaseService):
+    """Service running a pipeline of services in one task and handling
+    results."""
+
+
+def _schema_fingerprint(data_cls: Type) -> str:
+    fields = [(name, type(validator).__name__)
+              for name, validator in data_cls.validator.properties.items()]
+    return hashlib.sha1(repr(fields).encode('utf-8')).hexdigest()[:12]
+
+
+def _make_injector(components: List[Component], data_cls: Type) -> Injector:
     class InitialState(Type):
         _hack_ = data_cls
 
     class InitialComponent(Component):
         def resolve(self, state: InitialState) -> data_cls:
-            return data_cls(state['_hack_'])
+            return _load_state(data_cls, state['_hack_'])
     return Injector(
         [InitialComponent(), *components],
         {
@@ -212,7 +1496,13 @@ def _make_injector(components: List[Component],
 
 
 def make_resulter_service(impl: Callable, components: List[Component],
-                          data_cls, app: Celery,
+                          data_cls, app: Celery, compact: bool = False,
+                          compression: str = None,
+                          compression_threshold: int = 16 * 1024,
+                          blob_store: BlobStore = None,
+                          offload_threshold: int = 256 * 1024,
+                          cache: ResultCache = None,
+                          single_flight: SingleFlight = None,
                           **celery_opts: StrDict) -> BaseService:
     if isinstance(impl, FunctionType):
         service_cls = FunctionResulterService
@@ -223,12 +1513,24 @@ def make_resulter_service(impl: Callable, components: List[Component],
     else:
         raise ConfigurationError(f"{impl} could not be handled")
     injector = _make_injector(components, data_cls)
-    return service_cls(app, injector, impl, data_cls,
-                       celery_opts)
+    return service_cls(app, injector, impl, data_cls, celery_opts,
+                       compact=compact, compression=compression,
+                       compression_threshold=compression_threshold,
+                       blob_store=blob_store,
+                       offload_threshold=offload_threshold, cache=cache,
+                       single_flight=single_flight)
 
 
 def make_service(impl: Callable, components: List[Component],
-                 data_cls, app: Celery,
+                 data_cls, app: Celery, compact: bool = False,
+                 compression: str = None,
+                 compression_threshold: int = 16 * 1024,
+                 blob_store: BlobStore = None,
+                 offload_threshold: int = 256 * 1024,
+                 cache: ResultCache = None,
+                 dedupe: DedupeStore = None,
+                 dedupe_window: float = 600,
+                 idempotency_field: str = None,
                  **celery_opts: StrDict) -> BaseService:
     if isinstance(impl, FunctionType):
         service_cls = FunctionService
@@ -239,39 +1541,161 @@ def make_service(impl: Callable, components: List[Component],
     else:
         raise ConfigurationError(f"{impl} could not be handled")
     injector = _make_injector(components, data_cls)
-    return service_cls(app, injector, impl, data_cls,
-                       celery_opts)
+    return service_cls(app, injector, impl, data_cls, celery_opts,
+                       compact=compact, compression=compression,
+                       compression_threshold=compression_threshold,
+                       blob_store=blob_store,
+                       offload_threshold=offload_threshold, cache=cache,
+                       dedupe=dedupe, dedupe_window=dedupe_window,
+                       idempotency_field=idempotency_field)
+
+
+def make_batch_service(impl: Callable, components: List[Component],
+                       data_cls, app: Celery, batch_size: int = 100,
+                       batch_timeout: float = 0, resulter: bool = False,
+                       compact: bool = False, compression: str = None,
+                       compression_threshold: int = 16 * 1024,
+                       blob_store: BlobStore = None,
+                       offload_threshold: int = 256 * 1024,
+                       cache: ResultCache = None,
+                       **celery_opts: StrDict) -> BaseService:
+    """Make a service whose impl takes a List[data_cls] batch.
+
+    Each task blocks until its batch has run, so batches only form when the
+    worker runs tasks concurrently, e.g. with `-P threads` and a concurrency
+    of at least batch_size. A batch takes the messages already waiting,
+    and with batch_timeout also those arriving that long after its first
+    one. Under the default prefork pool each process runs one task at a
+    time, so keep batch_timeout at 0 there: it would delay every task.
+
+    @arg batch_size most task messages run in one batch
+    @arg batch_timeout seconds a batch waits for more messages
+    @arg resulter whether the service handles results
+
+    """
+    if not isinstance(impl, FunctionType):
+        raise ConfigurationError(f"{impl} could not be handled")
+    service_cls = BatchResulterService if resulter else BatchService
+    injector = _make_injector(components, data_cls)
+    return service_cls(app, injector, impl, data_cls, celery_opts,
+                       batch_size=batch_size, batch_timeout=batch_timeout,
+                       compact=compact, compression=compression,
+                       compression_threshold=compression_threshold,
+                       blob_store=blob_store,
+                       offload_threshold=offload_threshold, cache=cache)
+
+
+def make_pipeline(stages: List[BaseService], app: Celery = None,
+                  compact: bool = False, compression: str = None,
+                  compression_threshold: int = 16 * 1024,
+                  blob_store: BlobStore = None,
+                  offload_threshold: int = 256 * 1024,
+                  cache: ResultCache = None,
+                  **celery_opts: StrDict) -> BaseService:
+    """Make a service running stages in one task, each one taking the
+    output of the previous one as initial state.
+
+    The pipeline takes the data_cls of the first stage, and handles
+    results when the last stage does.
+
+    @arg stages function, class or callable object based services
+    @arg app Celery app, defaults to the app of the last stage
+    @throws ConfigurationError if adjacent stages are incompatible
+
+    """
+    if not stages:
+        raise ConfigurationError("a pipeline needs at least one stage")
+    first, last = stages[0], stages[-1]
+    if isinstance(last, ResulterMixin):
+        service_cls = PipelineResulterService
+    else:
+        service_cls = PipelineService
+    return service_cls(app or last.app, first.injector, None,
+                       first.data_cls, celery_opts, stages=list(stages),
+                       compact=compact, compression=compression,
+                       compression_threshold=compression_threshold,
+                       blob_store=blob_store,
+                       offload_threshold=offload_threshold, cache=cache)
+
+
+def _register_serializers():
+    # Looked up on each call, so that a later `jsonbackend.set_backend()`
+    # applies to Celery messages too.
+    register_serializer(
+        JSON_SERIALIZER,
+        lambda obj: jsonbackend.dumps(obj),
+        lambda data: jsonbackend.loads(data),
+        content_type=JSON_CONTENT_TYPE,
+        content_encoding='utf-8',
+    )
+    register_serializer(
+        MSGPACK_SERIALIZER,
+        msgpackbackend.dumps,
+        msgpackbackend.loads,
+        content_type=MSGPACK_CONTENT_TYPE,
+        content_encoding='binary',
+    )
+
+
+def make_celery_app(name: str, serializer: str = JSON_SERIALIZER,
+                    **opts: StrDict) -> Celery:
+    """Make a Celery app that serializes tasks and results with `serializer`.
+
+    @arg serializer JSON_SERIALIZER or MSGPACK_SERIALIZER
 
+    Messages in any of the supported formats, and plain `json`, are
+    accepted whichever serializer is chosen.
 
-def make_celery_app(name: str, **opts: StrDict) -> Celery:
+    """
+    if serializer not in (JSON_SERIALIZER, MSGPACK_SERIALIZER):
+        raise ConfigurationError(f"unknown serializer {serializer!r}")
+    _register_serializers()
     return Celery(
         **opts,
         main=name,
-        task_serializer='json',
-        accept_content=['json'],
-        result_serializer='json',
+        task_serializer=serializer,
+        accept_content=list(SERIALIZERS),
+        result_serializer=serializer,
     )
 
 
 def _make_view(service: BaseService, post_data_cls: Type) -> Callable:
-    def view(post_data: post_data_cls):
+    def view(post_data: post_data_cls, app: App, headers: http.Headers):
         if post_data['remote']:
             if isinstance(service, ResulterMixin):
                 response = service.apply_remote(post_data['data'],
                                                 post_data['apply_opts'],
                                                 post_data['result_opts'])
             else:
-                response = service.apply_remote(post_data['data'],
-                                                post_data['apply_opts'])
+                response = service.apply_remote(
+                    post_data['data'], post_data['apply_opts'],
+                    headers.get('Idempotency-Key'))
         else:
             response = service.apply_local(post_data['data'],
                                            post_data['apply_opts'])
-        return JSONResponse(response)
+        return app.encode_response(response, headers.get('Accept'))
+    return view
+
+
+def _make_scatter_view(service: ResulterMixin, post_data_cls: Type,
+                       reducers: Dict[str, BaseService]) -> Callable:
+    def view(post_data: post_data_cls, app: App, headers: http.Headers):
+        reduce = reducers.get(post_data['reduce'])
+        response = service.scatter(post_data['data'], post_data['field'],
+                                   post_data['chunk_size'], reduce,
+                                   post_data['apply_opts'],
+                                   post_data['result_opts'],
+                                   post_data['reduce_field'])
+        return app.encode_response(response, headers.get('Accept'))
     return view
 
 
-def make_wsgi_app(services: List[BaseService]):
+def make_wsgi_app(services: List[BaseService], max_body_size: int = None,
+                  compress: bool = True, shard_schema: bool = False,
+                  router_class: type = None):
     routes = []
+    reducers = {srv.name: srv for srv in services
+                if isinstance(srv, ResulterMixin)}
     for srv in services:
         post_data_cls = type(f'{srv.name}_PostData', (Type,), {
             'apply_opts': Object(),
@@ -286,6 +1710,25 @@ def make_wsgi_app(services: List[BaseService]):
         routes.append(Route(f'/{srv.app.main}/{srv.name}', 'POST',
                             handler=_make_view(srv, post_data_cls),
                             name=f'{srv.app.main}/{srv.name}'))
+        list_fields = [
+            name for name, validator in srv.data_cls.validator.properties.items()
+            if isinstance(validator, Array)
+        ]
+        if isinstance(srv, ResulterMixin) and list_fields:
+            scatter_data_cls = type(f'{srv.name}_ScatterData', (Type,), {
+                'apply_opts': Object(),
+                'result_opts': Object(),
+                'field': String(enum=list_fields),
+                'chunk_size': Integer(minimum=1),
+                'reduce': String(enum=list(reducers),
+                                 allow_null=True, default=None),
+                'reduce_field': String(default='results'),
+                'data': post_data_cls.validator.properties['data'],
+            })
+            routes.append(Route(
+                f'/{srv.app.main}/{srv.name}/scatter', 'POST',
+                handler=_make_scatter_view(srv, scatter_data_cls, reducers),
+                name=f'{srv.app.main}/{srv.name}/scatter'))
     def index():
         return Response('', status_code=302,
                         headers={'Location': '/static/index.html'},)
@@ -293,5 +1736,10 @@ def make_wsgi_app(services: List[BaseService]):
     static_dir = path.join(path.dirname(__file__), 'static')
     return App(
         routes=routes,
-        static_dir=static_dir
+        static_dir=static_dir,
+        router_class=router_class,
+        max_body_size=max_body_size,
+        event_hooks=[CompressionHook()] if compress else None,
+        shard_schema=shard_schema,
+        codecs=[JSONCodec(), MessagePackCodec()],
     )
@@ -2,10 +2,11 @@ from celerystar_apistar.codecs.base import BaseCodec
 from celerystar_apistar.codecs.download import DownloadCodec
 from celerystar_apistar.codecs.jsondata import JSONCodec
 from celerystar_apistar.codecs.jsonschema import JSONSchemaCodec
+from celerystar_apistar.codecs.msgpackdata import MessagePackCodec
 from celerystar_apistar.codecs.openapi import OpenAPICodec
 from celerystar_apistar.codecs.text import TextCodec
 
 __all__ = [
-    'BaseCodec', 'JSONCodec', 'JSONSchemaCodec', 'OpenAPICodec', 'TextCodec',
-    'DownloadCodec'
+    'BaseCodec', 'JSONCodec', 'JSONSchemaCodec', 'MessagePackCodec',
+    'OpenAPICodec', 'TextCodec', 'DownloadCodec'
 ]
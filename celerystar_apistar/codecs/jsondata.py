@@ -1,9 +1,85 @@
-import collections
+import codecs
 import json
+import re
 
+from celerystar_apistar import jsonbackend
 from celerystar_apistar.codecs.base import BaseCodec
 from celerystar_apistar.exceptions import ParseError
 
+WHITESPACE = ' \t\n\r'
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*\Z')
+
+
+class _TextStream():
+    """
+    A sliding text window over an iterable of UTF-8 encoded byte chunks.
+
+    Text before `pos` has already been consumed and is discarded whenever
+    more input is read, so only the value currently being parsed is kept.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, min_size=1):
+        """
+        Read chunks until at least `min_size` characters are available after
+        `pos`. Returns `False` if the stream was already exhausted.
+        """
+        if self.eof:
+            return False
+        parts = [self.buffer[self.pos:]]
+        size = len(parts[0])
+        self.pos = 0
+        try:
+            while size < min_size:
+                try:
+                    chunk = next(self.chunks)
+                except StopIteration:
+                    parts.append(self.decoder.decode(b'', final=True))
+                    self.eof = True
+                    break
+                text = self.decoder.decode(chunk)
+                parts.append(text)
+                size += len(text)
+        except UnicodeDecodeError as exc:
+            raise ParseError('Malformed JSON. %s' % exc) from None
+        self.buffer = ''.join(parts)
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, or '' at the end.
+        """
+        while True:
+            buffer = self.buffer
+            while self.pos < len(buffer) and buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(buffer) or not self.fill():
+                return buffer[self.pos:self.pos + 1]
+
+    def decode_value(self, decoder):
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except ValueError as exc:
+                # Possibly a truncated value. Grow the window geometrically,
+                # so that large values are not re-scanned once per chunk.
+                if self.fill(2 * (len(self.buffer) - self.pos) + 1):
+                    continue
+                raise ParseError('Malformed JSON. %s' % exc) from None
+            if type(value) in (int, float) and NUMBER_TAIL.match(self.buffer, end):
+                # A number such as "12" or "12." may continue in the next
+                # chunk, so it is only complete once followed by a delimiter.
+                if self.fill(len(self.buffer) - self.pos + 1):
+                    continue
+            self.pos = end
+            return value
+
 
 class JSONCodec(BaseCodec):
     media_type = 'application/json'
@@ -14,9 +90,33 @@ class JSONCodec(BaseCodec):
         Return raw JSON data.
         """
         try:
-            return json.loads(
-                bytestring.decode('utf-8'),
-                object_pairs_hook=collections.OrderedDict
-            )
+            return jsonbackend.loads(bytestring)
         except ValueError as exc:
             raise ParseError('Malformed JSON. %s' % exc) from None
+
+    def decode_stream(self, chunks, **options):
+        """
+        Incrementally decode a top-level JSON array from an iterable of byte
+        chunks, yielding each item as soon as it has been parsed.
+        """
+        decoder = json.JSONDecoder()
+        stream = _TextStream(chunks)
+
+        if stream.peek() != '[':
+            raise ParseError('Malformed JSON. Expecting a top-level array.')
+        stream.pos += 1
+
+        if stream.peek() == ']':
+            stream.pos += 1
+        else:
+            while True:
+                yield stream.decode_value(decoder)
+                delimiter = stream.peek()
+                stream.pos += 1
+                if delimiter == ']':
+                    break
+                elif delimiter != ',':
+                    raise ParseError("Malformed JSON. Expecting ',' delimiter.")
+
+        if stream.peek():
+            raise ParseError('Malformed JSON. Extra data after array.')
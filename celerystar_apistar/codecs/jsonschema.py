@@ -218,7 +218,7 @@ class JSONSchemaCodec(BaseCodec):
         return json.dumps(struct, **kwargs).encode('utf-8')
 
     def encode_to_data_structure(self, item, defs=None, def_prefix=None, is_def=False):
-        if issubclass(item, types.Type):
+        if isinstance(item, type) and issubclass(item, types.Type):
             item = item.validator
 
         if defs is not None and item.def_name and not is_def:
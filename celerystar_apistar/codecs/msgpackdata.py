@@ -0,0 +1,30 @@
+from celerystar_apistar import msgpackbackend
+from celerystar_apistar.codecs.base import BaseCodec
+from celerystar_apistar.exceptions import ParseError
+
+
+class MessagePackCodec(BaseCodec):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+
+    def decode(self, bytestring, **options):
+        """
+        Return raw MessagePack data.
+        """
+        try:
+            return msgpackbackend.loads(bytestring)
+        except ValueError as exc:
+            raise ParseError('Malformed MessagePack. %s' % exc) from None
+
+    def decode_stream(self, chunks, **options):
+        """
+        Decode a top-level MessagePack array from an iterable of byte chunks,
+        yielding each item. The whole array is read before the first item.
+        """
+        data = self.decode(b''.join(chunks))
+        if not isinstance(data, list):
+            raise ParseError('Malformed MessagePack. Expecting a top-level array.')
+        yield from data
+
+    def encode(self, item, **options):
+        return msgpackbackend.dumps(item)
@@ -8,15 +8,33 @@ else:
 
 
 try:
-    import aiofiles
+    import jinja2
 except ImportError:
-    aiofiles = None
+    jinja2 = None
 
 
 try:
-    import jinja2
+    import msgpack
 except ImportError:
-    jinja2 = None
+    msgpack = None
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 
 try:
@@ -1,4 +1,5 @@
 from celerystar_apistar import exceptions
+from celerystar_apistar.cache import LRUCache
 
 
 def negotiate_content_type(codecs, content_type=None):
@@ -19,3 +20,102 @@ def negotiate_content_type(codecs, content_type=None):
 
     msg = "Unsupported media in Content-Type header '%s'" % content_type
     raise exceptions.NoCodecAvailable(msg)
+
+
+def parse_accept(accept):
+    """
+    Return the media ranges of an 'Accept' header, mapped to their quality.
+    """
+    qualities = {}
+    for item in accept.split(','):
+        media_range, *params = item.split(';')
+        media_range = media_range.strip().lower()
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities.setdefault(media_range, quality)
+    return qualities
+
+
+class CodecTable():
+    """
+    Negotiates between a fixed list of codecs, in order of preference.
+
+    Media types are resolved through a table built once from the codecs,
+    and the codec chosen for each raw header value is kept in an LRU cache,
+    so that repeated headers are not parsed again.
+    """
+    def __init__(self, codecs, cache_size=256):
+        assert codecs, 'At least one codec is required.'
+        self.codecs = list(codecs)
+        # Media type, including 'type/*' and '*/*', to the position and the
+        # instance of the first codec that handles it.
+        self.table = {}
+        for position, codec in enumerate(self.codecs):
+            self.table.setdefault(codec.media_type, (position, codec))
+        self.content_type_cache = LRUCache(cache_size)
+        self.accept_cache = LRUCache(cache_size)
+
+    def negotiate_content_type(self, content_type=None):
+        """
+        Return the codec for decoding content of the given 'Content-Type'.
+        """
+        if content_type is None:
+            return self.codecs[0]
+
+        codec = self.content_type_cache.get(content_type, False)
+        if codec is False:
+            codec = self.lookup_content_type(content_type)
+            self.content_type_cache.set(content_type, codec)
+        if codec is None:
+            msg = "Unsupported media in Content-Type header '%s'" % content_type
+            raise exceptions.NoCodecAvailable(msg)
+        return codec
+
+    def lookup_content_type(self, content_type):
+        media_type = content_type.split(';')[0].strip().lower()
+        candidates = [
+            self.table[key]
+            for key in (media_type, media_type.split('/')[0] + '/*', '*/*')
+            if key in self.table
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda candidate: candidate[0])[1]
+
+    def negotiate_accept(self, accept=None):
+        """
+        Return the codec for encoding a response to a request with the given
+        'Accept' header, preferring earlier codecs on equal quality.
+        """
+        if not accept:
+            return self.codecs[0]
+
+        codec = self.accept_cache.get(accept, False)
+        if codec is False:
+            codec = self.lookup_accept(accept)
+            self.accept_cache.set(accept, codec)
+        if codec is None:
+            msg = "No codec satisfies the Accept header '%s'" % accept
+            raise exceptions.NoCodecAvailable(msg)
+        return codec
+
+    def lookup_accept(self, accept):
+        qualities = parse_accept(accept)
+        best, best_quality = None, 0.0
+        for codec in self.codecs:
+            media_type = codec.media_type
+            # The most specific matching range sets the quality.
+            for key in (media_type, media_type.split('/')[0] + '/*', '*/*'):
+                if key in qualities:
+                    if qualities[key] > best_quality:
+                        best, best_quality = codec, qualities[key]
+                    break
+        return best
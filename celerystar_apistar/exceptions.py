@@ -104,6 +104,11 @@ class NotAcceptable(HTTPException):
     default_detail = 'Could not satisfy the request Accept header'
 
 
+class PayloadTooLarge(HTTPException):
+    default_status_code = 413
+    default_detail = 'Request body too large'
+
+
 class UnsupportedMediaType(HTTPException):
     default_status_code = 415
     default_detail = 'Unsupported Content-Type header in request'
@@ -1,8 +1,12 @@
+import asyncio
 import json
+import mimetypes
+import os
 import typing
-from urllib.parse import urlparse
+from types import MappingProxyType
+from urllib.parse import parse_qsl, unquote_plus, urlparse
 
-from celerystar_apistar import types
+from celerystar_apistar import jsonbackend
 
 Method = typing.NewType('Method', str)
 Scheme = typing.NewType('Scheme', str)
@@ -13,9 +17,11 @@ QueryString = typing.NewType('QueryString', str)
 QueryParam = typing.NewType('QueryParam', str)
 Header = typing.NewType('Header', str)
 Body = typing.NewType('Body', bytes)
+BodyStream = typing.NewType('BodyStream', typing.Iterator)
 PathParams = typing.NewType('PathParams', dict)
 PathParam = typing.NewType('PathParam', str)
 RequestData = typing.TypeVar('RequestData')
+RequestDataStream = typing.NewType('RequestDataStream', typing.Iterator)
 
 
 class URL(str):
@@ -36,136 +42,208 @@ StrPairs = typing.Sequence[typing.Tuple[str, str]]
 StrMapping = typing.Mapping[str, str]
 
 
-class QueryParams(typing.Mapping[str, str]):
+NO_REPEATS = MappingProxyType({})
+
+
+class MultiDict(typing.Mapping[str, str]):
     """
-    An immutable multidict.
+    A compact, immutable multidict.
+
+    Items are kept in a single list of pairs, with an index from each key to
+    the position of its first pair. Keys that occur more than once are also
+    indexed by all of their positions, so that neither lookups nor
+    `get_list` have to scan the list.
     """
 
-    def __init__(self, value: typing.Union[StrMapping, StrPairs]=None) -> None:
-        if value is None:
-            value = []
-        if hasattr(value, 'items'):
-            items = list(value.items())
-        else:
-            items = list(value)
-        self._dict = {k: v for k, v in reversed(items)}
-        self._list = items
+    def _load(self, items: typing.List[typing.Tuple[str, str]]) -> None:
+        self._items = items
+        self._index = {key: position for position, (key, value) in enumerate(items)}
+        if len(self._index) == len(items):
+            self._repeated = NO_REPEATS
+            return
+        index = self._index = {}
+        repeated = self._repeated = {}
+        for position, (key, value) in enumerate(items):
+            first = index.setdefault(key, position)
+            if first != position:
+                repeated.setdefault(key, [first]).append(position)
+
+    # Normalizes the keys that are looked up.
+    _key = staticmethod(str)
 
     def get_list(self, key: str) -> typing.List[str]:
-        return [
-            item_value for item_key, item_value in self._list
-            if item_key == key
-        ]
+        key = self._key(key)
+        positions = self._repeated.get(key)
+        if positions is not None:
+            items = self._items
+            return [items[position][1] for position in positions]
+        position = self._index.get(key)
+        return [] if position is None else [self._items[position][1]]
 
     def keys(self):
-        return [key for key, value in self._list]
+        return [key for key, value in self._items]
 
     def values(self):
-        return [value for key, value in self._list]
+        return [value for key, value in self._items]
 
     def items(self):
-        return list(self._list)
+        return list(self._items)
 
-    def get(self, key, default=None):
-        if key in self._dict:
-            return self._dict[key]
-        else:
-            return default
+    def get(self, key: str, default: str=None):
+        position = self._index.get(self._key(key))
+        return default if position is None else self._items[position][1]
 
-    def __getitem__(self, key):
-        return self._dict[key]
+    def __getitem__(self, key: str):
+        return self._items[self._index[self._key(key)]][1]
 
-    def __contains__(self, key):
-        return key in self._dict
+    def __contains__(self, key: str):
+        return self._key(key) in self._index
 
     def __iter__(self):
-        return iter(self._list)
+        return iter(self._items)
 
     def __len__(self):
-        return len(self._list)
-
-    def __eq__(self, other):
-        if not isinstance(other, QueryParams):
-            other = QueryParams(other)
-        return sorted(self._list) == sorted(other._list)
+        return len(self._items)
 
     def __repr__(self):
-        return 'QueryParams(%s)' % repr(self._list)
+        return '%s(%s)' % (self.__class__.__name__, repr(self._items))
 
 
-class Headers(typing.Mapping[str, str]):
+class QueryParams(MultiDict):
     """
-    An immutable, case-insensitive multidict.
+    An immutable multidict.
     """
 
     def __init__(self, value: typing.Union[StrMapping, StrPairs]=None) -> None:
         if value is None:
             value = []
-        if hasattr(value, 'items'):
-            items = [(k.lower(), str(v)) for k, v in list(value.items())]
-        else:
-            items = [(k.lower(), str(v)) for k, v in list(value)]
-        self._dict = {k: v for k, v in reversed(items)}
-        self._list = items
+        elif hasattr(value, 'items'):
+            value = value.items()
+        self._load(list(value))
+
+    def __eq__(self, other):
+        if not isinstance(other, QueryParams):
+            other = QueryParams(other)
+        return sorted(self.items()) == sorted(other.items())
+
+
+class QueryStringParams(QueryParams):
+    """
+    A read-only `QueryParams` view over a raw query string.
+
+    Lookups only decode the names and values that they have to, and the
+    full list of parameters is only built when it is needed.
+    """
+
+    def __init__(self, query_string: str) -> None:
+        self.query_string = query_string
+        self._pairs = None
+
+    def __getattr__(self, name):
+        if name in ('_items', '_index', '_repeated'):
+            QueryParams.__init__(self, parse_qsl(self.query_string))
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def raw_pairs(self):
+        if self._pairs is None:
+            self._pairs = [
+                pair.partition('=')[::2]
+                for pair in self.query_string.split('&')
+                if '=' in pair
+            ]
+        return self._pairs
+
+    def iter_values(self, key: str):
+        for name, value in self.raw_pairs():
+            if not value:
+                continue
+            if '%' in name or '+' in name:
+                name = unquote_plus(name)
+            if name == key:
+                yield unquote_plus(value) if ('%' in value or '+' in value) else value
 
     def get_list(self, key: str) -> typing.List[str]:
-        key_lower = key.lower()
+        return list(self.iter_values(key))
+
+    def keys(self):
         return [
-            item_value for item_key, item_value in self._list
-            if item_key == key_lower
+            unquote_plus(name) if ('%' in name or '+' in name) else name
+            for name, value in self.raw_pairs() if value
         ]
 
-    def keys(self):
-        return [key for key, value in self._list]
+    def get(self, key, default=None):
+        return next(self.iter_values(key), default)
 
-    def values(self):
-        return [value for key, value in self._list]
+    def __getitem__(self, key):
+        for value in self.iter_values(key):
+            return value
+        raise KeyError(key)
 
-    def items(self):
-        return list(self._list)
+    def __contains__(self, key):
+        return next(self.iter_values(key), None) is not None
 
-    def get(self, key: str, default: str=None):
-        key = key.lower()
-        if key in self._dict:
-            return self._dict[key]
-        else:
-            return default
+    def __len__(self):
+        return len(self.keys())
 
-    def __getitem__(self, key: str):
-        return self._dict[key.lower()]
 
-    def __contains__(self, key: str):
-        return key.lower() in self._dict
+class Headers(MultiDict):
+    """
+    An immutable, case-insensitive multidict.
+    """
 
-    def __iter__(self):
-        return iter(self._list)
+    def __init__(self, value: typing.Union[StrMapping, StrPairs]=None) -> None:
+        if value is None:
+            value = []
+        elif hasattr(value, 'items'):
+            value = value.items()
+        self._load([(key.lower(), str(item_value)) for key, item_value in value])
 
-    def __len__(self):
-        return len(self._list)
+    _key = staticmethod(str.lower)
 
     def __eq__(self, other):
         if not isinstance(other, Headers):
             other = Headers(other)
-        return sorted(self._list) == sorted(other._list)
-
-    def __repr__(self):
-        return '%s(%s)' % (self.__class__.__name__, repr(self._list))
+        return sorted(self.items()) == sorted(other.items())
 
 
 class MutableHeaders(Headers):
+    def _append(self, key: str, value: str) -> None:
+        self._index[key] = len(self._items)
+        self._items.append((key, value))
+
     def __setitem__(self, key: str, value: str):
         key = key.lower()
         value = str(value)
 
-        if key not in self._dict:
-            self._dict[key] = value
-            self._list.append((key, value))
+        position = self._index.get(key)
+        if position is None:
+            self._append(key, value)
+        elif key in self._repeated:
+            # Drop the other values, which is the only case that needs
+            # the list to be rebuilt.
+            self._load([
+                (key, value) if idx == position else item
+                for idx, item in enumerate(self._items)
+                if item[0] != key or idx == position
+            ])
         else:
-            self._dict[key] = value
-            self._list = [
-                (item_key, value) if item_key == key else (item_key, item_value)
-                for item_key, item_value in self._list
-            ]
+            self._items[position] = (key, value)
+
+    def __delitem__(self, key: str):
+        key = key.lower()
+        if key not in self._index:
+            raise KeyError(key)
+        self._load([item for item in self._items if item[0] != key])
+
+    def setdefault(self, key: str, value: str) -> str:
+        key = key.lower()
+        position = self._index.get(key)
+        if position is None:
+            value = str(value)
+            self._append(key, value)
+            return value
+        return self._items[position][1]
 
 
 class Request():
@@ -206,14 +284,14 @@ class Response():
         )
 
     def set_default_headers(self):
-        if 'Content-Length' not in self.headers:
-            self.headers['Content-Length'] = str(len(self.content))
+        self.headers.setdefault('Content-Length', str(len(self.content)))
+        if self.media_type is not None:
+            self.headers.setdefault('Content-Type', self.content_type())
 
-        if 'Content-Type' not in self.headers and self.media_type is not None:
-            content_type = self.media_type
-            if self.charset is not None:
-                content_type += '; charset=%s' % self.charset
-            self.headers['Content-Type'] = content_type
+    def content_type(self) -> str:
+        if self.charset is None:
+            return self.media_type
+        return '%s; charset=%s' % (self.media_type, self.charset)
 
 
 class HTMLResponse(Response):
@@ -232,12 +310,123 @@ class JSONResponse(Response):
     }
 
     def render(self, content: typing.Any) -> bytes:
+        if self.options is JSONResponse.options and type(self).default is JSONResponse.default:
+            return jsonbackend.dumps(content)
+        # Subclasses that customize the encoding keep using the stdlib.
         options = {'default': self.default}
         options.update(self.options)
         return json.dumps(content, **options).encode('utf-8')
 
     def default(self, obj: typing.Any) -> typing.Any:
-        if isinstance(obj, types.Type):
-            return dict(obj)
-        error = "Object of type '%s' is not JSON serializable."
-        return TypeError(error % type(obj).__name_)
+        return jsonbackend.default(obj)
+
+
+class StreamingResponse(Response):
+    """
+    A response whose content is a sync or async iterator of bytes or string
+    chunks, sent as they are produced instead of being buffered in memory.
+    """
+    def render(self, content: typing.Any) -> typing.Any:
+        return content
+
+    def render_chunk(self, chunk: typing.Any) -> bytes:
+        return super().render(chunk)
+
+    def set_default_headers(self):
+        # The length is unknown up front, so no Content-Length is set.
+        if self.media_type is not None:
+            self.headers.setdefault('Content-Type', self.content_type())
+
+    def iter_content(self) -> typing.Iterator[bytes]:
+        """
+        Yield the rendered chunks. An async iterator is driven on a private
+        event loop, one chunk at a time.
+        """
+        if not hasattr(self.content, '__aiter__'):
+            try:
+                for chunk in self.content:
+                    yield self.render_chunk(chunk)
+            finally:
+                if hasattr(self.content, 'close'):
+                    self.content.close()
+            return
+
+        iterator = self.content.__aiter__()
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                try:
+                    chunk = loop.run_until_complete(iterator.__anext__())
+                except StopAsyncIteration:
+                    break
+                yield self.render_chunk(chunk)
+        finally:
+            if hasattr(iterator, 'aclose'):
+                loop.run_until_complete(iterator.aclose())
+            loop.close()
+
+    async def aiter_content(self) -> typing.AsyncIterator[bytes]:
+        """
+        Yield the rendered chunks. Each chunk of a sync iterator is fetched
+        in the default executor, since producing it may block.
+        """
+        if hasattr(self.content, '__aiter__'):
+            iterator = self.content.__aiter__()
+            try:
+                async for chunk in iterator:
+                    yield self.render_chunk(chunk)
+            finally:
+                if hasattr(iterator, 'aclose'):
+                    await iterator.aclose()
+            return
+
+        loop = asyncio.get_event_loop()
+        iterator = iter(self.content)
+        done = object()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, iterator, done)
+                if chunk is done:
+                    break
+                yield self.render_chunk(chunk)
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+
+class FileResponse(StreamingResponse):
+    """
+    A response that sends a file, given its path or an open binary file.
+
+    Where the server supports it the file is sent with `sendfile()`, through
+    `wsgi.file_wrapper` or the ASGI zero-copy send extension, so that its
+    contents are never copied into Python.
+    """
+    charset = None
+    chunk_size = 64 * 1024
+
+    def render(self, content: typing.Any) -> typing.Iterator[bytes]:
+        if isinstance(content, (str, os.PathLike)):
+            if self.media_type is None:
+                self.media_type = mimetypes.guess_type(os.fspath(content))[0]
+            content = open(content, 'rb')
+        self.file = content
+        return self.read_chunks()
+
+    def read_chunks(self) -> typing.Iterator[bytes]:
+        try:
+            while True:
+                chunk = self.file.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.file.close()
+
+    def set_default_headers(self):
+        if 'Content-Length' not in self.headers:
+            size = os.fstat(self.file.fileno()).st_size - self.file.tell()
+            self.headers['Content-Length'] = str(size)
+        if self.media_type is None:
+            self.media_type = 'application/octet-stream'
+        super().set_default_headers()
@@ -0,0 +1,114 @@
+"""
+The JSON implementation shared by `JSONResponse`, `JSONCodec` and the Celery
+message serializer.
+
+`orjson`, `ujson` or `rapidjson` is used when installed, in that order of
+preference, and the standard library `json` module otherwise. Call
+`set_backend()` to choose one explicitly.
+"""
+import json
+
+from celerystar_apistar import types
+from celerystar_apistar.compat import orjson, rapidjson, ujson
+from celerystar_apistar.exceptions import ConfigurationError
+
+
+def default(obj):
+    if isinstance(obj, types.Type):
+        return dict(obj)
+    error = "Object of type '%s' is not JSON serializable."
+    raise TypeError(error % type(obj).__name__)
+
+
+class StdlibBackend():
+    name = 'json'
+    module = json
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(
+            obj, default=default, ensure_ascii=False, allow_nan=False,
+            separators=(',', ':')
+        ).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonBackend(StdlibBackend):
+    name = 'orjson'
+    module = orjson
+
+    def dumps(self, obj) -> bytes:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonBackend(StdlibBackend):
+    name = 'ujson'
+    module = ujson
+
+    def dumps(self, obj) -> bytes:
+        return ujson.dumps(
+            obj, default=default, ensure_ascii=False,
+            escape_forward_slashes=False
+        ).encode('utf-8')
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+class RapidjsonBackend(StdlibBackend):
+    name = 'rapidjson'
+    module = rapidjson
+
+    def dumps(self, obj) -> bytes:
+        return rapidjson.dumps(obj, default=default, ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return rapidjson.loads(data)
+
+
+BACKENDS = {
+    backend_class.name: backend_class
+    for backend_class in (OrjsonBackend, UjsonBackend, RapidjsonBackend, StdlibBackend)
+}
+
+backend = None
+
+
+def set_backend(name: str=None):
+    """
+    Select the JSON backend by name, or the preferred installed one.
+    """
+    global backend
+    if name is None:
+        name = next(
+            name for name, backend_class in BACKENDS.items()
+            if backend_class.module is not None
+        )
+    elif name not in BACKENDS:
+        msg = 'Unknown JSON backend "%s". Choose one of %s.'
+        raise ConfigurationError(msg % (name, ', '.join(BACKENDS)))
+    elif BACKENDS[name].module is None:
+        raise ConfigurationError('`%s` must be installed to use it as the JSON backend.' % name)
+    backend = BACKENDS[name]()
+    return backend
+
+
+def dumps(obj) -> bytes:
+    """
+    Encode `obj` as compact UTF-8 JSON, serializing `Type` instances as objects.
+    """
+    return backend.dumps(obj)
+
+
+def loads(data):
+    """
+    Decode JSON from bytes or a string. Raises `ValueError` when malformed.
+    """
+    return backend.loads(data)
+
+
+set_backend()
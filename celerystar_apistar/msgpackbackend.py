@@ -0,0 +1,246 @@
+"""
+The MessagePack implementation shared by `MessagePackCodec` and the Celery
+message serializer.
+
+The `msgpack` package is used when installed. Otherwise an in-tree encoder
+and decoder handle the same subset of the format: nil, booleans, integers
+up to 64 bits, floats, strings, binary data, arrays and maps. Extension
+types are not supported.
+"""
+import struct
+
+from celerystar_apistar import types
+from celerystar_apistar.compat import msgpack
+
+
+def default(obj):
+    if isinstance(obj, types.Type):
+        return dict(obj)
+    error = "Object of type '%s' is not MessagePack serializable."
+    raise TypeError(error % type(obj).__name__)
+
+
+# Encoding
+
+_uint8 = struct.Struct('>B').pack
+_uint16 = struct.Struct('>BH').pack
+_uint32 = struct.Struct('>BI').pack
+_uint64 = struct.Struct('>BQ').pack
+_int8 = struct.Struct('>Bb').pack
+_int16 = struct.Struct('>Bh').pack
+_int32 = struct.Struct('>Bi').pack
+_int64 = struct.Struct('>Bq').pack
+_float64 = struct.Struct('>Bd').pack
+
+
+def _pack_length(append, length, fix_code, fix_limit, code8, code16, code32):
+    if length < fix_limit:
+        append(_uint8(fix_code | length))
+    elif code8 is not None and length < 0x100:
+        append(_uint8(code8) + _uint8(length))
+    elif length < 0x10000:
+        append(_uint16(code16, length))
+    elif length < 0x100000000:
+        append(_uint32(code32, length))
+    else:
+        raise ValueError('Object too large to be MessagePack serialized.')
+
+
+def _pack(obj, append):
+    obj_type = type(obj)
+    if obj is None:
+        append(b'\xc0')
+    elif obj is True:
+        append(b'\xc3')
+    elif obj is False:
+        append(b'\xc2')
+    elif obj_type is int:
+        if 0 <= obj < 0x80 or -0x20 <= obj < 0:
+            append(_uint8(obj & 0xff))
+        elif 0 <= obj < 0x100:
+            append(b'\xcc' + _uint8(obj))
+        elif 0 <= obj < 0x10000:
+            append(_uint16(0xcd, obj))
+        elif 0 <= obj < 0x100000000:
+            append(_uint32(0xce, obj))
+        elif 0 <= obj < 0x10000000000000000:
+            append(_uint64(0xcf, obj))
+        elif -0x80 <= obj < 0:
+            append(_int8(0xd0, obj))
+        elif -0x8000 <= obj < 0:
+            append(_int16(0xd1, obj))
+        elif -0x80000000 <= obj < 0:
+            append(_int32(0xd2, obj))
+        elif -0x8000000000000000 <= obj < 0:
+            append(_int64(0xd3, obj))
+        else:
+            raise OverflowError('Integer too large to be MessagePack serialized.')
+    elif obj_type is float:
+        append(_float64(0xcb, obj))
+    elif obj_type is str:
+        data = obj.encode('utf-8')
+        _pack_length(append, len(data), 0xa0, 0x20, 0xd9, 0xda, 0xdb)
+        append(data)
+    elif obj_type in (bytes, bytearray, memoryview):
+        data = bytes(obj)
+        _pack_length(append, len(data), 0, 0, 0xc4, 0xc5, 0xc6)
+        append(data)
+    elif obj_type in (list, tuple):
+        _pack_length(append, len(obj), 0x90, 0x10, None, 0xdc, 0xdd)
+        for item in obj:
+            _pack(item, append)
+    elif obj_type is dict:
+        _pack_length(append, len(obj), 0x80, 0x10, None, 0xde, 0xdf)
+        for key, value in obj.items():
+            _pack(key, append)
+            _pack(value, append)
+    elif isinstance(obj, (bool, int, float, str, list, tuple, dict)):
+        # Subclasses, such as enums.
+        base = next(base for base in (bool, int, float, str, list, tuple, dict)
+                    if isinstance(obj, base))
+        _pack(base(obj), append)
+    else:
+        _pack(default(obj), append)
+
+
+def pack(obj) -> bytes:
+    """
+    Encode `obj` with the in-tree MessagePack encoder.
+    """
+    parts = []
+    _pack(obj, parts.append)
+    return b''.join(parts)
+
+
+# Decoding
+
+_unpack_uint16 = struct.Struct('>H').unpack_from
+_unpack_uint32 = struct.Struct('>I').unpack_from
+_unpack_uint64 = struct.Struct('>Q').unpack_from
+_unpack_int8 = struct.Struct('>b').unpack_from
+_unpack_int16 = struct.Struct('>h').unpack_from
+_unpack_int32 = struct.Struct('>i').unpack_from
+_unpack_int64 = struct.Struct('>q').unpack_from
+_unpack_float32 = struct.Struct('>f').unpack_from
+_unpack_float64 = struct.Struct('>d').unpack_from
+
+# Type code to (unpack function, size) of fixed size values.
+_SCALARS = {
+    0xca: (_unpack_float32, 4),
+    0xcb: (_unpack_float64, 8),
+    0xcc: (lambda data, pos: (data[pos],), 1),
+    0xcd: (_unpack_uint16, 2),
+    0xce: (_unpack_uint32, 4),
+    0xcf: (_unpack_uint64, 8),
+    0xd0: (_unpack_int8, 1),
+    0xd1: (_unpack_int16, 2),
+    0xd2: (_unpack_int32, 4),
+    0xd3: (_unpack_int64, 8),
+}
+# Type code to (kind, size of the length prefix) of variable size values.
+_CONTAINERS = {
+    0xc4: ('bin', 1), 0xc5: ('bin', 2), 0xc6: ('bin', 4),
+    0xd9: ('str', 1), 0xda: ('str', 2), 0xdb: ('str', 4),
+    0xdc: ('array', 2), 0xdd: ('array', 4),
+    0xde: ('map', 2), 0xdf: ('map', 4),
+}
+_LENGTHS = {
+    1: lambda data, pos: data[pos],
+    2: lambda data, pos: _unpack_uint16(data, pos)[0],
+    4: lambda data, pos: _unpack_uint32(data, pos)[0],
+}
+
+
+def _take(data, pos, length):
+    end = pos + length
+    if end > len(data):
+        raise ValueError('Truncated MessagePack data.')
+    return data[pos:end], end
+
+
+def _unpack(data, pos):
+    code = data[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    elif code >= 0xe0:
+        return code - 0x100, pos
+    elif code < 0x90:
+        kind, length = 'map', code & 0x0f
+    elif code < 0xa0:
+        kind, length = 'array', code & 0x0f
+    elif code < 0xc0:
+        kind, length = 'str', code & 0x1f
+    elif code == 0xc0:
+        return None, pos
+    elif code == 0xc2:
+        return False, pos
+    elif code == 0xc3:
+        return True, pos
+    elif code in _SCALARS:
+        unpack_from, size = _SCALARS[code]
+        return unpack_from(data, pos)[0], pos + size
+    elif code in _CONTAINERS:
+        kind, size = _CONTAINERS[code]
+        length = _LENGTHS[size](data, pos)
+        pos += size
+    else:
+        raise ValueError('Unsupported MessagePack type 0x%02x.' % code)
+
+    if kind == 'str':
+        value, pos = _take(data, pos, length)
+        return bytes(value).decode('utf-8'), pos
+    elif kind == 'bin':
+        value, pos = _take(data, pos, length)
+        return bytes(value), pos
+    elif kind == 'array':
+        items = []
+        for _ in range(length):
+            item, pos = _unpack(data, pos)
+            items.append(item)
+        return items, pos
+    mapping = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos)
+        value, pos = _unpack(data, pos)
+        mapping[key] = value
+    return mapping, pos
+
+
+def unpack(data):
+    """
+    Decode MessagePack data with the in-tree decoder.
+    """
+    data = memoryview(data)
+    try:
+        value, pos = _unpack(data, 0)
+    except (IndexError, struct.error):
+        raise ValueError('Truncated MessagePack data.') from None
+    except TypeError as exc:
+        raise ValueError('Invalid MessagePack map key. %s' % exc) from None
+    except RecursionError:
+        raise ValueError('MessagePack data nested too deeply.') from None
+    if pos != len(data):
+        raise ValueError('Extra data after MessagePack value.')
+    return value
+
+
+def dumps(obj) -> bytes:
+    """
+    Encode `obj` as MessagePack, serializing `Type` instances as maps.
+    """
+    if msgpack is not None:
+        return msgpack.packb(obj, default=default, use_bin_type=True)
+    return pack(obj)
+
+
+def loads(data):
+    """
+    Decode MessagePack bytes. Raises `ValueError` when malformed.
+    """
+    if msgpack is not None:
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (ValueError, TypeError) as exc:
+            raise ValueError(str(exc)) from None
+    return unpack(data)
@@ -0,0 +1,327 @@
+import asyncio
+import os
+import signal
+import sys
+import traceback
+from urllib.parse import unquote
+
+from celerystar_apistar.server.asgi import ZEROCOPY_SEND
+from celerystar_apistar.server.prefork import PreforkServer
+from celerystar_apistar.server.wsgi import RESPONSE_STATUS_TEXT
+
+MAX_HEAD_SIZE = 64 * 1024
+BODY_CHUNK_SIZE = 64 * 1024
+MAX_DRAIN_SIZE = 1024 * 1024
+
+
+class BadRequest(Exception):
+    pass
+
+
+class HTTPConnection():
+    """
+    Serves the HTTP/1.1 requests made on a single client connection,
+    calling the ASGI application for each of them in turn.
+    """
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.idle = True
+
+    async def run(self):
+        try:
+            while not self.server.stopping:
+                if not await self.handle_request():
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ConnectionError, BadRequest):
+            pass
+        finally:
+            self.writer.close()
+
+    async def read_head(self):
+        try:
+            head = await asyncio.wait_for(
+                self.reader.readuntil(b'\r\n\r\n'),
+                self.server.keepalive_timeout
+            )
+        except asyncio.LimitOverrunError:
+            await self.send_error(431)
+            raise BadRequest()
+
+        try:
+            request_line, *header_lines = head[:-4].decode('latin-1').split('\r\n')
+            method, target, version = request_line.split(' ')
+            headers = []
+            for line in header_lines:
+                name, _, value = line.partition(':')
+                headers.append((name.strip().lower().encode('latin-1'),
+                                value.strip().encode('latin-1')))
+        except ValueError:
+            await self.send_error(400)
+            raise BadRequest()
+        return method, target, version, headers
+
+    async def handle_request(self):
+        method, target, version, headers = await self.read_head()
+        self.idle = False
+
+        path, _, query_string = target.partition('?')
+        header_dict = dict(headers)
+        connection = header_dict.get(b'connection', b'').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != b'close'
+        else:
+            self.keep_alive = connection == b'keep-alive'
+
+        self.method = method.upper()
+        self.expect_continue = header_dict.get(b'expect', b'').lower() == b'100-continue'
+        self.chunked_request = b'chunked' in header_dict.get(b'transfer-encoding', b'').lower()
+        try:
+            self.body_remaining = int(header_dict.get(b'content-length', 0))
+        except ValueError:
+            await self.send_error(400)
+            raise BadRequest()
+        self.body_complete = not self.chunked_request and not self.body_remaining
+        self.response_started = False
+        self.response_complete = False
+        self.chunked_response = False
+
+        sockname = self.writer.get_extra_info('sockname')
+        peername = self.writer.get_extra_info('peername')
+        scope = {
+            'type': 'http',
+            'http_version': version[5:],
+            'method': self.method,
+            'scheme': 'http',
+            'root_path': '',
+            'path': unquote(path),
+            'query_string': query_string.encode('latin-1'),
+            'headers': headers,
+            'client': list(peername[:2]) if peername else None,
+            'server': list(sockname[:2]) if sockname else None,
+            'extensions': {ZEROCOPY_SEND: {}},
+        }
+
+        try:
+            asgi_callable = self.server.app(scope)
+            await asgi_callable(self.receive, self.send)
+        except ConnectionError:
+            raise
+        except Exception:
+            traceback.print_exc()
+            if self.response_started:
+                return False
+            await self.send_error(500)
+
+        if not self.response_complete:
+            return False
+
+        # Discard any unread request body so the next request lines up, but
+        # close the connection rather than read a large one, such as an
+        # upload rejected for its size.
+        drained = 0
+        while self.keep_alive and not self.body_complete:
+            message = await self.receive()
+            drained += len(message['body'])
+            if drained > MAX_DRAIN_SIZE:
+                return False
+
+        self.idle = True
+        return self.keep_alive
+
+    async def receive(self):
+        if self.body_complete:
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        if self.expect_continue:
+            self.expect_continue = False
+            self.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        if self.chunked_request:
+            line = await self.reader.readline()
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise BadRequest()
+            if size == 0:
+                # Skip any trailers.
+                while (await self.reader.readline()) not in (b'\r\n', b''):
+                    pass
+                self.body_complete = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            body = await self.reader.readexactly(size)
+            await self.reader.readexactly(2)
+            return {'type': 'http.request', 'body': body, 'more_body': True}
+
+        body = await self.reader.readexactly(min(self.body_remaining, BODY_CHUNK_SIZE))
+        self.body_remaining -= len(body)
+        self.body_complete = not self.body_remaining
+        return {'type': 'http.request', 'body': body, 'more_body': not self.body_complete}
+
+    async def send(self, message):
+        message_type = message['type']
+        if message_type == 'http.response.start':
+            assert not self.response_started, 'Response already started.'
+            self.status = message['status']
+            self.response_headers = list(message.get('headers', []))
+            return
+
+        assert message_type in ('http.response.body', ZEROCOPY_SEND), (
+            "Unexpected ASGI message type '%s'." % message_type
+        )
+        assert not self.response_complete, 'Response already completed.'
+        more_body = message.get('more_body', False)
+        if message_type == ZEROCOPY_SEND:
+            file = message['file']
+            offset = message.get('offset')
+            if offset is None:
+                offset = file.tell()
+            count = message.get('count')
+            if count is None:
+                count = os.fstat(file.fileno()).st_size - offset
+            length = count
+        else:
+            body = message.get('body', b'')
+            length = len(body)
+
+        if not self.response_started:
+            self.response_started = True
+            self.write_head(length, more_body)
+
+        if self.method != 'HEAD':
+            if self.chunked_response and length:
+                self.writer.write(b'%x\r\n' % length)
+            if message_type == ZEROCOPY_SEND:
+                if count:
+                    await self.writer.drain()
+                    loop = asyncio.get_event_loop()
+                    await loop.sendfile(self.writer.transport, file, offset, count)
+            elif body:
+                self.writer.write(body)
+            if self.chunked_response:
+                if length:
+                    self.writer.write(b'\r\n')
+                if not more_body:
+                    self.writer.write(b'0\r\n\r\n')
+
+        self.response_complete = not more_body
+        # Wait for the transport buffer to drain, so a slow client pushes
+        # back on the application instead of growing the buffer.
+        await self.writer.drain()
+
+    def write_head(self, length, more_body):
+        headers = self.response_headers
+        names = set(bytes(key).lower() for key, value in headers)
+        if b'content-length' not in names:
+            if not more_body:
+                headers.append((b'content-length', str(length).encode()))
+            elif self.method != 'HEAD':
+                headers.append((b'transfer-encoding', b'chunked'))
+                self.chunked_response = True
+        if not self.keep_alive:
+            headers.append((b'connection', b'close'))
+
+        lines = [('HTTP/1.1 %s\r\n' % RESPONSE_STATUS_TEXT[self.status]).encode('latin-1')]
+        lines.extend(b'%s: %s\r\n' % (bytes(key), bytes(value)) for key, value in headers)
+        lines.append(b'\r\n')
+        self.writer.write(b''.join(lines))
+
+    async def send_error(self, status):
+        self.keep_alive = False
+        content = RESPONSE_STATUS_TEXT[status].encode('latin-1')
+        self.writer.write(
+            b'HTTP/1.1 %s\r\ncontent-type: text/plain\r\ncontent-length: %d\r\n'
+            b'connection: close\r\n\r\n%s' % (content, len(content), content)
+        )
+        self.response_started = True
+        self.response_complete = True
+        await self.writer.drain()
+
+
+class ASGIServer():
+    """
+    An asyncio HTTP/1.1 server that runs an ASGI application directly, so
+    that requests to async handlers overlap instead of running one at a
+    time. Connections are kept alive for `keepalive_timeout` seconds.
+    """
+    def __init__(self, app, host, port, keepalive_timeout=5,
+                 graceful_timeout=30):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.graceful_timeout = graceful_timeout
+        self.connections = set()
+        self.stopping = False
+
+    async def start(self, sock=None):
+        if sock is None:
+            self.server = await asyncio.start_server(
+                self.handle_connection, self.host, self.port,
+                limit=MAX_HEAD_SIZE
+            )
+        else:
+            self.server = await asyncio.start_server(
+                self.handle_connection, sock=sock, limit=MAX_HEAD_SIZE
+            )
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle_connection(self, reader, writer):
+        connection = HTTPConnection(self, reader, writer)
+        self.connections.add(connection)
+        try:
+            await connection.run()
+        finally:
+            self.connections.discard(connection)
+
+    async def shutdown(self):
+        """
+        Stop accepting connections, close the idle ones and wait up to
+        `graceful_timeout` seconds for in-flight requests to finish.
+        """
+        self.stopping = True
+        self.server.close()
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.graceful_timeout
+        while self.connections and loop.time() < deadline:
+            for connection in list(self.connections):
+                if connection.idle:
+                    connection.writer.close()
+            await asyncio.sleep(0.05)
+        for connection in list(self.connections):
+            connection.writer.close()
+
+    def serve_forever(self, sock=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        stopped = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stopped.set)
+
+        async def main():
+            await self.start(sock)
+            if sock is None:
+                print(' * Running on http://%s:%d/' % (self.host, self.port),
+                      file=sys.stderr)
+            await stopped.wait()
+            await self.shutdown()
+
+        try:
+            loop.run_until_complete(main())
+        finally:
+            loop.close()
+
+
+class ASGIPreforkServer(PreforkServer):
+    """
+    Runs an `ASGIServer` event loop in each of the worker processes.
+    """
+    def serve_socket(self, sock):
+        server = ASGIServer(
+            self.app, self.host, self.port,
+            keepalive_timeout=self.keepalive_timeout,
+            graceful_timeout=self.graceful_timeout
+        )
+        server.serve_forever(sock)
@@ -1,22 +1,43 @@
+import hashlib
+
 import werkzeug
 
 from celerystar_apistar import exceptions
-from celerystar_apistar.http import HTMLResponse, JSONResponse, PathParams, Response
+from celerystar_apistar.codecs import JSONCodec, OpenAPICodec
+from celerystar_apistar.conneg import CodecTable
 from celerystar_apistar.server.adapters import ASGItoWSGIAdapter
+from celerystar_apistar.http import (
+    FileResponse, Headers, HTMLResponse, JSONResponse, PathParams, Response,
+    StreamingResponse
+)
+from celerystar_apistar.server.aioserver import ASGIPreforkServer, ASGIServer
 from celerystar_apistar.server.asgi import (
-    ASGI_COMPONENTS, ASGIReceive, ASGIScope, ASGISend
+    ASGI_COMPONENTS, ASGIReceive, ASGIScope, ASGISend, send_file
 )
+from celerystar_apistar.server.asgi import BodyStreamComponent as ASGIBodyStreamComponent
 from celerystar_apistar.server.components import Component
-from celerystar_apistar.server.core import Route, generate_document
+from celerystar_apistar.server.core import Route, generate_document, shard_document
 from celerystar_apistar.server.injector import ASyncInjector, Injector
+from celerystar_apistar.server.prefork import PreforkServer
 from celerystar_apistar.server.router import Router
 from celerystar_apistar.server.staticfiles import ASyncStaticFiles, StaticFiles
 from celerystar_apistar.server.templates import Templates
-from celerystar_apistar.server.validation import VALIDATION_COMPONENTS
+from celerystar_apistar.server.validation import (
+    VALIDATION_COMPONENTS, RequestDataComponent
+)
 from celerystar_apistar.server.wsgi import (
-    RESPONSE_STATUS_TEXT, WSGI_COMPONENTS, WSGIEnviron, WSGIStartResponse
+    RESPONSE_STATUS_TEXT, WSGI_COMPONENTS, BodyStreamComponent,
+    RequestDataStreamComponent, WSGIEnviron, WSGIStartResponse
 )
 
+# Options only the werkzeug development server understands.
+WERKZEUG_OPTIONS = {
+    'use_reloader', 'use_debugger', 'use_evalex', 'extra_files',
+    'exclude_patterns', 'reloader_interval', 'reloader_type', 'threaded',
+    'processes', 'request_handler', 'static_files', 'passthrough_errors',
+    'ssl_context',
+}
+
 
 class App():
     interface = 'wsgi'
@@ -28,7 +49,12 @@ class App():
                  schema_url='/schema/',
                  static_url='/static/',
                  components=None,
-                 event_hooks=None):
+                 event_hooks=None,
+                 router_class=None,
+                 max_body_size=None,
+                 shard_schema=False,
+                 codecs=None,
+                 precompress_static=False):
 
         if static_dir is None:
             static_url = None
@@ -41,23 +67,32 @@ class App():
             msg = 'event_hooks must be a list of instances, not classes.'
             assert not any([isinstance(event_hook, type) for event_hook in event_hooks]), msg
 
-        routes = routes + self.include_extra_routes(schema_url, static_url)
+        routes = routes + self.include_extra_routes(schema_url, static_url, shard_schema)
+        self.routes = routes
         self.init_document(routes)
-        self.init_router(routes)
+        self.init_router(routes, router_class)
         self.init_templates(template_dir)
-        self.init_staticfiles(static_url, static_dir)
-        self.init_injector(components)
+        self.init_staticfiles(static_url, static_dir, precompress_static)
+        self.init_codecs(codecs)
+        self.init_injector(components, max_body_size, codecs)
         self.init_hooks(event_hooks)
 
-    def include_extra_routes(self, schema_url=None, static_url=None):
+    def include_extra_routes(self, schema_url=None, static_url=None, shard_schema=False):
         extra_routes = []
 
-        from celerystar_apistar.server.handlers import serve_schema, serve_static_wsgi
+        from celerystar_apistar.server.handlers import (
+            serve_schema, serve_schema_shard, serve_static_wsgi
+        )
 
         if schema_url:
             extra_routes += [
                 Route(schema_url, method='GET', handler=serve_schema, documented=False)
             ]
+        if schema_url and shard_schema:
+            shard_url = schema_url.rstrip('/') + '/{shard}/'
+            extra_routes += [
+                Route(shard_url, method='GET', handler=serve_schema_shard, documented=False)
+            ]
         if static_url:
             static_url = static_url.rstrip('/') + '/{+filename}'
             extra_routes += [
@@ -67,9 +102,35 @@ class App():
 
     def init_document(self, routes):
         self.document = generate_document(routes)
-
-    def init_router(self, routes):
-        self.router = Router(routes)
+        self.schema_cache = {}
+
+    def get_schema(self, shard=None):
+        """
+        Return the encoded OpenAPI schema of the document, or of one of its
+        shards, together with its ETag. Schemas are encoded once, and again
+        only after `app.document` has been replaced.
+        """
+        document = self.document
+        try:
+            cached_document, content, etag = self.schema_cache[shard]
+        except KeyError:
+            cached_document = None
+        if cached_document is document:
+            return content, etag
+
+        if shard is not None:
+            document = shard_document(document, shard)
+            if document is None:
+                raise exceptions.NotFound()
+        content = OpenAPICodec().encode(document)
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()
+        self.schema_cache[shard] = (self.document, content, etag)
+        return content, etag
+
+    def init_router(self, routes, router_class=None):
+        if router_class is None:
+            router_class = Router
+        self.router = router_class(routes)
 
     def init_templates(self, template_dir: str=None):
         if not template_dir:
@@ -78,15 +139,23 @@ class App():
             template_globals = {'reverse_url': self.reverse_url}
             self.templates = Templates(template_dir, template_globals)
 
-    def init_staticfiles(self, static_url: str, static_dir: str=None):
+    def init_staticfiles(self, static_url: str, static_dir: str=None, precompress: bool=False):
         if not static_dir:
             self.statics = None
         else:
-            self.statics = StaticFiles(static_url, static_dir)
+            self.statics = StaticFiles(static_url, static_dir, precompress)
 
-    def init_injector(self, components=None):
+    def init_codecs(self, codecs=None):
+        self.codecs = CodecTable(codecs or [JSONCodec()])
+
+    def init_injector(self, components=None, max_body_size=None, codecs=None):
         components = components if components else []
         components = list(WSGI_COMPONENTS + VALIDATION_COMPONENTS) + components
+        if max_body_size is not None:
+            components.insert(0, BodyStreamComponent(max_body_size))
+        if codecs:
+            components.insert(0, RequestDataComponent(codecs))
+            components.insert(0, RequestDataStreamComponent(codecs))
         initial_components = {
             'environ': WSGIEnviron,
             'start_response': WSGIStartResponse,
@@ -122,21 +191,75 @@ class App():
     def render_template(self, path: str, **context):
         return self.templates.render_template(path, **context)
 
-    def serve(self, host, port, **options):
-        werkzeug.run_simple(host, port, self, **options)
+    def get_route_functions(self, route):
+        if route.standalone:
+            return [route.handler]
+        return (
+            self.on_request_functions +
+            [route.handler] +
+            self.on_response_functions
+        )
 
-    def render_response(self, response):
+    def warm_up(self):
+        """
+        Resolve the injector steps for every route, and for error handling,
+        so that they're ready before the first request arrives.
+        """
+        for path, name, route in self.router.walk_routes(self.routes):
+            self.injector.get_steps(self.get_route_functions(route))
+        self.injector.get_steps(self.on_error_functions)
+
+    def serve(self, host, port, workers=None, **options):
+        """
+        Run the development server, or with `workers` set, a prefork server
+        with that many worker processes. See `PreforkServer` for its options.
+        """
+        if workers is None:
+            werkzeug.run_simple(host, port, self, **options)
+        else:
+            self.warm_up()
+            PreforkServer(self, host, port, workers=workers, **options).serve_forever()
+
+    def render_response(self, response, headers: Headers):
         if isinstance(response, Response):
             return response
         elif isinstance(response, str):
             return HTMLResponse(response)
-        return JSONResponse(response)
-
-    def finalize_wsgi(self, response, start_response: WSGIStartResponse):
+        return self.encode_response(response, headers.get('Accept'))
+
+    def encode_response(self, data, accept: str=None, status_code: int=200) -> Response:
+        """
+        Return a response with `data` encoded by the codec that the `Accept`
+        header prefers. Clients asking for none of the codecs still get the
+        default one, rather than an error.
+        """
+        try:
+            codec = self.codecs.negotiate_accept(accept)
+        except exceptions.NoCodecAvailable:
+            codec = self.codecs.codecs[0]
+        if isinstance(codec, JSONCodec):
+            response = JSONResponse(data, status_code)
+        else:
+            content = codec.encode(data)
+            response = Response(content, status_code, {'Content-Type': codec.media_type})
+        if len(self.codecs.codecs) > 1:
+            response.headers['Vary'] = 'Accept'
+        return response
+
+    def finalize_wsgi(self,
+                      response,
+                      environ: WSGIEnviron,
+                      start_response: WSGIStartResponse):
         start_response(
             RESPONSE_STATUS_TEXT[response.status_code],
             list(response.headers)
         )
+        if isinstance(response, FileResponse) and 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](response.file, response.chunk_size)
+        if isinstance(response, StreamingResponse):
+            # The server pulls the next chunk only once it has written the
+            # previous one, so a slow client slows down the producer.
+            return response.iter_content()
         return [response.content]
 
     def exception_handler(self, exc: Exception):
@@ -159,14 +282,7 @@ class App():
             route, path_params = self.router.lookup(path, method)
             state['route'] = route
             state['path_params'] = path_params
-            if route.standalone:
-                funcs = [route.handler]
-            else:
-                funcs = (
-                    self.on_request_functions +
-                    [route.handler] +
-                    self.on_response_functions
-                )
+            funcs = self.get_route_functions(route)
             return self.injector.run(funcs, state)
         except Exception as exc:
             state['exc'] = exc
@@ -177,15 +293,22 @@ class App():
 class ASyncApp(App):
     interface = 'asgi'
 
-    def include_extra_routes(self, schema_url=None, static_url=None):
+    def include_extra_routes(self, schema_url=None, static_url=None, shard_schema=False):
         extra_routes = []
 
-        from celerystar_apistar.server.handlers import serve_schema, serve_static_asgi
+        from celerystar_apistar.server.handlers import (
+            serve_schema, serve_schema_shard, serve_static_asgi
+        )
 
         if schema_url:
             extra_routes += [
                 Route(schema_url, method='GET', handler=serve_schema, documented=False)
             ]
+        if schema_url and shard_schema:
+            shard_url = schema_url.rstrip('/') + '/{shard}/'
+            extra_routes += [
+                Route(shard_url, method='GET', handler=serve_schema_shard, documented=False)
+            ]
         if static_url:
             static_url = static_url.rstrip('/') + '/{+filename}'
             extra_routes += [
@@ -193,9 +316,13 @@ class ASyncApp(App):
             ]
         return extra_routes
 
-    def init_injector(self, components=None):
+    def init_injector(self, components=None, max_body_size=None, codecs=None):
         components = components if components else []
         components = list(ASGI_COMPONENTS + VALIDATION_COMPONENTS) + components
+        if max_body_size is not None:
+            components.insert(0, ASGIBodyStreamComponent(max_body_size))
+        if codecs:
+            components.insert(0, RequestDataComponent(codecs))
         initial_components = {
             'scope': ASGIScope,
             'receive': ASGIReceive,
@@ -226,11 +353,11 @@ class ASyncApp(App):
             if hasattr(hook, 'on_error')
         ] + [self.finalize_asgi]
 
-    def init_staticfiles(self, static_url: str, static_dir: str=None):
+    def init_staticfiles(self, static_url: str, static_dir: str=None, precompress: bool=False):
         if not static_dir:
             self.statics = None
         else:
-            self.statics = ASyncStaticFiles(static_url, static_dir)
+            self.statics = ASyncStaticFiles(static_url, static_dir, precompress)
 
     def __call__(self, scope):
         async def asgi_callable(receive, send):
@@ -249,14 +376,7 @@ class ASyncApp(App):
                 route, path_params = self.router.lookup(path, method)
                 state['route'] = route
                 state['path_params'] = path_params
-                if route.standalone:
-                    funcs = [route.handler]
-                else:
-                    funcs = (
-                        self.on_request_functions +
-                        [route.handler] +
-                        self.on_response_functions
-                    )
+                funcs = self.get_route_functions(route)
                 await self.injector.run_async(funcs, state)
             except Exception as exc:
                 state['exc'] = exc
@@ -264,7 +384,7 @@ class ASyncApp(App):
                 await self.injector.run_async(funcs, state)
         return asgi_callable
 
-    async def finalize_asgi(self, response, send: ASGISend):
+    async def finalize_asgi(self, response, scope: ASGIScope, send: ASGISend):
         await send({
             'type': 'http.response.start',
             'status': response.status_code,
@@ -273,11 +393,47 @@ class ASyncApp(App):
                 for key, value in response.headers
             ]
         })
+        if isinstance(response, FileResponse):
+            try:
+                await send_file(scope, send, response.file,
+                                chunk_size=response.chunk_size)
+            finally:
+                response.file.close()
+            return
+        if isinstance(response, StreamingResponse):
+            # `send` returns once the server has flushed each chunk, which
+            # applies the client's backpressure to the producer.
+            async for chunk in response.aiter_content():
+                await send({
+                    'type': 'http.response.body',
+                    'body': chunk,
+                    'more_body': True
+                })
+            await send({
+                'type': 'http.response.body',
+                'body': b''
+            })
+            return
         await send({
             'type': 'http.response.body',
             'body': response.content
         })
 
-    def serve(self, host, port, **options):
-        wsgi = ASGItoWSGIAdapter(self)
-        werkzeug.run_simple(host, port, wsgi, **options)
+    def serve(self, host, port, workers=None, **options):
+        """
+        Run an asyncio HTTP server, or with `workers` set, one in each of
+        that many worker processes. See `ASGIServer` and `PreforkServer`
+        for their options.
+
+        Options of werkzeug's `run_simple`, such as `use_reloader` or
+        `use_debugger`, run the werkzeug development server instead, as
+        before the asyncio server.
+        """
+        if workers is None and WERKZEUG_OPTIONS.intersection(options):
+            werkzeug.run_simple(host, port, ASGItoWSGIAdapter(self), **options)
+            return
+        self.warm_up()
+        if workers is None:
+            ASGIServer(self, host, port, **options).serve_forever()
+        else:
+            ASGIPreforkServer(self, host, port, workers=workers, **options).serve_forever()
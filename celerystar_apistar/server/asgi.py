@@ -1,14 +1,105 @@
+import asyncio
+import io
 import typing
 from inspect import Parameter
-from urllib.parse import parse_qsl
 
-from celerystar_apistar import http
+from celerystar_apistar import exceptions, http
 from celerystar_apistar.server.components import Component
 
 ASGIScope = typing.NewType('ASGIScope', dict)
 ASGIReceive = typing.NewType('ASGIReceive', typing.Callable)
 ASGISend = typing.NewType('ASGISend', typing.Callable)
 
+ZEROCOPY_SEND = 'http.response.zerocopysend'
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+async def send_file(scope, send, file, offset=None, count=None,
+                    chunk_size=FILE_CHUNK_SIZE):
+    """
+    Send `count` bytes of an open binary file, starting at `offset`, as the
+    response body. Uses the zero-copy send extension when the server offers
+    it, and otherwise sends the file in chunks read in the default executor.
+    """
+    try:
+        file.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        zerocopy = False
+    else:
+        zerocopy = ZEROCOPY_SEND in scope.get('extensions', {})
+
+    if zerocopy:
+        message = {'type': ZEROCOPY_SEND, 'file': file}
+        if offset is not None:
+            message['offset'] = offset
+        if count is not None:
+            message['count'] = count
+        await send(message)
+        return
+
+    loop = asyncio.get_event_loop()
+    if offset is not None:
+        file.seek(offset)
+    remaining = count
+    while True:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        chunk = await loop.run_in_executor(None, file.read, size) if size else b''
+        if remaining is not None:
+            remaining -= len(chunk)
+        more_body = bool(chunk) and remaining != 0
+        await send({
+            'type': 'http.response.body',
+            'body': chunk,
+            'more_body': more_body
+        })
+        if not more_body:
+            break
+
+
+class ScopeHeaders(http.Headers):
+    """
+    A read-only `Headers` view over the raw header list of an ASGI scope.
+
+    Lookups only decode the values they return, and the full list of
+    headers is only built when it is needed.
+    """
+
+    def __init__(self, raw_headers) -> None:
+        self.raw_headers = raw_headers
+
+    def __getattr__(self, name):
+        if name in ('_items', '_index', '_repeated'):
+            http.Headers.__init__(self, [
+                (key.decode(), value.decode())
+                for key, value in self.raw_headers
+            ])
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def get_list(self, key: str) -> typing.List[str]:
+        raw_key = key.lower().encode()
+        return [
+            value.decode() for name, value in self.raw_headers
+            if name == raw_key
+        ]
+
+    def get(self, key: str, default: str=None):
+        raw_key = key.lower().encode()
+        for name, value in self.raw_headers:
+            if name == raw_key:
+                return value.decode()
+        return default
+
+    def __getitem__(self, key: str):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str):
+        raw_key = key.lower().encode()
+        return any(name == raw_key for name, value in self.raw_headers)
+
 
 class MethodComponent(Component):
     def resolve(self,
@@ -68,53 +159,85 @@ class QueryStringComponent(Component):
 class QueryParamsComponent(Component):
     def resolve(self,
                 scope: ASGIScope) -> http.QueryParams:
-        query_string = scope['query_string'].decode()
-        return http.QueryParams(parse_qsl(query_string))
+        return http.QueryStringParams(scope['query_string'].decode())
 
 
 class QueryParamComponent(Component):
     def resolve(self,
                 parameter: Parameter,
                 query_params: http.QueryParams) -> http.QueryParam:
-        name = parameter.name
-        if name not in query_params:
+        value = query_params.get(parameter.name)
+        if value is None:
             return None
-        return http.QueryParam(query_params[name])
+        return http.QueryParam(value)
 
 
 class HeadersComponent(Component):
     def resolve(self,
                 scope: ASGIScope) -> http.Headers:
-        return http.Headers([
-            (key.decode(), value.decode())
-            for key, value in scope['headers']
-        ])
+        return ScopeHeaders(scope['headers'])
 
 
 class HeaderComponent(Component):
     def resolve(self,
                 parameter: Parameter,
                 headers: http.Headers) -> http.Header:
-        name = parameter.name.replace('_', '-')
-        if name not in headers:
+        value = headers.get(parameter.name.replace('_', '-'))
+        if value is None:
             return None
-        return http.Header(headers[name])
+        return http.Header(value)
 
 
-class BodyComponent(Component):
-    async def resolve(self,
-                      receive: ASGIReceive) -> http.Body:
-        body = b''
+class BodyStreamComponent(Component):
+    """
+    Yields the request body lazily, one ASGI message at a time.
+
+    Bodies over `max_body_size` bytes are rejected with a 413, up front
+    when the request has a Content-Length, or else once that much has
+    been received.
+    """
+    def __init__(self, max_body_size: int=None) -> None:
+        self.max_body_size = max_body_size
+
+    def resolve(self,
+                scope: ASGIScope,
+                receive: ASGIReceive) -> http.BodyStream:
+        max_body_size = self.max_body_size
+        if max_body_size is not None:
+            for key, value in scope['headers']:
+                if key.lower() == b'content-length':
+                    try:
+                        content_length = int(value)
+                    except ValueError:
+                        raise exceptions.BadRequest('Invalid Content-Length header')
+                    if content_length > max_body_size:
+                        raise exceptions.PayloadTooLarge()
+        return http.BodyStream(self.iter_chunks(receive))
+
+    async def iter_chunks(self, receive):
+        size = 0
         while True:
             message = await receive()
             if not message['type'] == 'http.request':
                 error = "'Unexpected ASGI message type '%s'."
                 raise Exception(error % message['type'])
-            body += message.get('body', b'')
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if self.max_body_size is not None and size > self.max_body_size:
+                raise exceptions.PayloadTooLarge()
+            if chunk:
+                yield chunk
             if not message.get('more_body', False):
                 break
 
-        return http.Body(body)
+
+class BodyComponent(Component):
+    async def resolve(self,
+                      stream: http.BodyStream) -> http.Body:
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+        return http.Body(b''.join(chunks))
 
 
 class RequestComponent(Component):
@@ -138,6 +261,7 @@ ASGI_COMPONENTS = (
     QueryParamComponent(),
     HeadersComponent(),
     HeaderComponent(),
+    BodyStreamComponent(),
     BodyComponent(),
     RequestComponent()
 )
@@ -0,0 +1,141 @@
+import zlib
+
+from celerystar_apistar import http
+
+# zlib `wbits` values selecting the container format of each encoding.
+ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'application/vnd.oai.openapi',
+    'application/xml',
+    'image/svg+xml',
+}
+
+
+def negotiate_encoding(accept_encoding: str, encodings=ENCODINGS):
+    """
+    Return the supported encoding the client prefers in an `Accept-Encoding`
+    header, or `None` if it accepts none of them.
+    """
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for encoding in encodings:
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    media_type = content_type.partition(';')[0].strip().lower()
+    return (
+        media_type.startswith('text/') or
+        media_type.endswith(('+json', '+xml')) or
+        media_type in COMPRESSIBLE_TYPES
+    )
+
+
+class CompressionHook():
+    """
+    An event hook that compresses responses with gzip or deflate, as
+    negotiated from the request `Accept-Encoding` header.
+
+    Responses smaller than `minimum_size` bytes are sent as they are.
+    Streaming responses are compressed chunk by chunk, flushing after each
+    one so that the client still receives them as they are produced.
+    """
+    def __init__(self, minimum_size: int=500, level: int=6) -> None:
+        self.minimum_size = minimum_size
+        self.level = level
+
+    def on_response(self, response: http.Response, headers: http.Headers) -> http.Response:
+        if (
+            'Content-Encoding' in response.headers or
+            not is_compressible(response.headers.get('Content-Type', '')) or
+            response.status_code < 200 or response.status_code in (204, 304)
+        ):
+            return response
+
+        response.headers['Vary'] = self.get_vary(response.headers)
+        encoding = negotiate_encoding(headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+
+        if isinstance(response, http.StreamingResponse):
+            content_length = response.headers.get('Content-Length')
+            if content_length is not None and int(content_length) < self.minimum_size:
+                return response
+            response_headers = http.MutableHeaders([
+                (key, value) for key, value in response.headers
+                if key != 'content-length'
+            ])
+            response_headers['Content-Encoding'] = encoding
+            return http.StreamingResponse(
+                self.compress_stream(response.content, encoding),
+                response.status_code,
+                response_headers
+            )
+
+        if len(response.content) < self.minimum_size:
+            return response
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODINGS[encoding])
+        response.content = compressor.compress(response.content) + compressor.flush()
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Content-Length'] = str(len(response.content))
+        return response
+
+    def get_vary(self, headers: http.Headers) -> str:
+        vary = headers.get('Vary')
+        if not vary:
+            return 'Accept-Encoding'
+        elif 'accept-encoding' in vary.lower():
+            return vary
+        return vary + ', Accept-Encoding'
+
+    def compress_stream(self, content, encoding):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, ENCODINGS[encoding])
+        if hasattr(content, '__aiter__'):
+            return self.compress_async_chunks(compressor, content)
+        return self.compress_chunks(compressor, content)
+
+    def compress_chunks(self, compressor, content):
+        try:
+            for chunk in content:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+        finally:
+            if hasattr(content, 'close'):
+                content.close()
+
+    async def compress_async_chunks(self, compressor, content):
+        iterator = content.__aiter__()
+        try:
+            async for chunk in iterator:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+        finally:
+            if hasattr(iterator, 'aclose'):
+                await iterator.aclose()
@@ -1,5 +1,6 @@
 import inspect
 import re
+from urllib.parse import urlparse
 
 from celerystar_apistar import types, validators
 from celerystar_apistar.document import Document, Field, Link, Section
@@ -17,6 +18,7 @@ class Route():
             self.link = self.generate_link(url, method, handler, self.name)
         else:
             self.link = link
+        self.generate_validators(self.link)
 
     def generate_link(self, url, method, handler, name):
         fields = self.generate_fields(url, method, handler)
@@ -25,6 +27,29 @@ class Route():
             encoding = 'application/json'
         return Link(url=url, method=method, name=name, encoding=encoding, fields=fields)
 
+    def generate_validators(self, link):
+        """
+        Build the path and query parameter validators once, rather than on
+        every request.
+        """
+        path_fields = link.get_path_fields()
+        query_fields = link.get_query_fields()
+        self.path_params_validator = validators.Object(
+            properties=[
+                (field.name, field.schema if field.schema else validators.Any())
+                for field in path_fields
+            ],
+            required=[field.name for field in path_fields]
+        )
+        self.query_params_validator = validators.Object(
+            properties=[
+                (field.name, field.schema if field.schema else validators.Any())
+                for field in query_fields
+            ],
+            required=[field.name for field in query_fields if field.required]
+        )
+        self.body_field = link.get_body_field()
+
     def generate_fields(self, url, method, handler):
         fields = []
         path_names = [
@@ -59,10 +84,15 @@ class Route():
                 field = Field(name=name, location='query', schema=schema)
                 fields.append(field)
 
-            elif issubclass(param.annotation, types.Type):
+            elif inspect.isclass(param.annotation) and issubclass(param.annotation, types.Type):
                 field = Field(name=name, location='body', schema=param.annotation.validator)
                 fields.append(field)
 
+            elif isinstance(param.annotation, validators.Array):
+                # An `Array` instance annotation declares a streamed body.
+                field = Field(name=name, location='body', schema=param.annotation)
+                fields.append(field)
+
         return fields
 
 
@@ -104,6 +134,30 @@ def generate_document(routes):
     return Document(content=content)
 
 
+def shard_document(document, shard):
+    """
+    Return the part of a document made of the section named `shard` and of
+    the links under the `/<shard>/` URL, or `None` if there is no such part.
+    """
+    content = []
+    for item in document.content:
+        if isinstance(item, Section):
+            name = item.name
+        else:
+            name = urlparse(item.url).path.strip('/').split('/')[0]
+        if name == shard:
+            content.append(item)
+    if not content:
+        return None
+    return Document(
+        content=content,
+        url=document.url,
+        title=document.title,
+        description=document.description,
+        version=document.version
+    )
+
+
 def bind(document, bindings, name_prefix=''):
     """
     Given a document and a map of {"section:link": handler} return a
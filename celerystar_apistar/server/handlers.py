@@ -1,14 +1,38 @@
 from celerystar_apistar import App, http
-from celerystar_apistar.codecs import OpenAPICodec
 from celerystar_apistar.server.asgi import ASGIReceive, ASGIScope, ASGISend
 from celerystar_apistar.server.wsgi import WSGIEnviron, WSGIStartResponse
 
 
-def serve_schema(app: App):
-    codec = OpenAPICodec()
-    content = codec.encode(app.document)
-    headers = {'Content-Type': 'application/vnd.oai.openapi'}
-    return http.Response(content, headers=headers)
+def etag_matches(etag: str, if_none_match: str):
+    if if_none_match.strip() == '*':
+        return True
+    return any(
+        tag.strip().replace('W/', '', 1) == etag
+        for tag in if_none_match.split(',')
+    )
+
+
+def schema_response(content: bytes, etag: str, headers: http.Headers):
+    response_headers = {
+        'ETag': etag,
+        'Cache-Control': 'no-cache',
+    }
+    if etag_matches(etag, headers.get('If-None-Match', '')):
+        response = http.Response(b'', status_code=304, headers=response_headers)
+        del response.headers['Content-Length']
+        return response
+    response_headers['Content-Type'] = 'application/vnd.oai.openapi'
+    return http.Response(content, headers=response_headers)
+
+
+def serve_schema(app: App, headers: http.Headers):
+    content, etag = app.get_schema()
+    return schema_response(content, etag, headers)
+
+
+def serve_schema_shard(app: App, shard: str, headers: http.Headers):
+    content, etag = app.get_schema(shard)
+    return schema_response(content, etag, headers)
 
 
 def serve_documentation(app: App):
@@ -85,14 +85,17 @@ class Injector(BaseInjector):
             steps.extend(func_steps)
         return steps
 
-    def run(self, funcs, state):
+    def get_steps(self, funcs):
         funcs = tuple(funcs)
         try:
-            steps = self.resolver_cache[funcs]
+            return self.resolver_cache[funcs]
         except KeyError:
             steps = self.resolve_functions(funcs)
             self.resolver_cache[funcs] = steps
+            return steps
 
+    def run(self, funcs, state):
+        steps = self.get_steps(funcs)
         for func, is_async, kwargs, consts, output_name in steps:
             func_kwargs = {key: state[val] for key, val in kwargs.items()}
             func_kwargs.update(consts)
@@ -105,13 +108,7 @@ class ASyncInjector(Injector):
     allow_async = True
 
     async def run_async(self, funcs, state):
-        funcs = tuple(funcs)
-        try:
-            steps = self.resolver_cache[funcs]
-        except KeyError:
-            steps = self.resolve_functions(funcs)
-            self.resolver_cache[funcs] = steps
-
+        steps = self.get_steps(funcs)
         for func, is_async, kwargs, consts, output_name in steps:
             func_kwargs = {key: state[val] for key, val in kwargs.items()}
             func_kwargs.update(consts)
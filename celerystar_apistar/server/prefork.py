@@ -0,0 +1,255 @@
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    Closes idle keep-alive connections after `timeout` seconds, so they
+    can't hold on to a thread of the bounded pool forever.
+    """
+    timeout = 5
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    A WSGI server that handles requests on a bounded pool of threads.
+
+    When every thread is busy the server stops accepting connections, which
+    leaves them queued in the listen backlog instead of in memory.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8, **kwargs):
+        self.executor = ThreadPoolExecutor(threads)
+        self.slots = threading.BoundedSemaphore(threads)
+        super().__init__(host, port, app, **kwargs)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            # Let the in-flight requests finish.
+            self.executor.shutdown(wait=True)
+
+
+class PreforkServer():
+    """
+    Serves a WSGI application from `workers` forked processes, each one
+    handling requests with a pool of `threads` threads.
+
+    Where `SO_REUSEPORT` is available every worker listens on its own socket
+    bound to the same address, and the kernel balances connections between
+    them. Otherwise the workers share a single inherited listening socket.
+
+    Signals sent to the master process:
+
+    * `SIGTERM`/`SIGINT` - stop the workers gracefully and exit.
+    * `SIGHUP` - graceful restart: start a new set of workers, then stop
+      the old ones once they have finished their in-flight requests.
+
+    Workers that die are replaced. When they keep dying within
+    `min_worker_lifetime` seconds of starting, e.g. on a bind failure or
+    an import error, the delay before replacing them doubles each time,
+    up to `max_respawn_delay` seconds.
+    """
+    def __init__(self, app, host, port, workers=None, threads=8,
+                 keepalive_timeout=5, graceful_timeout=30, reuse_port=True,
+                 min_worker_lifetime=1, max_respawn_delay=30):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.num_workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.keepalive_timeout = keepalive_timeout
+        self.graceful_timeout = graceful_timeout
+        self.reuse_port = reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        self.workers = {}  # pid -> generation
+        self.started = {}  # pid -> start time
+        self.min_worker_lifetime = min_worker_lifetime
+        self.max_respawn_delay = max_respawn_delay
+        self.failures = 0
+        self.respawn_at = 0
+        self.generation = 0
+        self.running = False
+        self.reload_requested = False
+
+    def create_socket(self, listen):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.host, self.port))
+        if listen:
+            sock.listen(socket.SOMAXCONN)
+        return sock
+
+    # Master process
+
+    def serve_forever(self):
+        # With `SO_REUSEPORT` the master only reserves the address, and
+        # resolves port 0 so that every worker binds the same port.
+        self.socket = self.create_socket(listen=not self.reuse_port)
+        self.port = self.socket.getsockname()[1]
+        self.running = True
+
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        print(' * Running on http://%s:%d/ (%d workers, %d threads each)' % (
+            self.host, self.port, self.num_workers, self.threads
+        ), file=sys.stderr)
+
+        try:
+            self.spawn_workers()
+            while self.running:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                self.reap_workers()
+                time.sleep(0.1)
+        finally:
+            self.stop_workers(list(self.workers))
+            self.socket.close()
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def spawn_workers(self):
+        current = [
+            pid for pid, generation in self.workers.items()
+            if generation == self.generation
+        ]
+        for _ in range(self.num_workers - len(current)):
+            self.spawn_worker()
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self.run_worker()
+            except BaseException:
+                exit_code = 1
+                sys.excepthook(*sys.exc_info())
+            finally:
+                os._exit(exit_code)
+        self.workers[pid] = self.generation
+        self.started[pid] = time.monotonic()
+
+    def reap_workers(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                self.started.clear()
+                break
+            if pid == 0:
+                break
+            self.workers.pop(pid, None)
+            self.worker_exited(pid)
+        if self.running and time.monotonic() >= self.respawn_at:
+            self.spawn_workers()
+
+    def worker_exited(self, pid):
+        now = time.monotonic()
+        if now - self.started.pop(pid, now) < self.min_worker_lifetime:
+            self.failures += 1
+            delay = min(0.1 * 2 ** self.failures, self.max_respawn_delay)
+            self.respawn_at = now + delay
+        else:
+            self.failures = 0
+
+    def reload(self):
+        old_workers = list(self.workers)
+        self.generation += 1
+        self.spawn_workers()
+        self.stop_workers(old_workers)
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            self.kill_worker(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self.graceful_timeout
+        pending = set(pids)
+        while pending and time.monotonic() < deadline:
+            for pid in list(pending):
+                if self.wait_worker(pid, os.WNOHANG):
+                    pending.discard(pid)
+            time.sleep(0.05)
+
+        for pid in pending:
+            self.kill_worker(pid, signal.SIGKILL)
+            self.wait_worker(pid, 0)
+        for pid in pids:
+            self.workers.pop(pid, None)
+            self.started.pop(pid, None)
+
+    def wait_worker(self, pid, options):
+        """
+        Return `True` once the worker has exited.
+        """
+        try:
+            return os.waitpid(pid, options)[0] == pid
+        except ChildProcessError:
+            return True
+
+    def kill_worker(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    # Worker process
+
+    def run_worker(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+        if self.reuse_port:
+            self.socket.close()
+            self.socket = self.create_socket(listen=True)
+        self.serve_socket(self.socket)
+
+    def serve_socket(self, sock):
+        handler = type('RequestHandler', (KeepAliveRequestHandler,), {
+            'timeout': self.keepalive_timeout
+        })
+        server = PooledWSGIServer(
+            self.host, self.port, self.app, threads=self.threads,
+            handler=handler, fd=sock.fileno()
+        )
+        sock.close()
+
+        def stop(signum, frame):
+            # `shutdown()` blocks until `serve_forever()` returns, so it can't
+            # be called from the thread running it.
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        server.serve_forever()
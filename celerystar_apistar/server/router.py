@@ -1,12 +1,12 @@
 import inspect
 import re
-from urllib.parse import urlparse
+from urllib.parse import quote, urlencode, urlparse
 
 import werkzeug
 from werkzeug.routing import Map, Rule
 
 from celerystar_apistar import exceptions
-from celerystar_apistar.compat import dict_type
+from celerystar_apistar.cache import LRUCache
 from celerystar_apistar.server.core import Include, Route
 
 
@@ -17,49 +17,25 @@ class BaseRouter():
     def reverse_url(self, name: str, **params) -> str:
         raise NotImplementedError()
 
-
-class Router(BaseRouter):
-    def __init__(self, routes):
-        rules = []
-        name_lookups = {}
-
-        for path, name, route in self.walk_routes(routes):
-            path_params = [
-                item.strip('{}') for item in re.findall('{[^}]*}', path)
-            ]
-            args = inspect.signature(route.handler).parameters
-            for path_param in path_params:
-                if path_param.startswith('+'):
-                    path = path.replace(
-                        '{%s}' % path_param,
-                        "<path:%s>" % path_param.lstrip('+')
-                    )
-                elif path_param in args and args[path_param].annotation is int:
-                    path = path.replace(
-                        '{%s}' % path_param,
-                        "<int:%s>" % path_param
-                    )
-                elif path_param in args and args[path_param].annotation is float:
-                    path = path.replace(
-                        '{%s}' % path_param,
-                        "<float:%s>" % path_param
-                    )
-                else:
-                    path = path.replace(
-                        '{%s}' % path_param,
-                        "<string:%s>" % path_param
-                    )
-
-            rule = Rule(path, methods=[route.method], endpoint=name)
-            rules.append(rule)
-            name_lookups[name] = route
-
-        self.adapter = Map(rules).bind('')
-        self.name_lookups = name_lookups
-
-        # Use an MRU cache for router lookups.
-        self._lookup_cache = dict_type()
-        self._lookup_cache_size = 10000
+    def get_path_converters(self, path, route):
+        """
+        Return a list of `(template, name, converter)` for each "{param}"
+        in the given path, where converter is one of 'path', 'int', 'float'
+        or 'string'.
+        """
+        converters = []
+        args = inspect.signature(route.handler).parameters
+        for template in re.findall('{[^}]*}', path):
+            path_param = template.strip('{}')
+            if path_param.startswith('+'):
+                converters.append((template, path_param.lstrip('+'), 'path'))
+            elif path_param in args and args[path_param].annotation is int:
+                converters.append((template, path_param, 'int'))
+            elif path_param in args and args[path_param].annotation is float:
+                converters.append((template, path_param, 'float'))
+            else:
+                converters.append((template, path_param, 'string'))
+        return converters
 
     def walk_routes(self, routes, url_prefix='', name_prefix=''):
         walked = []
@@ -76,12 +52,33 @@ class Router(BaseRouter):
                 walked.extend(result)
         return walked
 
+
+class Router(BaseRouter):
+    def __init__(self, routes, lookup_cache_size=10000):
+        rules = []
+        name_lookups = {}
+
+        for path, name, route in self.walk_routes(routes):
+            for template, path_param, converter in self.get_path_converters(path, route):
+                path = path.replace(template, "<%s:%s>" % (converter, path_param))
+
+            rule = Rule(path, methods=[route.method], endpoint=name)
+            rules.append(rule)
+            name_lookups[name] = route
+
+        self.adapter = Map(rules).bind('')
+        self.name_lookups = name_lookups
+
+        # Use an LRU cache for router lookups. Only routes without path
+        # parameters are cached, so that high-cardinality URLs such as
+        # "/users/{id}" do not flush the entries that are actually reused.
+        self.lookup_cache = LRUCache(lookup_cache_size)
+
     def lookup(self, path: str, method: str):
         lookup_key = method + ' ' + path
-        try:
-            return self._lookup_cache[lookup_key]
-        except KeyError:
-            pass
+        cached = self.lookup_cache.get(lookup_key)
+        if cached is not None:
+            return cached
 
         try:
             name, path_params = self.adapter.match(path, method)
@@ -95,9 +92,8 @@ class Router(BaseRouter):
 
         route = self.name_lookups[name]
 
-        self._lookup_cache[lookup_key] = (route, path_params)
-        if len(self._lookup_cache) > self._lookup_cache_size:
-            self._lookup_cache.pop(next(iter(self._lookup_cache)))
+        if not path_params:
+            self.lookup_cache.set(lookup_key, (route, path_params))
 
         return (route, path_params)
 
@@ -106,3 +102,171 @@ class Router(BaseRouter):
             return self.adapter.build(name, params)
         except werkzeug.routing.BuildError as exc:
             raise exceptions.NoReverseMatch(str(exc)) from None
+
+
+CONVERTERS = {
+    'int': (re.compile(r'\d+\Z'), int),
+    'float': (re.compile(r'\d+\.\d+\Z'), float),
+    'string': (re.compile(r'[^/]+\Z'), str),
+}
+CONVERTER_PRIORITY = ('int', 'float', 'string')
+
+
+class RouteNode():
+    """
+    A node in the `TreeRouter` trie, holding one path segment.
+    """
+    def __init__(self):
+        self.static = {}          # segment -> RouteNode
+        self.patterns = []        # [(regex, [(name, converter)], RouteNode)]
+        self.params = []          # [(converter, name, RouteNode)]
+        self.path_param = None    # (name, RouteNode)
+        self.endpoints = {}       # method -> route name
+
+    def add_child(self, segment, converters):
+        params = [item for item in converters if item[0] in segment]
+        if not params:
+            return self.static.setdefault(segment, RouteNode())
+
+        if len(params) == 1 and params[0][0] == segment:
+            template, name, converter = params[0]
+            if converter == 'path':
+                if self.path_param is None:
+                    self.path_param = (name, RouteNode())
+                assert self.path_param[0] == name, 'Conflicting path parameter names.'
+                return self.path_param[1]
+            for param_converter, param_name, node in self.params:
+                if (param_converter, param_name) == (converter, name):
+                    return node
+            node = RouteNode()
+            self.params.append((converter, name, node))
+            self.params.sort(key=lambda item: CONVERTER_PRIORITY.index(item[0]))
+            return node
+
+        # A segment mixing literal text and parameters, eg. "{name}.json".
+        msg = 'Path parameters "{+name}" must span whole segments.'
+        assert all(item[2] != 'path' for item in params), msg
+        regex = ''
+        names = []
+        for part in re.split('({[^}]*})', segment):
+            param = [item for item in params if item[0] == part]
+            if param:
+                template, name, converter = param[0]
+                regex += '(%s)' % CONVERTERS[converter][0].pattern[:-2]
+                names.append((name, converter))
+            else:
+                regex += re.escape(part)
+        for pattern, pattern_names, node in self.patterns:
+            if pattern.pattern == regex + r'\Z':
+                return node
+        node = RouteNode()
+        self.patterns.append((re.compile(regex + r'\Z'), names, node))
+        return node
+
+
+class TreeRouter(BaseRouter):
+    """
+    A router that matches paths against a trie of path segments, rather than
+    trying a regex for each rule. Routes without path parameters are looked
+    up directly in a dict.
+    """
+    def __init__(self, routes):
+        self.root = RouteNode()
+        self.static_routes = {}
+        self.name_lookups = {}
+        self.reverse_lookups = {}
+
+        for path, name, route in self.walk_routes(routes):
+            converters = self.get_path_converters(path, route)
+            if not converters:
+                self.static_routes.setdefault(path, {})[route.method] = name
+            else:
+                node = self.root
+                for segment in path.split('/'):
+                    node = node.add_child(segment, converters)
+                node.endpoints[route.method] = name
+            self.name_lookups[name] = route
+            self.reverse_lookups[name] = (path, converters)
+
+    def lookup(self, path: str, method: str):
+        try:
+            return self.match(path, method)
+        except exceptions.NotFound:
+            if path.endswith('/'):
+                raise
+        try:
+            self.match(path + '/', method)
+        except exceptions.HTTPException:
+            raise exceptions.NotFound() from None
+        raise exceptions.Found(path + '/')
+
+    def match(self, path: str, method: str):
+        endpoints = self.static_routes.get(path)
+        if endpoints is not None and method in endpoints:
+            return (self.name_lookups[endpoints[method]], {})
+
+        path_matched = endpoints is not None
+        segments = path.split('/')
+        for node, path_params in self.match_node(self.root, segments, 0, {}):
+            if method in node.endpoints:
+                return (self.name_lookups[node.endpoints[method]], path_params)
+            path_matched = True
+
+        if path_matched:
+            raise exceptions.MethodNotAllowed()
+        raise exceptions.NotFound()
+
+    def match_node(self, node, segments, index, path_params):
+        """
+        Yield every `(node, path_params)` with endpoints that matches the
+        segments from `index` onwards, trying static segments first.
+        """
+        if index == len(segments):
+            if node.endpoints:
+                yield node, path_params
+            return
+
+        segment = segments[index]
+        child = node.static.get(segment)
+        if child is not None:
+            yield from self.match_node(child, segments, index + 1, path_params)
+
+        for regex, names, child in node.patterns:
+            match = regex.match(segment)
+            if match is not None:
+                params = dict(path_params)
+                for (name, converter), value in zip(names, match.groups()):
+                    params[name] = CONVERTERS[converter][1](value)
+                yield from self.match_node(child, segments, index + 1, params)
+
+        for converter, name, child in node.params:
+            regex, to_python = CONVERTERS[converter]
+            if regex.match(segment):
+                params = dict(path_params, **{name: to_python(segment)})
+                yield from self.match_node(child, segments, index + 1, params)
+
+        if node.path_param is not None and segment:
+            name, child = node.path_param
+            for end in range(index + 1, len(segments) + 1):
+                params = dict(path_params, **{name: '/'.join(segments[index:end])})
+                yield from self.match_node(child, segments, end, params)
+
+    def reverse_url(self, name: str, **params) -> str:
+        try:
+            path, converters = self.reverse_lookups[name]
+        except KeyError:
+            raise exceptions.NoReverseMatch('Could not build url for endpoint %r.' % name) from None
+
+        params = dict(params)
+        for template, param_name, converter in converters:
+            if param_name not in params:
+                msg = 'Could not build url for endpoint %r. Missing parameter %r.'
+                raise exceptions.NoReverseMatch(msg % (name, param_name))
+            value = params.pop(param_name)
+            if converter in ('int', 'float'):
+                value = CONVERTERS[converter][1](value)
+            path = path.replace(template, quote(str(value), safe="/:@!$&'()*+,;="))
+
+        if params:
+            path += '?' + urlencode(list(params.items()))
+        return path
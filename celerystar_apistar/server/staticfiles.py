@@ -1,7 +1,48 @@
-from http import HTTPStatus
+import gzip
+import os
+import tempfile
 
 from celerystar_apistar import exceptions
-from celerystar_apistar.compat import aiofiles, whitenoise
+from celerystar_apistar.compat import whitenoise
+from celerystar_apistar.server.asgi import send_file
+
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.html', '.js', '.json', '.map', '.svg', '.txt', '.xml')
+
+
+def precompress_files(static_dir, minimum_size=500):
+    """
+    Write a gzipped `.gz` copy next to each compressible file in `static_dir`
+    that lacks an up to date one, for `whitenoise` to serve to clients that
+    accept gzip. Files that can't be written next to are left as they are.
+    """
+    for root, dirs, files in os.walk(static_dir):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            gz_path = path + '.gz'
+            stat = os.stat(path)
+            if stat.st_size < minimum_size:
+                continue
+            if os.path.exists(gz_path) and os.stat(gz_path).st_mtime >= stat.st_mtime:
+                continue
+
+            with open(path, 'rb') as source:
+                data = source.read()
+            try:
+                fd, tmp_path = tempfile.mkstemp(dir=root, prefix='.' + name)
+            except OSError:
+                continue
+            with os.fdopen(fd, 'wb') as target:
+                with gzip.GzipFile(name, 'wb', 9, target, mtime=0) as compressed:
+                    compressed.write(data)
+                compressed_size = target.tell()
+            if compressed_size < stat.st_size * 0.95:
+                os.chmod(tmp_path, stat.st_mode & 0o777)
+                os.replace(tmp_path, gz_path)
+            else:
+                os.remove(tmp_path)
 
 
 class BaseStaticFiles():
@@ -12,10 +53,17 @@ class BaseStaticFiles():
 class StaticFiles(BaseStaticFiles):
     """
     Static file handling for WSGI applications, using `whitenoise`.
+
+    With `precompress`, gzipped copies of the files are written into
+    `static_dir` at startup and served instead of compressing on every
+    request. It is off by default, since `static_dir` may be read-only or
+    part of an installed package.
     """
 
-    def __init__(self, prefix, static_dir=None):
+    def __init__(self, prefix, static_dir=None, precompress=False):
         self.check_requirements()
+        if precompress:
+            precompress_files(static_dir)
         self.whitenoise = whitenoise.WhiteNoise(application=self.not_found)
         self.whitenoise.add_files(static_dir, prefix=prefix)
 
@@ -32,13 +80,11 @@ class StaticFiles(BaseStaticFiles):
 
 class ASyncStaticFiles(StaticFiles):
     """
-    Static file handling for ASGI applications, using `whitenoise` and `aiofiles`.
+    Static file handling for ASGI applications, using `whitenoise`.
     """
     def check_requirements(self):
         if whitenoise is None:
             raise RuntimeError('`whitenoise` must be installed to use `ASyncStaticFiles`.')
-        if aiofiles is None:
-            raise RuntimeError('`aiofiles` must be installed to use `ASyncStaticFiles`.')
 
     def __call__(self, scope):
         path = scope['path'].encode('iso-8859-1', 'replace').decode('utf-8', 'replace')
@@ -65,47 +111,24 @@ class ASGIFileSession():
             self.headers[wsgi_key] = wsgi_value
 
     async def __call__(self, receive, send):
-        status, headers, file = await self.get_response(self.scope['method'], self.headers)
+        # `whitenoise` opens the file with a plain blocking `open()`, which
+        # is cheap next to sending it.
+        response = self.static_file.get_response(self.scope['method'], self.headers)
         await send({
             'type': 'http.response.start',
-            'status': status.value,
+            'status': response.status.value,
             'headers': [
                 (key.lower().encode(), value.encode())
-                for key, value in headers
+                for key, value in response.headers
             ]
         })
-        if file is None:
+        if response.file is None:
             await send({
                 'type': 'http.response.body',
                 'body': b''
             })
         else:
-            chunk = await file.read(8192)
-            more_body = True
-
-            while more_body:
-                next_chunk = await file.read(8192)
-                more_body = bool(next_chunk)
-
-                await send({
-                    'type': 'http.response.body',
-                    'body': chunk,
-                    'more_body': more_body
-                })
-                chunk = next_chunk
-
-    async def get_response(self, method, request_headers):
-        if method != 'GET' and method != 'HEAD':
-            return (
-                HTTPStatus.METHOD_NOT_ALLOWED,
-                (('Allow', 'GET, HEAD'),),
-                None
-            )
-        elif self.static_file.file_not_modified(request_headers):
-            return self.static_file.not_modified_response
-        path, headers = self.static_file.get_path_and_headers(request_headers)
-        if method != 'HEAD':
-            file_handle = await aiofiles.open(path, 'rb')
-        else:
-            file_handle = None
-        return (HTTPStatus.OK, headers, file_handle)
+            try:
+                await send_file(self.scope, send, response.file)
+            finally:
+                response.file.close()
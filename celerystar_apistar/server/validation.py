@@ -2,7 +2,7 @@ import inspect
 import typing
 
 from celerystar_apistar import codecs, exceptions, http, types, validators
-from celerystar_apistar.conneg import negotiate_content_type
+from celerystar_apistar.conneg import CodecTable
 from celerystar_apistar.server.components import Component
 from celerystar_apistar.server.core import Route
 
@@ -12,8 +12,8 @@ ValidatedRequestData = typing.TypeVar('ValidatedRequestData')
 
 
 class RequestDataComponent(Component):
-    def __init__(self):
-        self.codecs = [codecs.JSONCodec()]
+    def __init__(self, supported_codecs=None):
+        self.codecs = CodecTable(supported_codecs or [codecs.JSONCodec()])
 
     def can_handle_parameter(self, parameter: inspect.Parameter):
         return parameter.annotation is http.RequestData
@@ -27,7 +27,7 @@ class RequestDataComponent(Component):
         content_type = headers.get('Content-Type')
 
         try:
-            codec = negotiate_content_type(self.codecs, content_type)
+            codec = self.codecs.negotiate_content_type(content_type)
         except exceptions.NoCodecAvailable:
             raise exceptions.UnsupportedMediaType()
 
@@ -41,18 +41,8 @@ class ValidatePathParamsComponent(Component):
     def resolve(self,
                 route: Route,
                 path_params: http.PathParams) -> ValidatedPathParams:
-        path_fields = route.link.get_path_fields()
-
-        validator = validators.Object(
-            properties=[
-                (field.name, field.schema if field.schema else validators.Any())
-                for field in path_fields
-            ],
-            required=[field.name for field in path_fields]
-        )
-
         try:
-            path_params = validator.validate(path_params, allow_coerce=True)
+            path_params = route.path_params_validator.validate(path_params, allow_coerce=True)
         except validators.ValidationError as exc:
             raise exceptions.NotFound(exc.detail)
         return ValidatedPathParams(path_params)
@@ -62,18 +52,8 @@ class ValidateQueryParamsComponent(Component):
     def resolve(self,
                 route: Route,
                 query_params: http.QueryParams) -> ValidatedQueryParams:
-        query_fields = route.link.get_query_fields()
-
-        validator = validators.Object(
-            properties=[
-                (field.name, field.schema if field.schema else validators.Any())
-                for field in query_fields
-            ],
-            required=[field.name for field in query_fields if field.required]
-        )
-
         try:
-            query_params = validator.validate(query_params, allow_coerce=True)
+            query_params = route.query_params_validator.validate(query_params, allow_coerce=True)
         except validators.ValidationError as exc:
             raise exceptions.BadRequest(exc.detail)
         return ValidatedQueryParams(query_params)
@@ -86,7 +66,7 @@ class ValidateRequestDataComponent(Component):
     def resolve(self,
                 route: Route,
                 data: http.RequestData):
-        body_field = route.link.get_body_field()
+        body_field = route.body_field
 
         if not body_field or not body_field.schema:
             return data
@@ -100,17 +80,24 @@ class ValidateRequestDataComponent(Component):
 
 
 class PrimitiveParamComponent(Component):
+    def __init__(self):
+        self.validators = {}
+
     def can_handle_parameter(self, parameter: inspect.Parameter):
         return parameter.annotation in (str, int, float, bool, parameter.empty)
 
-    def resolve(self,
-                parameter: inspect.Parameter,
-                path_params: ValidatedPathParams,
-                query_params: ValidatedQueryParams):
-        params = path_params if (parameter.name in path_params) else query_params
+    def get_validator(self, parameter: inspect.Parameter):
         has_default = parameter.default is not parameter.empty
         allow_null = parameter.default is None
 
+        # The validator only depends on these, so it is built once for each
+        # distinct parameter, rather than once per request.
+        key = (parameter.name, parameter.annotation, has_default, allow_null)
+        try:
+            return self.validators[key]
+        except KeyError:
+            pass
+
         param_validator = {
             parameter.empty: validators.Any(),
             str: validators.String(allow_null=allow_null),
@@ -123,6 +110,15 @@ class PrimitiveParamComponent(Component):
             properties=[(parameter.name, param_validator)],
             required=[] if has_default else [parameter.name]
         )
+        self.validators[key] = validator
+        return validator
+
+    def resolve(self,
+                parameter: inspect.Parameter,
+                path_params: ValidatedPathParams,
+                query_params: ValidatedQueryParams):
+        params = path_params if (parameter.name in path_params) else query_params
+        validator = self.get_validator(parameter)
 
         try:
             params = validator.validate(params, allow_coerce=True)
@@ -131,6 +127,31 @@ class PrimitiveParamComponent(Component):
         return params.get(parameter.name, parameter.default)
 
 
+class StreamedArrayParamComponent(Component):
+    """
+    Handles parameters annotated with an `Array` instance, providing the
+    request body items as a generator that validates them one at a time.
+    """
+    def identity(self, parameter: inspect.Parameter):
+        return 'streamedarray:' + parameter.name.lower()
+
+    def can_handle_parameter(self, parameter: inspect.Parameter):
+        return isinstance(parameter.annotation, validators.Array)
+
+    def resolve(self,
+                parameter: inspect.Parameter,
+                data: http.RequestDataStream):
+        return self.validate_items(parameter.annotation, data)
+
+    def validate_items(self, validator, data):
+        try:
+            yield from validator.validate_iter(data, allow_coerce=True)
+        except exceptions.ParseError as exc:
+            raise exceptions.BadRequest(str(exc))
+        except validators.ValidationError as exc:
+            raise exceptions.BadRequest(exc.detail)
+
+
 class CompositeParamComponent(Component):
     def can_handle_parameter(self, parameter: inspect.Parameter):
         return issubclass(parameter.annotation, types.Type)
@@ -150,5 +171,6 @@ VALIDATION_COMPONENTS = (
     ValidateQueryParamsComponent(),
     ValidateRequestDataComponent(),
     PrimitiveParamComponent(),
+    StreamedArrayParamComponent(),
     CompositeParamComponent()
 )
@@ -1,12 +1,12 @@
 import typing
 from http import HTTPStatus
 from inspect import Parameter
-from urllib.parse import parse_qsl
 from wsgiref.util import request_uri
 
 from werkzeug.wsgi import get_input_stream
 
-from celerystar_apistar import http
+from celerystar_apistar import codecs, exceptions, http
+from celerystar_apistar.conneg import CodecTable
 from celerystar_apistar.server.components import Component
 
 WSGIEnviron = typing.NewType('WSGIEnviron', dict)
@@ -22,6 +22,57 @@ RESPONSE_STATUS_TEXT.update({
 })
 
 
+class EnvironHeaders(http.Headers):
+    """
+    A read-only `Headers` view over a WSGI environ.
+
+    Lookups read the matching environ key directly, and the full list of
+    headers is only built when it is needed.
+    """
+
+    def __init__(self, environ: WSGIEnviron) -> None:
+        self.environ = environ
+
+    def __getattr__(self, name):
+        if name in ('_items', '_index', '_repeated'):
+            http.Headers.__init__(self, self.environ_items())
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def environ_items(self):
+        header_items = []
+        for key, value in self.environ.items():
+            if key.startswith('HTTP_'):
+                header = (key[5:].lower().replace('_', '-'), value)
+                header_items.append(header)
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                header = (key.lower().replace('_', '-'), value)
+                header_items.append(header)
+        return header_items
+
+    def environ_key(self, key: str) -> str:
+        key = key.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            return key
+        return 'HTTP_' + key
+
+    def get_list(self, key: str) -> typing.List[str]:
+        value = self.environ.get(self.environ_key(key))
+        return [] if value is None else [value]
+
+    def get(self, key: str, default: str=None):
+        return self.environ.get(self.environ_key(key), default)
+
+    def __getitem__(self, key: str):
+        try:
+            return self.environ[self.environ_key(key)]
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key: str):
+        return self.environ_key(key) in self.environ
+
+
 class MethodComponent(Component):
     def resolve(self,
                 environ: WSGIEnviron) -> http.Method:
@@ -69,48 +120,93 @@ class QueryStringComponent(Component):
 class QueryParamsComponent(Component):
     def resolve(self,
                 environ: WSGIEnviron) -> http.QueryParams:
-        query_string = environ.get('QUERY_STRING', '')
-        return http.QueryParams(parse_qsl(query_string))
+        return http.QueryStringParams(environ.get('QUERY_STRING', ''))
 
 
 class QueryParamComponent(Component):
     def resolve(self,
                 parameter: Parameter,
                 query_params: http.QueryParams) -> http.QueryParam:
-        name = parameter.name
-        if name not in query_params:
+        value = query_params.get(parameter.name)
+        if value is None:
             return None
-        return http.QueryParam(query_params[name])
+        return http.QueryParam(value)
 
 
 class HeadersComponent(Component):
     def resolve(self,
                 environ: WSGIEnviron) -> http.Headers:
-        header_items = []
-        for key, value in environ.items():
-            if key.startswith('HTTP_'):
-                header = (key[5:].lower().replace('_', '-'), value)
-                header_items.append(header)
-            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
-                header = (key.lower().replace('_', '-'), value)
-                header_items.append(header)
-        return http.Headers(header_items)
+        return EnvironHeaders(environ)
 
 
 class HeaderComponent(Component):
     def resolve(self,
                 parameter: Parameter,
                 headers: http.Headers) -> http.Header:
-        name = parameter.name.replace('_', '-')
-        if name not in headers:
+        value = headers.get(parameter.name.replace('_', '-'))
+        if value is None:
             return None
-        return http.Header(headers[name])
+        return http.Header(value)
+
+
+class BodyStreamComponent(Component):
+    """
+    Reads the request body lazily, in chunks of `chunk_size` bytes.
+
+    Bodies over `max_body_size` bytes are rejected with a 413, up front
+    when the request has a Content-Length, or else once that much has
+    been read.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, max_body_size: int=None) -> None:
+        self.max_body_size = max_body_size
+
+    def resolve(self,
+                environ: WSGIEnviron) -> http.BodyStream:
+        max_body_size = self.max_body_size
+        if max_body_size is not None:
+            try:
+                content_length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                raise exceptions.BadRequest('Invalid Content-Length header')
+            if content_length > max_body_size:
+                raise exceptions.PayloadTooLarge()
+        return http.BodyStream(self.iter_chunks(get_input_stream(environ)))
+
+    def iter_chunks(self, stream):
+        size = 0
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if self.max_body_size is not None and size > self.max_body_size:
+                raise exceptions.PayloadTooLarge()
+            yield chunk
 
 
 class BodyComponent(Component):
     def resolve(self,
-                environ: WSGIEnviron) -> http.Body:
-        return http.Body(get_input_stream(environ).read())
+                stream: http.BodyStream) -> http.Body:
+        return http.Body(b''.join(stream))
+
+
+class RequestDataStreamComponent(Component):
+    def __init__(self, supported_codecs=None):
+        self.codecs = CodecTable(supported_codecs or [codecs.JSONCodec()])
+
+    def resolve(self,
+                stream: http.BodyStream,
+                headers: http.Headers) -> http.RequestDataStream:
+        content_type = headers.get('Content-Type')
+
+        try:
+            codec = self.codecs.negotiate_content_type(content_type)
+        except exceptions.NoCodecAvailable:
+            raise exceptions.UnsupportedMediaType()
+
+        return http.RequestDataStream(codec.decode_stream(stream))
 
 
 class RequestComponent(Component):
@@ -134,6 +230,8 @@ WSGI_COMPONENTS = (
     QueryParamComponent(),
     HeadersComponent(),
     HeaderComponent(),
+    BodyStreamComponent(),
     BodyComponent(),
+    RequestDataStreamComponent(),
     RequestComponent()
 )
@@ -121,7 +121,7 @@ class _ASGIAdapter(requests.adapters.HTTPAdapter):
 
         # Include other request headers.
         headers += [
-            [key.encode(), value.encode()]
+            [key.lower().encode(), value.encode()]
             for key, value in request.headers.items()
         ]
 
@@ -162,17 +162,20 @@ class _ASGIAdapter(requests.adapters.HTTPAdapter):
                 raw_kwargs['preload_content'] = False
                 raw_kwargs['original_response'] = _MockOriginalResponse(raw_kwargs['headers'])
             elif message['type'] == 'http.response.body':
-                raw_kwargs['body'] = io.BytesIO(message['body'])
+                body.write(message['body'])
             elif message['type'] == 'http.disconnect':
                 pass
             else:
                 raise Exception("Unknown ASGI message type: %s" % message['type'])
 
         raw_kwargs = {}
+        body = io.BytesIO()
         connection = self.app(scope)
 
         loop = asyncio.get_event_loop()
         loop.run_until_complete(connection(receive, send))
+        body.seek(0)
+        raw_kwargs['body'] = body
 
         raw = requests.packages.urllib3.HTTPResponse(**raw_kwargs)
         return self.build_response(request, raw)
@@ -470,25 +470,7 @@ class Array(Validator):
 
         for pos, item in enumerate(value):
             try:
-                if isinstance(self.items, list):
-                    if pos < len(self.items):
-                        item = self.items[pos].validate(
-                            item,
-                            definitions=definitions,
-                            allow_coerce=allow_coerce
-                        )
-                    elif isinstance(self.additional_items, Validator):
-                        item = self.additional_items.validate(
-                            item,
-                            definitions=definitions,
-                            allow_coerce=allow_coerce
-                        )
-                elif self.items is not None:
-                    item = self.items.validate(
-                        item,
-                        definitions=definitions,
-                        allow_coerce=allow_coerce
-                    )
+                item = self.validate_item(pos, item, definitions, allow_coerce)
 
                 if self.unique_items:
                     if item in seen_items:
@@ -505,6 +487,65 @@ class Array(Validator):
 
         return validated
 
+    def validate_item(self, pos, item, definitions=None, allow_coerce=False):
+        if isinstance(self.items, list):
+            if pos < len(self.items):
+                return self.items[pos].validate(
+                    item,
+                    definitions=definitions,
+                    allow_coerce=allow_coerce
+                )
+            elif isinstance(self.additional_items, Validator):
+                return self.additional_items.validate(
+                    item,
+                    definitions=definitions,
+                    allow_coerce=allow_coerce
+                )
+        elif self.items is not None:
+            return self.items.validate(
+                item,
+                definitions=definitions,
+                allow_coerce=allow_coerce
+            )
+        return item
+
+    def validate_iter(self, value, definitions=None, allow_coerce=False):
+        """
+        Lazily validate an iterable of items, yielding each one as soon as it
+        has been validated. The first invalid item raises a `ValidationError`,
+        so only a single item needs to be held in memory at a time.
+        """
+        definitions = self.get_definitions(definitions)
+        exact_items = self.min_items is not None and self.min_items == self.max_items
+        if self.unique_items:
+            seen_items = Uniqueness()
+
+        count = 0
+        for pos, item in enumerate(value):
+            if self.max_items is not None and pos >= self.max_items:
+                self.error('exact_items' if exact_items else 'max_items')
+            elif isinstance(self.items, list) and (self.additional_items is False) and pos >= len(self.items):
+                self.error('additional_items')
+
+            try:
+                item = self.validate_item(pos, item, definitions, allow_coerce)
+                if self.unique_items:
+                    if item in seen_items:
+                        self.error('unique_items')
+                    seen_items.add(item)
+            except ValidationError as exc:
+                raise ValidationError({pos: exc.detail}) from None
+
+            count = pos + 1
+            yield item
+
+        if exact_items and count != self.min_items:
+            self.error('exact_items')
+        if self.min_items is not None and count < self.min_items:
+            if self.min_items == 1:
+                self.error('empty')
+            self.error('min_items')
+
 
 class Date(String):
     def __init__(self, **kwargs):
@@ -125,7 +125,7 @@ def test_base_service_validate_celery_app(_):
 
 @make_base_build_task_patch
 def test_base_service_validate_apply_options(_):
-    with raises(cs.ConfigurationError, match="only json is supported"):
+    with raises(cs.ConfigurationError, match="only json and msgpack are supported"):
         cs.BaseService._validate_apply_options({'serializer': 'pickle'})
 
 
@@ -306,6 +306,7 @@ def test_make_injector():
 
 
 def test_make_wsgi_app():
+    from celerystar_apistar.server.router import Router, TreeRouter
 
     class InitialState(cs.Type):
         init_int = cs.Integer()
@@ -333,6 +334,9 @@ def test_make_wsgi_app():
     srv1 = cs.make_service(task1, components, InitialState, app)
     srv2 = cs.make_service(task2, components, InitialState, app)
     wsgi_app = cs.make_wsgi_app([srv2, srv1])
+    assert type(wsgi_app.router) is Router
+    assert isinstance(cs.make_wsgi_app([srv1], router_class=TreeRouter).router,
+                      TreeRouter)
 
     client = TestClient(wsgi_app)
 
@@ -373,3 +377,1579 @@ def test_make_wsgi_app():
     })
     assert ret.status_code == 200
     assert ret.json() == result_id
+
+
+def test_json_codec_decode_stream():
+    from celerystar_apistar.codecs import JSONCodec
+    from celerystar_apistar.exceptions import ParseError
+
+    content = b'[1, 22.5e+1, "\xc3\xa9", {"a": [1, null]}, true, 345]'
+    for size in range(1, len(content) + 1):
+        chunks = [content[i:i + size] for i in range(0, len(content), size)]
+        items = list(JSONCodec().decode_stream(chunks))
+        assert items == [1, 225.0, '\xe9', {'a': [1, None]}, True, 345]
+
+    for content in [b'{}', b'[1,]', b'[1 2]', b'[1] 2', b'[1, 2']:
+        with raises(ParseError):
+            list(JSONCodec().decode_stream([content]))
+
+
+def test_array_validate_iter():
+    validator = cs.Array(items=cs.Integer(), max_items=3, min_items=2)
+    assert list(validator.validate_iter(iter([1, 2]))) == [1, 2]
+
+    items = validator.validate_iter(iter([1, 'a']))
+    assert next(items) == 1
+    with raises(cs.ValidationError) as exc:
+        next(items)
+    assert exc.value.detail == {1: 'Must be a number.'}
+
+    with raises(cs.ValidationError, match='no more than 3'):
+        list(validator.validate_iter(iter([1, 2, 3, 4])))
+    with raises(cs.ValidationError, match='at least 2'):
+        list(validator.validate_iter(iter([1])))
+
+
+def test_streamed_array_param():
+    def total(items: cs.Array(items=cs.Integer())):
+        return sum(items)
+
+    client = TestClient(cs.App(routes=[cs.Route('/total', 'POST', total)]))
+
+    ret = client.post('/total', data=b'[1, 2, 3]')
+    assert ret.status_code == 200
+    assert ret.json() == 6
+
+    ret = client.post('/total', data=b'[1, "a"]')
+    assert ret.status_code == 400
+    assert ret.json() == {'1': 'Must be a number.'}
+
+    ret = client.post('/total', data=b'[1, 2')
+    assert ret.status_code == 400
+
+
+def test_tree_router():
+    from celerystar_apistar import exceptions
+    from celerystar_apistar.server.router import Router, TreeRouter
+
+    def handler():
+        pass
+
+    def int_handler(id: int):
+        pass
+
+    def str_handler(name: str):
+        pass
+
+    def path_handler(filename: str):
+        pass
+
+    routes = [
+        cs.Route('/schema/', 'GET', handler, name='schema'),
+        cs.Route('/users/me', 'GET', handler, name='me'),
+        cs.Route('/users/{id}', 'GET', int_handler),
+        cs.Route('/users/{name}', 'GET', str_handler),
+        cs.Route('/users/{name}', 'POST', str_handler, name='post'),
+        cs.Route('/files/{name}.json', 'GET', str_handler, name='json'),
+        cs.Route('/static/{+filename}', 'GET', path_handler),
+    ]
+
+    def lookup(router, path, method):
+        try:
+            route, path_params = router.lookup(path, method)
+            return route.name, path_params
+        except exceptions.HTTPException as exc:
+            return exc.__class__.__name__
+
+    router, tree_router = Router(routes), TreeRouter(routes)
+    for path in ['/schema/', '/schema', '/users/me', '/users/1', '/users/a',
+                 '/users/', '/files/a.json', '/files/a', '/static/a/b.js',
+                 '/static/', '/missing']:
+        for method in ['GET', 'POST', 'PUT']:
+            assert lookup(tree_router, path, method) == lookup(router, path, method)
+
+    assert tree_router.reverse_url('int_handler', id=1) == '/users/1'
+    assert tree_router.reverse_url('path_handler', filename='a b/c.js') == \
+        '/static/a%20b/c.js'
+    with raises(exceptions.NoReverseMatch):
+        tree_router.reverse_url('int_handler')
+
+
+def test_lru_cache():
+    from celerystar_apistar.cache import LRUCache
+
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert cache.stats() == {
+        'hits': 2, 'misses': 1, 'evictions': 1, 'size': 2, 'maxsize': 2
+    }
+
+
+def test_router_caches_static_routes_only():
+    from concurrent.futures import ThreadPoolExecutor
+    from celerystar_apistar.server.router import Router
+
+    def handler():
+        pass
+
+    def item_handler(id: int):
+        pass
+
+    router = Router([
+        cs.Route('/items', 'GET', handler),
+        cs.Route('/items/{id}', 'GET', item_handler),
+    ], lookup_cache_size=10)
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda idx: router.lookup('/items/%d' % idx, 'GET'),
+                          range(100)))
+        list(executor.map(lambda idx: router.lookup('/items', 'GET'),
+                          range(100)))
+
+    stats = router.lookup_cache.stats()
+    assert stats['size'] == 1
+    assert stats['evictions'] == 0
+    assert stats['hits'] + stats['misses'] == 200
+    assert router.lookup('/items/3', 'GET')[1] == {'id': 3}
+
+
+def test_route_precompiled_validators():
+    import inspect
+    from celerystar_apistar.server.validation import PrimitiveParamComponent
+
+    def handler(id: int, limit: int=10, name: str=None):
+        return {'id': id, 'limit': limit, 'name': name}
+
+    route = cs.Route('/items/{id}', 'GET', handler)
+    assert route.path_params_validator.validate({'id': '1'}, allow_coerce=True) == {'id': 1}
+    assert route.query_params_validator.validate({}) == {'limit': 10, 'name': None}
+
+    component = PrimitiveParamComponent()
+    parameters = inspect.signature(handler).parameters
+    validator = component.get_validator(parameters['limit'])
+    assert component.get_validator(parameters['limit']) is validator
+
+    client = TestClient(cs.App(routes=[route]))
+    assert client.get('/items/1?limit=5').json() == {'id': 1, 'limit': 5, 'name': None}
+    assert client.get('/items/1?limit=a').status_code == 400
+
+
+def test_app_warm_up():
+    def handler(id: int):
+        return id
+
+    app = cs.App(routes=[cs.Route('/items/{id}', 'GET', handler)])
+    assert not app.injector.resolver_cache
+    app.warm_up()
+
+    route = app.router.lookup('/items/1', 'GET')[0]
+    assert tuple(app.get_route_functions(route)) in app.injector.resolver_cache
+    assert tuple(app.on_error_functions) in app.injector.resolver_cache
+
+
+def test_prefork_server():
+    import json
+    import os
+    import signal
+    import socket
+    import subprocess
+    import sys
+    import time
+    import urllib.request
+
+    script = '\n'.join([
+        'import os, sys',
+        'from celerystar_apistar import App, Route',
+        'from celerystar_apistar.server.prefork import PreforkServer',
+        'def pid():',
+        '    return {"pid": os.getpid()}',
+        'app = App(routes=[Route("/pid", "GET", pid)])',
+        'PreforkServer(app, "127.0.0.1", int(sys.argv[1]), workers=1,',
+        '              graceful_timeout=5).serve_forever()',
+    ])
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    master = subprocess.Popen([sys.executable, '-c', script, str(port)],
+                              stderr=subprocess.DEVNULL)
+
+    def wait_for_worker(old_pid=None):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/pid',
+                                            timeout=1) as response:
+                    pid = json.loads(response.read())['pid']
+                if pid != old_pid:
+                    return pid
+            except OSError:
+                pass
+            time.sleep(0.05)
+        raise AssertionError('no worker served the request')
+
+    try:
+        pid = wait_for_worker()
+        assert pid != master.pid
+
+        # SIGHUP replaces the worker, a dead worker is respawned.
+        master.send_signal(signal.SIGHUP)
+        pid = wait_for_worker(pid)
+        os.kill(pid, signal.SIGKILL)
+        pid = wait_for_worker(pid)
+
+        master.send_signal(signal.SIGTERM)
+        assert master.wait(10) == 0
+        with raises(ProcessLookupError):
+            os.kill(pid, 0)
+    finally:
+        if master.poll() is None:
+            master.kill()
+            master.wait()
+
+
+def test_prefork_respawn_backoff():
+    import time
+    from celerystar_apistar.server.prefork import PreforkServer
+
+    server = PreforkServer(None, '127.0.0.1', 0, workers=1)
+    server.running = True
+    pids = iter(range(100, 200))
+
+    def spawn_worker():
+        pid = next(pids)
+        server.workers[pid] = server.generation
+        server.started[pid] = time.monotonic()
+
+    def crash(pid, options):
+        # Every worker dies right after starting.
+        return (next(iter(server.workers)), 256) if server.workers else (0, 0)
+
+    with patch.object(server, 'spawn_worker', side_effect=spawn_worker), \
+            patch('os.waitpid', side_effect=crash):
+        server.spawn_workers()
+        delays = []
+        for _ in range(4):
+            server.reap_workers()
+            assert not server.workers
+            delays.append(server.respawn_at - time.monotonic())
+            server.respawn_at = 0
+            server.reap_workers()
+            assert len(server.workers) == 1
+        assert server.failures == 4
+        assert all(0.5 * delay < later < 2.5 * delay
+                   for delay, later in zip(delays, delays[1:]))
+
+        # A worker that lived long enough resets the backoff.
+        pid, = server.workers
+        server.started[pid] -= 10
+        server.reap_workers()
+        assert server.failures == 0 and len(server.workers) == 1
+
+
+def test_async_app_serve_options():
+    from celerystar_apistar import ASyncApp
+    from celerystar_apistar.server.adapters import ASGItoWSGIAdapter
+    from celerystar_apistar.server.aioserver import ASGIServer
+
+    app = ASyncApp(routes=[])
+    with patch('werkzeug.run_simple') as run_simple:
+        app.serve('127.0.0.1', 8080, use_reloader=True, use_debugger=True)
+    (host, port, wsgi), options = run_simple.call_args
+    assert isinstance(wsgi, ASGItoWSGIAdapter) and wsgi.asgi is app
+    assert options == {'use_reloader': True, 'use_debugger': True}
+
+    with patch.object(ASGIServer, 'serve_forever') as serve_forever:
+        app.serve('127.0.0.1', 8080, keepalive_timeout=1)
+    assert serve_forever.called
+
+
+def test_asgi_server_keep_alive():
+    import asyncio
+    from celerystar_apistar import ASyncApp, http
+    from celerystar_apistar.server.aioserver import ASGIServer
+
+    async def echo(body: http.Body):
+        return len(body)
+
+    app = ASyncApp(routes=[cs.Route('/echo', 'POST', echo)])
+    server = ASGIServer(app, '127.0.0.1', 0)
+
+    async def main():
+        await server.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(b'POST /echo HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc'
+                     b'POST /echo HTTP/1.1\r\nTransfer-Encoding: chunked\r\n'
+                     b'Connection: close\r\n\r\n2\r\nab\r\n0\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        await server.shutdown()
+        return response
+
+    response = asyncio.new_event_loop().run_until_complete(main())
+    assert response.count(b'HTTP/1.1 200 OK') == 2
+    assert response.endswith(b'\r\n\r\n2')
+    assert b'connection: close' in response
+
+
+def test_streaming_response():
+    import asyncio
+    from celerystar_apistar import ASyncApp, TestClient, http
+    from celerystar_apistar.server.aioserver import ASGIServer
+
+    def sync_chunks():
+        yield 'a'
+        yield b'b'
+
+    async def async_chunks():
+        yield b'c'
+        await asyncio.sleep(0)
+        yield 'd'
+
+    def sync_handler():
+        return http.StreamingResponse(sync_chunks())
+
+    def async_handler():
+        return http.StreamingResponse(async_chunks())
+
+    routes = [
+        cs.Route('/sync', 'GET', sync_handler),
+        cs.Route('/async', 'GET', async_handler),
+    ]
+    for app in (cs.App(routes=routes), ASyncApp(routes=routes)):
+        client = TestClient(app)
+        for path, content in (('/sync', b'ab'), ('/async', b'cd')):
+            response = client.get(path)
+            assert response.content == content
+            assert 'content-length' not in response.headers
+
+    server = ASGIServer(ASyncApp(routes=routes), '127.0.0.1', 0)
+
+    async def main():
+        await server.start()
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(b'GET /async HTTP/1.1\r\nConnection: close\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        await server.shutdown()
+        return response
+
+    response = asyncio.new_event_loop().run_until_complete(main())
+    assert b'transfer-encoding: chunked' in response
+    assert response.endswith(b'\r\n\r\n1\r\nc\r\n1\r\nd\r\n0\r\n\r\n')
+
+
+def test_body_stream_max_body_size():
+    import asyncio
+    import io
+    from celerystar_apistar import ASyncApp, TestClient, http
+
+    def count(stream: http.BodyStream):
+        return [len(chunk) for chunk in stream]
+
+    async def async_count(stream: http.BodyStream):
+        return [len(chunk) async for chunk in stream]
+
+    def echo(body: http.Body):
+        return body.decode()
+
+    for app_class, handler in ((cs.App, count), (ASyncApp, async_count)):
+        app = app_class(routes=[
+            cs.Route('/count', 'POST', handler),
+            cs.Route('/echo', 'POST', echo),
+        ], max_body_size=100)
+        client = TestClient(app)
+        assert client.post('/count', data=b'x' * 100).json() == [100]
+        assert client.post('/echo', data=b'abc').text == 'abc'
+        response = client.post('/echo', data=b'x' * 101)
+        assert response.status_code == 413
+
+    # Without a Content-Length the limit applies while reading.
+    app = cs.App(routes=[cs.Route('/count', 'POST', count)], max_body_size=100)
+    environ = {
+        'REQUEST_METHOD': 'POST',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/count',
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(b'x' * 101),
+        'wsgi.input_terminated': True,
+    }
+    statuses = []
+    app(environ, lambda status, headers: statuses.append(status))
+    assert statuses == ['413 Request Entity Too Large']
+
+
+def test_file_response(tmpdir):
+    import asyncio
+    import io
+    from wsgiref.util import FileWrapper
+    from celerystar_apistar import ASyncApp, TestClient, http
+    from celerystar_apistar.server.aioserver import ASGIServer
+
+    path = tmpdir.join('result.txt')
+    path.write(b'x' * 100000 + b'end', mode='wb')
+    tmpdir.mkdir('static').join('app.js').write(b'alert(1)', mode='wb')
+
+    def result():
+        return http.FileResponse(str(path))
+
+    routes = [cs.Route('/result', 'GET', result)]
+    for app in (cs.App(routes=routes), ASyncApp(routes=routes)):
+        response = TestClient(app).get('/result')
+        assert response.content == b'x' * 100000 + b'end'
+        assert response.headers['content-length'] == '100003'
+        assert response.headers['content-type'] == 'text/plain'
+
+    app = cs.App(routes=routes)
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': '/result',
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(),
+        'wsgi.file_wrapper': FileWrapper,
+    }
+    wrapper = app(environ, lambda status, headers: None)
+    assert isinstance(wrapper, FileWrapper)
+    assert b''.join(wrapper).endswith(b'end')
+    wrapper.close()
+
+    app = ASyncApp(routes=routes, static_dir=str(tmpdir.join('static')))
+    server = ASGIServer(app, '127.0.0.1', 0)
+
+    async def fetch(path):
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(b'GET %s HTTP/1.1\r\nConnection: close\r\n\r\n' % path)
+        response = await reader.read()
+        writer.close()
+        return response
+
+    async def main():
+        await server.start()
+        responses = [await fetch(b'/result'), await fetch(b'/static/app.js')]
+        await server.shutdown()
+        return responses
+
+    result_response, static_response = asyncio.new_event_loop().run_until_complete(main())
+    assert result_response.startswith(b'HTTP/1.1 200 OK')
+    assert result_response.endswith(b'\r\n\r\n' + b'x' * 100000 + b'end')
+    assert static_response.endswith(b'\r\n\r\nalert(1)')
+
+
+def test_compression_hook():
+    import gzip
+    import zlib
+    from celerystar_apistar import ASyncApp, TestClient, http
+    from celerystar_apistar.server.compression import CompressionHook, negotiate_encoding
+
+    assert negotiate_encoding('gzip, deflate') == 'gzip'
+    assert negotiate_encoding('deflate;q=1, gzip;q=0.5') == 'deflate'
+    assert negotiate_encoding('gzip;q=0, *') == 'deflate'
+    assert negotiate_encoding('br, identity') is None
+
+    def large():
+        return {'items': list(range(1000))}
+
+    def small():
+        return {'items': []}
+
+    def stream():
+        return http.StreamingResponse(
+            ('%d\n' % idx for idx in range(1000)),
+            headers={'Content-Type': 'text/plain'}
+        )
+
+    routes = [
+        cs.Route('/large', 'GET', large),
+        cs.Route('/small', 'GET', small),
+        cs.Route('/stream', 'GET', stream),
+    ]
+    for app_class in (cs.App, ASyncApp):
+        client = TestClient(app_class(routes=routes, event_hooks=[CompressionHook()]))
+
+        # `requests` transparently decodes the body.
+        response = client.get('/large', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert response.json() == large()
+        assert int(response.headers['content-length']) < len(response.content)
+
+        response = client.get('/large', headers={'Accept-Encoding': 'identity'})
+        assert 'content-encoding' not in response.headers
+        assert response.json() == large()
+
+        response = client.get('/small', headers={'Accept-Encoding': 'gzip'})
+        assert 'content-encoding' not in response.headers
+
+        response = client.get('/stream', headers={'Accept-Encoding': 'deflate'},
+                              stream=True)
+        assert response.headers['content-encoding'] == 'deflate'
+        assert 'content-length' not in response.headers
+        raw = response.raw.read(decode_content=False)
+        assert zlib.decompress(raw) == b''.join(b'%d\n' % idx for idx in range(1000))
+
+    hook = CompressionHook()
+    chunks = list(hook.compress_stream(iter([b'abc', b'def']), 'gzip'))
+    assert gzip.decompress(b''.join(chunks)) == b'abcdef'
+    # Every chunk is flushed as soon as it is produced.
+    assert zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(chunks[0]) == b'abc'
+
+
+def test_precompressed_static_files(tmpdir):
+    import gzip
+    from celerystar_apistar import TestClient
+
+    static_dir = tmpdir.mkdir('static')
+    static_dir.join('app.js').write('var x = 1;\n' * 1000)
+    static_dir.join('tiny.js').write('var x = 1;\n')
+
+    cs.App(routes=[], static_dir=str(static_dir))
+    assert not static_dir.join('app.js.gz').check()
+
+    app = cs.App(routes=[], static_dir=str(static_dir), precompress_static=True)
+    assert static_dir.join('app.js.gz').check()
+    assert not static_dir.join('tiny.js.gz').check()
+    assert gzip.decompress(static_dir.join('app.js.gz').read_binary()) == \
+        static_dir.join('app.js').read_binary()
+
+    response = TestClient(app).get('/static/app.js', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert response.text == 'var x = 1;\n' * 1000
+
+
+def test_schema_cache_and_shards():
+    from celerystar_apistar import Document, TestClient
+
+    def list_users():
+        pass
+
+    def list_orders():
+        pass
+
+    app = cs.App(routes=[
+        cs.Route('/users/', 'GET', list_users),
+        cs.Route('/orders/', 'GET', list_orders),
+    ], shard_schema=True)
+    client = TestClient(app)
+
+    response = client.get('/schema/')
+    etag = response.headers['etag']
+    assert response.headers['cache-control'] == 'no-cache'
+    assert set(response.json()['paths']) == {'/users/', '/orders/'}
+    assert app.get_schema() == (response.content, etag)
+    assert app.get_schema()[0] is app.get_schema()[0]
+
+    response = client.get('/schema/', headers={'If-None-Match': 'W/"other", ' + etag})
+    assert response.status_code == 304
+    assert response.content == b''
+
+    response = client.get('/schema/users/')
+    assert set(response.json()['paths']) == {'/users/'}
+    assert response.headers['etag'] != etag
+    assert client.get('/schema/missing/').status_code == 404
+
+    # Replacing the document invalidates the cached schemas.
+    app.document = Document(content=app.document.content[:1])
+    response = client.get('/schema/')
+    assert set(response.json()['paths']) == {'/users/'}
+    assert response.headers['etag'] != etag
+
+
+def test_lazy_header_and_query_views():
+    from celerystar_apistar import http
+    from celerystar_apistar.server.asgi import ScopeHeaders
+    from celerystar_apistar.server.wsgi import EnvironHeaders
+
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'CONTENT_TYPE': 'application/json',
+        'HTTP_X_REQUEST_ID': 'abc',
+        'HTTP_ACCEPT': 'text/html',
+    }
+    raw_headers = [
+        (b'content-type', b'application/json'),
+        (b'x-request-id', b'abc'),
+        (b'accept', b'text/html'),
+        (b'accept', b'text/plain'),
+    ]
+    for headers in (EnvironHeaders(environ), ScopeHeaders(raw_headers)):
+        assert headers['Content-Type'] == 'application/json'
+        assert headers.get('X-Request-Id') == 'abc'
+        assert 'x-request-id' in headers
+        assert headers.get('Missing', 'default') == 'default'
+        assert 'missing' not in headers
+        assert headers.get_list('missing') == []
+        assert '_items' not in headers.__dict__
+        assert len(headers) == len(headers.items())
+        assert '_items' in headers.__dict__
+    assert EnvironHeaders(environ) == http.Headers([
+        ('content-type', 'application/json'),
+        ('x-request-id', 'abc'),
+        ('accept', 'text/html'),
+    ])
+    assert ScopeHeaders(raw_headers).get_list('Accept') == ['text/html', 'text/plain']
+    assert len(ScopeHeaders(raw_headers)) == 4
+
+    query_string = 'a=1&b=&c=x+y&a=2&d%5B%5D=%2F&e'
+    params = http.QueryStringParams(query_string)
+    assert params['a'] == '1'
+    assert params.get_list('a') == ['1', '2']
+    assert params['c'] == 'x y'
+    assert params['d[]'] == '/'
+    assert 'b' not in params and 'e' not in params
+    assert params.get('b', 'default') == 'default'
+    assert '_items' not in params.__dict__
+    assert params.keys() == ['a', 'c', 'a', 'd[]']
+    assert '_items' not in params.__dict__
+    assert params == http.QueryParams([('a', '1'), ('c', 'x y'), ('a', '2'), ('d[]', '/')])
+    assert '_items' in params.__dict__
+
+
+def test_multidict_headers():
+    from celerystar_apistar import http
+
+    headers = http.MutableHeaders([
+        ('Accept', 'text/html'), ('X-Id', '1'), ('accept', 'text/plain'),
+    ])
+    assert headers['ACCEPT'] == 'text/html'
+    assert headers.get_list('accept') == ['text/html', 'text/plain']
+    assert headers.get_list('x-id') == ['1']
+    assert headers.get_list('missing') == []
+    assert len(headers) == 3
+
+    headers['X-Id'] = 2
+    assert headers.items() == [('accept', 'text/html'), ('x-id', '2'), ('accept', 'text/plain')]
+
+    # Setting a repeated header replaces all of its values.
+    headers['Accept'] = 'application/json'
+    assert headers.items() == [('accept', 'application/json'), ('x-id', '2')]
+    assert headers.get_list('accept') == ['application/json']
+
+    assert headers.setdefault('X-Id', '3') == '2'
+    assert headers.setdefault('Vary', 'Accept') == 'Accept'
+    del headers['x-id']
+    assert headers == http.Headers({'Accept': 'application/json', 'Vary': 'Accept'})
+    assert headers['vary'] == 'Accept'
+
+    params = http.QueryParams([('a', '1'), ('b', '2'), ('a', '3')])
+    assert params['a'] == '1'
+    assert params.get_list('a') == ['1', '3']
+    assert params.keys() == ['a', 'b', 'a']
+    assert list(params) == [('a', '1'), ('b', '2'), ('a', '3')]
+
+
+def test_json_backend():
+    from kombu.serialization import dumps, loads, prepare_accept_content
+    from celerystar_apistar import http, jsonbackend
+    from celerystar_apistar.codecs import JSONCodec
+    from celerystar_apistar.exceptions import ParseError
+
+    class Item(cs.Type):
+        id = cs.Integer()
+        when = cs.Date()
+
+    item = Item(id=1, when='2018-01-02')
+    previous = jsonbackend.backend.name
+    try:
+        for name, backend_class in jsonbackend.BACKENDS.items():
+            if backend_class.module is None:
+                with raises(cs.ConfigurationError):
+                    jsonbackend.set_backend(name)
+                continue
+            jsonbackend.set_backend(name)
+            content = jsonbackend.dumps({'item': item, 'text': 'é'})
+            assert content == '{"item":{"id":1,"when":"2018-01-02"},"text":"é"}'.encode()
+            assert http.JSONResponse([item]).content == b'[{"id":1,"when":"2018-01-02"}]'
+            data = JSONCodec().decode(b'{"b": 1, "a": [2]}')
+            assert type(data) is dict and list(data) == ['b', 'a']
+            with raises(ParseError, match='Malformed JSON'):
+                JSONCodec().decode(b'{"b": ')
+            with raises(TypeError):
+                jsonbackend.dumps(object())
+    finally:
+        jsonbackend.set_backend(previous)
+
+    with raises(cs.ConfigurationError):
+        jsonbackend.set_backend('simplejson')
+
+    app = cs.make_celery_app('json_backend')
+    content_type, encoding, data = dumps({'item': item}, serializer=cs.JSON_SERIALIZER)
+    accept = prepare_accept_content(app.conf.accept_content)
+    assert loads(data, content_type, encoding, accept=accept) == {
+        'item': {'id': 1, 'when': '2018-01-02'}
+    }
+    cs.BaseService._validate_apply_options({'serializer': cs.JSON_SERIALIZER})
+
+
+def test_accept_negotiation():
+    from celerystar_apistar import App, ASyncApp, Route, http
+    from celerystar_apistar.codecs import BaseCodec, JSONCodec, TextCodec
+    from celerystar_apistar.conneg import CodecTable
+    from celerystar_apistar.exceptions import NoCodecAvailable
+
+    class CSVCodec(BaseCodec):
+        media_type = 'text/csv'
+
+        def decode(self, bytestring, **options):
+            return bytestring.decode('utf-8').split(',')
+
+        def encode(self, item, **options):
+            return ','.join(str(value) for value in item).encode('utf-8')
+
+    json_codec, csv_codec, text_codec = JSONCodec(), CSVCodec(), TextCodec()
+    table = CodecTable([json_codec, csv_codec, text_codec])
+    assert table.negotiate_content_type() is json_codec
+    assert table.negotiate_content_type('application/json; charset=utf-8') is json_codec
+    assert table.negotiate_content_type('text/csv') is csv_codec
+    assert table.negotiate_content_type('text/plain') is text_codec
+    with raises(NoCodecAvailable):
+        table.negotiate_content_type('image/png')
+    with raises(NoCodecAvailable):
+        table.negotiate_content_type('image/png')
+    assert table.content_type_cache.hits == 1
+
+    assert table.negotiate_accept(None) is json_codec
+    assert table.negotiate_accept('*/*') is json_codec
+    assert table.negotiate_accept('text/csv') is csv_codec
+    assert table.negotiate_accept('text/*, application/json;q=0.5') is csv_codec
+    assert table.negotiate_accept('text/csv;q=0.1, */*;q=0.5') is json_codec
+    assert table.negotiate_accept('application/json;q=0, text/csv;q=0.2') is csv_codec
+    with raises(NoCodecAvailable):
+        table.negotiate_accept('image/png')
+
+    def rows():
+        return [1, 2, 3]
+
+    def parse(data: http.RequestData):
+        return data
+
+    routes = [Route('/rows', 'GET', rows), Route('/parse', 'POST', parse)]
+    for app_class in (App, ASyncApp):
+        client = TestClient(app_class(routes=routes, codecs=[json_codec, csv_codec]))
+        response = client.get('/rows')
+        assert response.json() == [1, 2, 3]
+        assert response.headers['Vary'] == 'Accept'
+        response = client.get('/rows', headers={'Accept': 'text/csv'})
+        assert response.headers['Content-Type'] == 'text/csv'
+        assert response.text == '1,2,3'
+        response = client.get('/rows', headers={'Accept': 'image/png'})
+        assert response.json() == [1, 2, 3]
+        response = client.post('/parse', data=b'a,b', headers={'Content-Type': 'text/csv'})
+        assert response.json() == ['a', 'b']
+        response = client.post('/parse', data=b'a', headers={'Content-Type': 'text/plain'})
+        assert response.status_code == 415
+
+    client = TestClient(App(routes=routes))
+    response = client.get('/rows', headers={'Accept': 'text/csv'})
+    assert response.json() == [1, 2, 3]
+    assert 'Vary' not in response.headers
+
+
+def test_msgpack_codec():
+    from kombu.serialization import dumps, loads, prepare_accept_content
+    from celerystar_apistar import msgpackbackend
+    from celerystar_apistar.codecs import MessagePackCodec
+    from celerystar_apistar.exceptions import ParseError
+
+    class Item(cs.Type):
+        id = cs.Integer()
+        score = cs.Number()
+        when = cs.Date()
+
+    item = Item(id=-200, score=0.1, when='2018-01-02')
+    data = {'item': item, 'blob': b'\x00\xff', 'big': 2 ** 64 - 1, 'none': None}
+    for pack, unpack in ((msgpackbackend.pack, msgpackbackend.unpack),
+                         (msgpackbackend.dumps, msgpackbackend.loads)):
+        decoded = unpack(pack(data))
+        assert decoded == dict(data, item=dict(item))
+        assert Item(decoded['item']) == item
+    assert msgpackbackend.pack([1, -1, 'a']) == b'\x93\x01\xff\xa1a'
+    assert len(msgpackbackend.pack(list(range(1000)))) < len(str(list(range(1000))))
+    with raises(TypeError):
+        msgpackbackend.pack(object())
+    with raises(OverflowError):
+        msgpackbackend.pack(2 ** 64)
+
+    codec = MessagePackCodec()
+    assert codec.decode(codec.encode([item])) == [dict(item)]
+    assert list(codec.decode_stream([b'\x92\x01', b'\x02'])) == [1, 2]
+    for malformed in (b'\x92\x01', b'\xc1', b'\x01\x02', b'\x81\x90\x01'):
+        with raises(ParseError, match='Malformed MessagePack'):
+            codec.decode(malformed)
+    with raises(ParseError, match='top-level array'):
+        list(codec.decode_stream([b'\x01']))
+
+    app = cs.make_celery_app('msgpack', serializer=cs.MSGPACK_SERIALIZER)
+    assert app.conf.task_serializer == app.conf.result_serializer == cs.MSGPACK_SERIALIZER
+    content_type, encoding, payload = dumps({'item': item}, serializer=cs.MSGPACK_SERIALIZER)
+    assert content_type == cs.MSGPACK_CONTENT_TYPE
+    accept = prepare_accept_content(app.conf.accept_content)
+    assert loads(payload, content_type, encoding, accept=accept) == {'item': dict(item)}
+    cs.BaseService._validate_apply_options({'serializer': cs.MSGPACK_SERIALIZER})
+    with raises(cs.ConfigurationError):
+        cs.make_celery_app('msgpack', serializer='pickle')
+
+    class InitialState(cs.Type):
+        numbers = cs.Array(items=cs.Integer())
+
+    def double(state: InitialState):
+        return {'numbers': [number * 2 for number in state['numbers']]}
+
+    service = cs.make_service(double, [], InitialState, app)
+    client = TestClient(cs.make_wsgi_app([service]))
+    body = codec.encode({'apply_opts': {}, 'result_opts': {}, 'data': {'numbers': [1, 2]}})
+    response = client.post('/msgpack/double', data=body, headers={
+        'Content-Type': 'application/msgpack',
+        'Accept': 'application/msgpack'
+    })
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/msgpack'
+    assert codec.decode(response.content) == {'numbers': [2, 4]}
+    response = client.post('/msgpack/double', data=body, headers={
+        'Content-Type': 'application/msgpack'
+    })
+    assert response.json() == {'numbers': [2, 4]}
+
+
+def test_compact_payload():
+    class InitialState(cs.Type):
+        user_id = cs.Integer()
+        name = cs.String()
+        when = cs.Date()
+        limit = cs.Integer(default=10)
+
+    def describe(state: InitialState):
+        return [state['user_id'], state['name'], state['when'], state['limit']]
+
+    app = cs.make_celery_app('compact')
+    srv = cs.make_service(describe, [], InitialState, app, compact=True)
+    initial_state = {'user_id': 1, 'name': 'a', 'when': '2018-01-02'}
+    assert srv.apply_local(initial_state, {}) == [1, 'a', '2018-01-02', 10]
+
+    payload = srv._make_payload(initial_state)
+    assert payload == [srv.fingerprint, 1, 'a', '2018-01-02', 10]
+    assert len(cs.jsonbackend.dumps(payload)) < len(cs.jsonbackend.dumps(initial_state))
+    with patch.object(srv.task, 'apply_async') as apply_async:
+        srv.apply_remote(initial_state, {})
+        apply_async.assert_called_with([payload], {})
+
+    plain = cs.make_service(describe, [], InitialState, app, name='plain')
+    assert plain._make_payload(initial_state) is initial_state
+    assert plain.fingerprint == srv.fingerprint
+    assert plain.task.apply([payload]).get() == [1, 'a', '2018-01-02', 10]
+
+    class OtherState(cs.Type):
+        user_id = cs.String()
+        name = cs.String()
+        when = cs.Date()
+        limit = cs.Integer(default=10)
+
+    def describe_other(state: OtherState):
+        return dict(state)
+
+    other = cs.make_service(describe_other, [], OtherState, app)
+    assert other.fingerprint != srv.fingerprint
+    with raises(cs.ValidationError, match='fingerprint'):
+        other.task.apply([payload]).get()
+    with raises(cs.ValidationError, match='expected 4'):
+        srv.task.apply([payload[:-1]]).get()
+
+
+def test_payload_compression():
+    class InitialState(cs.Type):
+        text = cs.String()
+
+    def repeat(state: InitialState):
+        return state['text'] * 2
+
+    for serializer in (cs.JSON_SERIALIZER, cs.MSGPACK_SERIALIZER):
+        app = cs.make_celery_app('compression', serializer=serializer)
+        for compression in cs.COMPRESSIONS:
+            srv = cs.make_service(repeat, [], InitialState, app,
+                                  name=f'repeat_{compression}',
+                                  compression=compression,
+                                  compression_threshold=100)
+            assert srv.apply_local({'text': 'a'}, {}) == 'aa'
+            assert srv.apply_local({'text': 'b' * 1000}, {}) == 'b' * 2000
+
+            payload = srv._make_payload({'text': 'c' * 1000})
+            assert payload[cs.COMPRESSED_KEY] == compression
+            assert isinstance(payload['data'], bytes) == (serializer == cs.MSGPACK_SERIALIZER)
+            assert srv._read_payload(payload) == {'text': 'c' * 1000}
+
+            stats = srv.compressor.stats()
+            assert stats['messages'] == 5 and stats['compressed'] == 3
+            assert stats['compressed_bytes'] < stats['raw_bytes'] / 2
+
+    srv = cs.make_service(repeat, [], InitialState, app, name='compact_compression',
+                          compact=True, compression='zlib', compression_threshold=0)
+    payload = srv._make_payload({'text': 'd'})
+    assert cs.decompress(payload) == [srv.fingerprint, 'd']
+    result = srv.task.apply([payload]).get()
+    assert result[cs.COMPRESSED_KEY] == 'zlib'
+    assert cs.decompress(result) == 'dd'
+    assert cs.decompress({'text': 'e'}) == {'text': 'e'}
+
+    with raises(cs.ConfigurationError, match='compression must be one of'):
+        cs.make_service(repeat, [], InitialState, app, name='bad', compression='bz2')
+
+    # The encoding follows the serializer of each call, and values below
+    # the threshold are not serialized to measure them.
+    app = cs.make_celery_app('compression_msgpack', serializer=cs.MSGPACK_SERIALIZER)
+    srv = cs.make_service(repeat, [], InitialState, app, name='per_call',
+                          compression='zlib', compression_threshold=100)
+    payload = srv._make_payload({'text': 'f' * 1000}, serializer='json')
+    assert isinstance(payload['data'], str)
+    assert isinstance(srv._make_payload({'text': 'f' * 1000})['data'], bytes)
+    with patch.object(cs.msgpackbackend, 'dumps') as dumps:
+        assert srv._make_payload({'text': 'small'}) == {'text': 'small'}
+    assert not dumps.called
+
+
+def test_blob_store_offloading(tmp_path):
+    class InitialState(cs.Type):
+        name = cs.String()
+        document = cs.String(min_length=1)
+        count = cs.Integer(default=1)
+
+    loaded = []
+
+    class CountingStore(cs.FileBlobStore):
+        def get(self, key):
+            loaded.append(key)
+            return super().get(key)
+
+    store = CountingStore(str(tmp_path))
+
+    def name_only(state: InitialState):
+        assert isinstance(state, InitialState)
+        return state['name'] * state['count']
+
+    def describe(state: InitialState):
+        return [state.name, len(state['document'])]
+
+    app = cs.make_celery_app('offload')
+    for compact in (False, True):
+        srv = cs.make_service(name_only, [], InitialState, app,
+                              name=f'name_only_{compact}', compact=compact,
+                              blob_store=store, offload_threshold=100)
+        initial_state = {'name': 'a', 'document': 'é' * 60}
+        payload = srv._make_payload(initial_state)
+        assert payload[cs.BLOBS_KEY] == ['document']
+        state = srv._read_payload(payload)
+        assert state['name'] == 'a'
+        assert set(state['document']) == {cs.BLOB_KEY, 'encoding'}
+        assert store.get(state['document'][cs.BLOB_KEY]) == ('é' * 60).encode()
+        loaded.clear()
+        assert srv.task.apply([payload]).get() == 'a'
+        assert loaded == []
+
+        assert srv._make_payload({'name': 'a', 'document': 'short'}) == {
+            cs.BLOBS_KEY: [],
+            'payload': ([srv.fingerprint, 'a', 'short', 1] if compact
+                        else {'name': 'a', 'document': 'short'}),
+        }
+
+    srv = cs.make_service(describe, [], InitialState, app,
+                          blob_store=store, offload_threshold=100)
+    payload = srv._make_payload({'name': 'b', 'document': 'x' * 500})
+    assert srv.task.apply([payload]).get() == ['b', 500]
+    assert len(loaded) == 1
+
+    # apply_local runs in-process, so nothing is written to the store.
+    with patch.object(store, 'put') as put:
+        assert srv.apply_local({'name': 'b', 'document': 'y' * 500}, {}) == ['b', 500]
+    assert not put.called
+    key = store.put(b'x' * 500)
+
+    # Only the fields listed in the envelope are read from the store, and
+    # only if they could have been offloaded.
+    class Document(cs.Type):
+        document = cs.String()
+        meta = cs.Object()
+
+    def echo(state: Document):
+        return dict(state)
+
+    srv = cs.make_service(echo, [], Document, app, name='echo',
+                          blob_store=store, offload_threshold=100)
+    ref = {cs.BLOB_KEY: key}
+    payload = srv._make_payload({'document': 'a', 'meta': ref})
+    assert payload[cs.BLOBS_KEY] == []
+    assert srv.task.apply([payload]).get() == {'document': 'a', 'meta': ref}
+    forged = {cs.BLOBS_KEY: ['meta'], 'payload': {'document': 'a', 'meta': ref}}
+    with raises(cs.ValidationError, match='cannot offload meta'):
+        srv.task.apply([forged]).get()
+    forged = {cs.BLOBS_KEY: ['document'], 'payload': {'document': 'a', 'meta': {}}}
+    with raises(cs.ValidationError, match='not a blob reference'):
+        srv.task.apply([forged]).get()
+    with raises(cs.ValidationError, match='no blob envelope'):
+        srv.task.apply([{'document': 'a', 'meta': {}}]).get()
+
+    key = store.put(b'')
+    assert store.get(key) == b''
+    store.delete(key)
+    with raises(FileNotFoundError):
+        store.get(key)
+    with raises(ValueError, match='invalid blob key'):
+        store.get('../secret')
+    assert store.prune(-1) == 2
+
+    # Storing a blob again keeps prune() from deleting it.
+    import os
+    import time
+    key = store.put(b'again')
+    old = time.time() - 3600
+    os.utime(store._path(key), (old, old))
+    assert store.put(b'again') == key
+    assert store.prune(60) == 0
+    assert store.get(key) == b'again'
+
+    # put() prunes blobs older than max_age now and then.
+    auto = cs.FileBlobStore(str(tmp_path / 'auto'), max_age=60)
+    key = auto.put(b'old')
+    os.utime(auto._path(key), (old, old))
+    auto.put(b'new')
+    assert auto.get(key) == b'old'
+    auto._next_prune = 0
+    auto.put(b'new')
+    with raises(FileNotFoundError):
+        auto.get(key)
+    with raises(cs.ValidationError):
+        srv.apply_local({'name': 'b', 'document': 'x' * 500, 'count': 'many'}, {})
+
+
+def test_result_cache(tmp_path):
+    import time
+
+    class InitialState(cs.Type):
+        a = cs.Integer()
+        tags = cs.Object()
+
+    calls = []
+
+    def add(state: InitialState):
+        calls.append(state['a'])
+        return {'a': state['a'], 'calls': len(calls)}
+
+    app = cs.make_celery_app('cache')
+    caches = [cs.MemoryResultCache(maxsize=2),
+              cs.SQLiteResultCache(str(tmp_path / 'results.db'), maxsize=2)]
+    for cache in caches:
+        calls.clear()
+        srv = cs.make_service(add, [], InitialState, app,
+                              name=f'add_{type(cache).__name__}', cache=cache)
+        assert srv.apply_local({'a': 1, 'tags': {'x': 1, 'y': 2}}, {}) == {'a': 1, 'calls': 1}
+        assert srv.apply_local({'tags': {'y': 2, 'x': 1}, 'a': 1}, {}) == {'a': 1, 'calls': 1}
+        srv.apply_local({'a': 2, 'tags': {}}, {})
+        srv.apply_local({'a': 3, 'tags': {}}, {})
+        assert srv.apply_local({'a': 1, 'tags': {'x': 1, 'y': 2}}, {})['calls'] == 4
+        assert calls == [1, 2, 3, 1]
+        assert cache.stats() == {'hits': 1, 'stale_hits': 0, 'misses': 4}
+
+    shared = cs.SQLiteResultCache(str(tmp_path / 'results.db'), maxsize=2)
+    srv = cs.make_service(add, [], InitialState, app, name='add_shared', cache=shared)
+    srv._run_cached(InitialState(a=1, tags={}), lambda: 'first')
+    reopened = cs.SQLiteResultCache(str(tmp_path / 'results.db'))
+    assert reopened.lookup(srv._cache_key(InitialState(a=1, tags={}))) == ('first', False)
+
+    cache = cs.MemoryResultCache(ttl=0.05, stale_ttl=10)
+    srv = cs.make_service(add, [], InitialState, app, name='add_stale', cache=cache)
+    calls.clear()
+    assert srv.apply_local({'a': 1, 'tags': {}}, {})['calls'] == 1
+    time.sleep(0.06)
+    assert srv.apply_local({'a': 1, 'tags': {}}, {})['calls'] == 1
+    for _ in range(100):
+        if srv.apply_local({'a': 1, 'tags': {}}, {})['calls'] == 2:
+            break
+        time.sleep(0.01)
+    else:
+        assert False, 'stale result was not revalidated'
+    assert cache.stale_hits >= 1
+
+    cache = cs.MemoryResultCache(ttl=0)
+    assert cache.lookup('key') is None
+    cache.store('key', 1)
+    assert cache.lookup('key') is None
+
+    # Keys are built from bytes fields too, and tell them from strings.
+    class Blob(cs.Type):
+        data = cs.Any()
+
+    def size(state: Blob):
+        calls.append(state['data'])
+        return len(state['data'])
+
+    app = cs.make_celery_app('cache_bytes', serializer=cs.MSGPACK_SERIALIZER)
+    srv = cs.make_service(size, [], Blob, app, name='size',
+                          cache=cs.MemoryResultCache(),
+                          dedupe=cs.MemoryDedupeStore())
+    calls.clear()
+    assert srv.apply_local({'data': b'\x00' * 10}, {}) == 10
+    assert srv.apply_local({'data': b'\x00' * 10}, {}) == 10
+    assert calls == [b'\x00' * 10]
+    assert srv._cache_key(Blob(data=b'ab')) != srv._cache_key(Blob(data='ab'))
+    with patch.object(srv.task, 'apply_async') as apply_async:
+        apply_async.side_effect = lambda args, kwargs, task_id: MagicMock(id=task_id)
+        first = srv.apply_remote({'data': b'\x00' * 10}, {})
+        assert srv.apply_remote({'data': b'\x00' * 10}, {}) == first
+        assert apply_async.call_count == 1
+
+
+def test_single_flight(tmp_path):
+    import threading
+
+    class InitialState(cs.Type):
+        a = cs.Integer()
+
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow(state: InitialState):
+        calls.append(state['a'])
+        started.set()
+        release.wait(5)
+        return state['a'] * 10
+
+    app = cs.make_celery_app('single_flight', backend='cache+memory://',
+                             task_always_eager=True)
+    srv = cs.make_resulter_service(slow, [], InitialState, app,
+                                   single_flight=cs.SingleFlight())
+    results = []
+
+    def call(a):
+        results.append(srv.apply_remote({'a': a}, {}, {'timeout': 5}))
+
+    threads = [threading.Thread(target=call, args=(1,))]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=call, args=(1,)) for _ in range(4)]
+    for thread in threads[1:]:
+        thread.start()
+    while srv.single_flight.joined < 4:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [10] * 5
+    assert calls == [1]
+    assert srv.single_flight.stats() == {'led': 1, 'joined': 4}
+    assert srv.apply_remote({'a': 2}, {}, {'timeout': 5}) == 20
+    assert calls == [1, 2]
+
+    # Two processes sharing the database, one leading and one joining.
+    class AsyncResult:
+        def __init__(self, id):
+            self.id = id
+
+    published = []
+
+    def publish(task_id):
+        published.append(task_id)
+        return AsyncResult(task_id)
+
+    waiting = threading.Event()
+    done = threading.Event()
+
+    def wait(result):
+        waiting.set()
+        done.wait(5)
+        return result.id
+
+    filename = str(tmp_path / 'flights.db')
+    first, second = cs.SQLiteSingleFlight(filename), cs.SQLiteSingleFlight(filename)
+    leader = threading.Thread(target=lambda: results.append(
+        first.run('key', publish, AsyncResult, wait)))
+    leader.start()
+    waiting.wait(5)
+    task_id, = published
+    # The leader holds no lock on the database while its task runs.
+    assert second.run('key', publish, AsyncResult, lambda result: result.id) == task_id
+    done.set()
+    leader.join(5)
+    assert results[-1] == task_id and published == [task_id]
+    assert second.stats() == {'led': 0, 'joined': 1}
+    assert second.run('key', publish, AsyncResult, lambda result: result.id) != task_id
+    assert len(published) == 2
+
+    # The lock is not held while publishing either, and a failed publish
+    # does not leave its task id behind.
+    def fail(task_id):
+        assert second.run('unrelated', publish, AsyncResult, lambda result: 'ok') == 'ok'
+        raise ValueError('broker down')
+
+    with raises(ValueError):
+        first.run('other', fail, AsyncResult, wait)
+    assert first.run('other', publish, AsyncResult, lambda result: 'ok') == 'ok'
+
+
+def test_idempotency_keys(tmp_path):
+    class InitialState(cs.Type):
+        request_id = cs.String()
+        a = cs.Integer()
+
+    def job(state: InitialState):
+        pass
+
+    app = cs.make_celery_app('idempotency')
+    for store in (cs.MemoryDedupeStore(),
+                  cs.SQLiteDedupeStore(str(tmp_path / 'keys.db'))):
+        srv = cs.make_service(job, [], InitialState, app, dedupe=store,
+                              name=f'job_{type(store).__name__}')
+        with patch.object(srv.task, 'apply_async') as apply_async:
+            apply_async.side_effect = lambda args, kwargs, task_id: MagicMock(id=task_id)
+            first = srv.apply_remote({'request_id': 'r1', 'a': 1}, {})
+            assert srv.apply_remote({'a': 1, 'request_id': 'r1'}, {}) == first
+            second = srv.apply_remote({'request_id': 'r1', 'a': 2}, {})
+            assert second != first
+            with patch.object(srv, '_make_payload', wraps=srv._make_payload) as make:
+                assert srv.apply_remote({'request_id': 'r1', 'a': 3}, {}, 'k') == \
+                    srv.apply_remote({'request_id': 'r1', 'a': 4}, {}, 'k')
+                assert make.call_count == 1
+            assert apply_async.call_count == 3
+            assert apply_async.call_args_list[0][1] == {'task_id': first}
+            assert store.stats() == {'hits': 2, 'misses': 3}
+
+            apply_async.side_effect = ConnectionError()
+            with raises(ConnectionError):
+                srv.apply_remote({'request_id': 'r1', 'a': 5}, {})
+            apply_async.side_effect = lambda args, kwargs, task_id: MagicMock(id=task_id)
+            srv.apply_remote({'request_id': 'r1', 'a': 5}, {})
+            assert apply_async.call_count == 5
+
+        srv = cs.make_service(job, [], InitialState, app, dedupe=store,
+                              dedupe_window=0, name=f'job_{type(store).__name__}_0')
+        with patch.object(srv.task, 'apply_async') as apply_async:
+            srv.apply_remote({'request_id': 'r1', 'a': 1}, {})
+            srv.apply_remote({'request_id': 'r1', 'a': 1}, {})
+            assert apply_async.call_count == 2
+
+    store = cs.MemoryDedupeStore()
+    srv = cs.make_service(job, [], InitialState, app, name='job_field',
+                          dedupe=store, idempotency_field='request_id')
+    client = TestClient(cs.make_wsgi_app([srv]))
+    with patch.object(srv.task, 'apply_async') as apply_async:
+        apply_async.side_effect = lambda args, kwargs, task_id: MagicMock(id=task_id)
+        first = srv.apply_remote({'request_id': 'r1', 'a': 1}, {})
+        assert srv.apply_remote({'request_id': 'r1', 'a': 2}, {}) == first
+
+        def post(a, **headers):
+            return client.post('/idempotency/job_field', headers=headers, json={
+                'remote': True, 'apply_opts': {}, 'result_opts': {},
+                'data': {'request_id': 'r2', 'a': a},
+            }).json()
+
+        assert post(1, **{'Idempotency-Key': 'h1'}) == post(2, **{'Idempotency-Key': 'h1'})
+        assert post(3) == post(4) != first
+        assert apply_async.call_count == 3
+
+    with raises(cs.ConfigurationError, match='unknown idempotency field'):
+        cs.make_service(job, [], InitialState, app, name='job_bad',
+                        dedupe=store, idempotency_field='missing')
+
+
+
+def test_batch_service(tmp_path):
+    import threading
+    import time
+    from typing import List, NewType
+
+    class InitialState(cs.Type):
+        a = cs.Integer()
+
+    Doubled = NewType('Doubled', int)
+    Connection = NewType('Connection', str)
+
+    class DoubledComponent(cs.Component):
+        def resolve(self, state: InitialState) -> Doubled:
+            return Doubled(state['a'] * 2)
+
+    class ConnectionComponent(cs.Component):
+        def resolve(self) -> Connection:
+            return Connection('db')
+
+    batches = []
+
+    def lookup(states: List[InitialState], doubled: List[Doubled], conn: Connection):
+        batches.append([state['a'] for state in states])
+        assert all(isinstance(state, InitialState) for state in states)
+        return [ValueError('odd') if state['a'] % 2 else [conn, value]
+                for state, value in zip(states, doubled)]
+
+    app = cs.make_celery_app('batch')
+    srv = cs.make_batch_service(lookup, [DoubledComponent(), ConnectionComponent()],
+                                InitialState, app, batch_size=4, batch_timeout=0.5)
+    assert isinstance(srv, cs.BatchService)
+    results = {}
+
+    def call(a):
+        try:
+            results[a] = srv.apply_local({'a': a}, {})
+        except Exception as exc:
+            results[a] = exc
+
+    threads = [threading.Thread(target=call, args=(a,)) for a in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(batches) == 1 and sorted(batches[0]) == [0, 1, 2, 3]
+    assert results[0] == ['db', 0] and results[2] == ['db', 4]
+    assert isinstance(results[1], ValueError) and isinstance(results[3], ValueError)
+
+    # A message failing validation on the worker fails alone.
+    assert srv.task.apply([{'a': 2}]).get() == ['db', 4]
+    with raises(cs.ValidationError):
+        srv.task.apply([{'a': 'x'}]).get()
+
+    # Without a timeout, a batch still takes the messages already queued.
+    running, gate = threading.Event(), threading.Event()
+
+    def gated(states: List[InitialState]):
+        running.set()
+        gate.wait(5)
+        batches.append([state['a'] for state in states])
+
+    batches.clear()
+    srv = cs.make_batch_service(gated, [], InitialState, app, batch_size=4)
+    assert srv.batch_timeout == 0
+    first = threading.Thread(target=srv.apply_local, args=({'a': 0}, {}))
+    first.start()
+    running.wait(5)
+    batcher = srv._get_batcher()
+    threads = [threading.Thread(target=srv.apply_local, args=({'a': a}, {}))
+               for a in (1, 2)]
+    for thread in threads:
+        thread.start()
+    while batcher.queue.qsize() < 2:
+        time.sleep(0.01)
+    gate.set()
+    for thread in [first, *threads]:
+        thread.join(5)
+    assert batches[0] == [0] and sorted(batches[1]) == [1, 2]
+
+    # Payload options apply to batch services too.
+    srv = cs.make_batch_service(lookup, [DoubledComponent(), ConnectionComponent()],
+                                InitialState, app, name='lookup_compact',
+                                compact=True, compression='zlib',
+                                compression_threshold=0,
+                                blob_store=cs.FileBlobStore(str(tmp_path)))
+    assert srv.apply_local({'a': 2}, {}) == ['db', 4]
+    payload = srv._make_payload({'a': 2})
+    assert srv._read_payload(payload) == {'a': 2}
+    assert srv._read_result(srv.task.apply([payload]).get()) == ['db', 4]
+
+    def broken(states: List[InitialState]):
+        return []
+
+    srv = cs.make_batch_service(broken, [], InitialState, app)
+    with raises(ValueError, match='must return a list of 1 results'):
+        srv.apply_local({'a': 1}, {})
+
+    def single(state: InitialState):
+        pass
+
+    with raises(cs.ConfigurationError, match='List'):
+        cs.make_batch_service(single, [], InitialState, app)
+
+
+def test_scatter():
+    class InitialState(cs.Type):
+        numbers = cs.Array(items=cs.Integer())
+        factor = cs.Integer(default=1)
+
+    class Results(cs.Type):
+        results = cs.Array()
+
+    def multiply(data: InitialState):
+        return [number * data['factor'] for number in data['numbers']]
+
+    def total(data: Results):
+        return sum(sum(result) for result in data['results'])
+
+    app = cs.make_celery_app('scatter', backend='cache+memory://',
+                             task_always_eager=True)
+    srv = cs.make_resulter_service(multiply, [], InitialState, app,
+                                   name='multiply')
+    reducer = cs.make_resulter_service(total, [], Results, app, name='total')
+    result_opts = {'timeout': 5}
+
+    state = {'numbers': [1, 2, 3, 4, 5], 'factor': 2}
+    assert srv.scatter(state, 'numbers', 2, result_opts=result_opts) == [
+        [2, 4], [6, 8], [10]]
+    assert srv.scatter(state, 'numbers', 2, reducer,
+                       result_opts=result_opts) == 30
+    assert srv.scatter({'numbers': []}, 'numbers', 2,
+                       result_opts=result_opts) == [[]]
+    with raises(cs.ValidationError):
+        srv.scatter({'numbers': ['x']}, 'numbers', 2, result_opts=result_opts)
+    with raises(cs.ConfigurationError, match='list field'):
+        srv.scatter(state, 'factor', 2, result_opts=result_opts)
+    with raises(cs.ConfigurationError, match='chunk_size'):
+        srv.scatter(state, 'numbers', 0, result_opts=result_opts)
+    with raises(cs.ConfigurationError, match='timeout'):
+        srv.scatter(state, 'numbers', 2)
+
+    # Reducers are checked before any chunk is published.
+    def log(data: Results):
+        pass
+
+    plain = cs.make_service(log, [], Results, cs.make_celery_app('scatter_plain'),
+                            name='log')
+    with patch.object(srv.task, 's') as signature:
+        with raises(cs.ConfigurationError, match='does not handle results'):
+            srv.scatter(state, 'numbers', 2, plain, result_opts=result_opts)
+        with raises(cs.ConfigurationError, match="'totals' as its only required"):
+            srv.scatter(state, 'numbers', 2, reducer, result_opts=result_opts,
+                        reduce_field='totals')
+        with raises(cs.ConfigurationError, match="'results' as its only required"):
+            srv.scatter({'numbers': [1, 2], 'factor': 1}, 'numbers', 1, srv,
+                        result_opts=result_opts)
+    assert not signature.called
+
+    # So are chunks, which may break constraints the whole list meets.
+    class Pairs(cs.Type):
+        numbers = cs.Array(items=cs.Integer(), min_items=2)
+
+    def pair(data: Pairs):
+        return data['numbers']
+
+    pairs = cs.make_resulter_service(pair, [], Pairs, app, name='pairs')
+    with patch.object(pairs.task, 's') as signature:
+        with raises(cs.ValidationError):
+            pairs.scatter({'numbers': [1, 2, 3]}, 'numbers', 2,
+                          result_opts=result_opts)
+    assert not signature.called
+
+    client = TestClient(cs.make_wsgi_app([srv, reducer, plain]))
+    response = client.post('/scatter/multiply/scatter', json={
+        'apply_opts': {}, 'result_opts': result_opts, 'field': 'numbers',
+        'chunk_size': 2, 'reduce': 'total', 'data': state,
+    })
+    assert response.status_code == 200
+    assert response.json() == 30
+    response = client.post('/scatter/multiply/scatter', json={
+        'apply_opts': {}, 'result_opts': result_opts, 'field': 'numbers',
+        'chunk_size': 0, 'data': state,
+    })
+    assert response.status_code == 400
+    assert client.post('/scatter/total/scatter', json={}).status_code == 400
+    response = client.post('/scatter/multiply/scatter', json={
+        'apply_opts': {}, 'result_opts': result_opts, 'field': 'numbers',
+        'chunk_size': 2, 'reduce': 'log', 'data': state,
+    })
+    assert response.status_code == 400
+
+
+def test_pipeline():
+    class Text(cs.Type):
+        text = cs.String()
+
+    class Words(cs.Type):
+        words = cs.Array(items=cs.String())
+        text = cs.String()
+
+    class Counted(cs.Type):
+        words = cs.Array(items=cs.String())
+        separator = cs.String(default=' ')
+
+    calls = []
+
+    def split(data: Text) -> Words:
+        calls.append('split')
+        return Words({'words': data['text'].split(), 'text': data['text']})
+
+    class Upper:
+        def __init__(self, data: Counted):
+            self.data = data
+
+        def run(self):
+            calls.append(type(self.data))
+            return {'words': [word.upper() for word in self.data['words']]}
+
+    def join(data: Counted):
+        calls.append(type(data))
+        return data['separator'].join(data['words'])
+
+    app = cs.make_celery_app('pipeline')
+    result_app = cs.make_celery_app('pipeline_results', backend='cache+memory://',
+                                    task_always_eager=True)
+    stages = [
+        cs.make_service(split, [], Text, app, name='split'),
+        cs.make_service(Upper, [], Counted, app, name='upper'),
+        cs.make_resulter_service(join, [], Counted, result_app, name='join'),
+    ]
+    pipeline = cs.make_pipeline(stages)
+    assert isinstance(pipeline, cs.PipelineResulterService)
+    assert pipeline.name == 'split|upper|join'
+    assert pipeline.app is result_app
+    assert pipeline.data_cls is Text
+
+    result = pipeline.apply_remote({'text': 'a b c'}, {}, {'timeout': 5})
+    assert result == 'A B C'
+    # The typed output of split is passed on as it is, the untyped output
+    # of Upper is validated by the next stage.
+    assert calls == ['split', dict, Counted]
+    with raises(cs.ValidationError):
+        pipeline.apply_remote({'text': 1}, {}, {'timeout': 5})
+
+    pipeline = cs.make_pipeline(stages[:2], name='split_upper')
+    assert isinstance(pipeline, cs.PipelineService)
+
+    def count(data: Counted) -> Text:
+        pass
+
+    with raises(cs.ConfigurationError, match="Text has no 'words'"):
+        cs.make_pipeline([cs.make_service(count, [], Counted, app), stages[1]])
+
+    class Numbers(cs.Type):
+        text = cs.Integer()
+
+    def number(data: Text) -> Numbers:
+        pass
+
+    with raises(cs.ConfigurationError, match='Numbers.text is a Integer'):
+        cs.make_pipeline([cs.make_service(number, [], Text, app), stages[0]])
+    with raises(cs.ConfigurationError, match='at least one stage'):
+        cs.make_pipeline([])
+
+    # Outputs whose validators differ from the next stage's, here in
+    # items and enum, are validated by it.
+    class Out(cs.Type):
+        n = cs.Array(items=cs.String())
+        kind = cs.String(allow_null=True)
+
+    class In(cs.Type):
+        n = cs.Array(items=cs.Integer())
+        kind = cs.String(enum=['x', 'y'])
+
+    def produce(data: Text) -> Out:
+        return Out({'n': data['text'].split(), 'kind': None})
+
+    def consume(data: In):
+        return dict(data)
+
+    pipeline = cs.make_pipeline([
+        cs.make_service(produce, [], Text, app, name='produce'),
+        cs.make_resulter_service(consume, [], In, result_app, name='consume'),
+    ])
+    with raises(cs.ValidationError):
+        pipeline.apply_remote({'text': 'a b'}, {}, {'timeout': 5})
+
+    from celerystar.celerystar import _same_validator
+    assert _same_validator(Out.validator.properties['n'],
+                           cs.Array(items=cs.String(), title='other'))
+    assert not _same_validator(Out.validator.properties['n'],
+                               In.validator.properties['n'])
+    assert not _same_validator(cs.String(allow_null=True),
+                               cs.String(enum=['x', 'y']))